@@ -0,0 +1,84 @@
+# Copyright 2012 The greplin-twisted-utils Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Simulates clients retrying against a recovering backend with each SleepManager backoff policy.
+
+Every client makes a request at the same moment while the backend is down.  Once it recovers, the backend serves
+capacity requests per second and fails the rest.  For each policy, prints the total number of requests made, the
+busiest second after recovery, and how long it takes until every client has been served.  Run as:
+
+  python -m greplin.defer.backoff_benchmark [clients] [recoverAt] [capacity]
+"""
+
+from __future__ import absolute_import
+
+from greplin.defer import time
+
+import collections
+import heapq
+import random
+import sys
+
+
+POLICIES = (
+  ('linear', time.LinearBackoff(5)),
+  ('exponential', time.ExponentialBackoff()),
+  ('full jitter', time.FullJitterBackoff()),
+  ('equal jitter', time.EqualJitterBackoff()),
+  ('decorrelated jitter', time.DecorrelatedJitterBackoff()),
+)
+
+
+
+def simulate(backoff, clients, recoverAt, capacity, minSleep = 1, maxSleep = 60):
+  """Returns (requests made, busiest second after recovery, time the last client was served) for the policy."""
+  random.seed(0)
+  template = time.SleepManager(minSleep, maxSleep, backoff=backoff)
+  managers = [template.clone() for _ in xrange(clients)]
+  pending = [(0.0, client) for client in xrange(clients)]
+  load = collections.defaultdict(int)
+  requests = 0
+  finished = 0
+
+  while pending:
+    second = int(pending[0][0])
+    served = 0
+    while pending and pending[0][0] < second + 1:
+      when, client = heapq.heappop(pending)
+      load[second] += 1
+      requests += 1
+      if second >= recoverAt and served < capacity:
+        served += 1
+        finished = when
+      else:
+        heapq.heappush(pending, (when + managers[client].nextSleep(), client))
+
+  peak = max(count for second, count in load.iteritems() if second >= recoverAt)
+  return requests, peak, finished
+
+
+def main():
+  """Runs the simulation."""
+  clients = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+  recoverAt = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+  capacity = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+  print '%d clients, backend down for %ds then serving %d requests/s' % (clients, recoverAt, capacity)
+  print '%-20s %10s %14s %12s' % ('policy', 'requests', 'peak req/s', 'drained at')
+  for name, backoff in POLICIES:
+    requests, peak, finished = simulate(backoff, clients, recoverAt, capacity)
+    print '%-20s %10d %14d %11.1fs' % (name, requests, peak, finished)
+
+
+if __name__ == '__main__':
+  main()
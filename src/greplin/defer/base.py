@@ -24,6 +24,8 @@ import time
 DEFERRED_ATTRIBUTES = tuple([name for name in dir(defer.Deferred)
                              if not name.startswith('__') and not hasattr(getattr(defer.Deferred, name), '__call__')])
 
+DEFERRED_DEFAULTS = tuple([(name, getattr(defer.Deferred, name)) for name in DEFERRED_ATTRIBUTES])
+
 
 
 class LowMemoryDeferred(object, defer.Deferred):
@@ -33,8 +35,8 @@ class LowMemoryDeferred(object, defer.Deferred):
 
 
   def __init__(self, *args):
-    for attr in DEFERRED_ATTRIBUTES:
-      setattr(self, attr, getattr(defer.Deferred, attr))
+    for attr, value in DEFERRED_DEFAULTS:
+      setattr(self, attr, value)
     self.result = getattr(defer, '_NO_RESULT', None)
     self.startTime = time.time()
     defer.Deferred.__init__(self, *args)
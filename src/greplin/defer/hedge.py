@@ -0,0 +1,160 @@
+# Copyright 2012 The greplin-twisted-utils Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Hedged calls: start extra attempts when the first is slow, and use whichever answers first."""
+
+from twisted.internet import defer
+from twisted.python import failure
+
+
+
+def hedge(fn, delays, maxInFlight=None, args=None, keywordArgs=None, stats=None, policy=None, clock=None):
+  """Calls the given function, calling it again each time an attempt goes too long without an answer.
+
+  Arguments:
+    fn: The function to call.  It may return a deferred.
+    delays: Seconds to wait after each attempt starts before starting the next one.  There are at most len(delays) + 1
+            attempts.
+    maxInFlight: If given, an extra attempt that is due while this many attempts are running waits until one fails.
+    args: Args to pass to the function.
+    keywordArgs: keywordArgs to pass to the function.
+    stats: A metrics.HedgeStats to record the calls in.
+    policy: A retry.RetryPolicy, such as a RetryBudget, shared by calls to the same backend.  Extra attempts are only
+            started if its allowRetry returns true, which can be used to cap the extra load hedging adds.
+    clock: The IReactorTime to schedule attempts with.  Defaults to the reactor.
+
+  Returns:
+    A deferred that fires with the first successful result.  The other attempts are cancelled, as are all attempts if
+    the deferred is cancelled.  An attempt that fails starts the next attempt straight away.  Fails with the last
+    failure if every attempt fails.
+  """
+  if clock is None:
+    from twisted.internet import reactor
+    clock = reactor
+  return _Hedge(fn, args or (), keywordArgs or {}, delays, maxInFlight, stats, policy, clock).result
+
+
+
+class _Hedge(object):
+  """The state of a single hedged call."""
+
+  def __init__(self, fn, args, keywordArgs, delays, maxInFlight, stats, policy, clock):
+    self.__fn = fn
+    self.__args = args
+    self.__keywordArgs = keywordArgs
+    self.__delays = delays
+    self.__nextDelay = 0
+    self.__maxInFlight = maxInFlight
+    self.__stats = stats
+    self.__policy = policy
+    self.__clock = clock
+    self.__pending = [] # (deferred, whether it is an extra attempt) for each running attempt.
+    self.__timer = None
+    self.__waitingForSlot = False
+    self.__startedAt = stats.started() if stats else None
+    self.result = defer.Deferred(self.__cancel)
+
+    if policy:
+      policy.started()
+    try:
+      self.__start(False)
+    except: # pylint: disable=W0702
+      self.__fail(failure.Failure())
+
+
+  def __start(self, isHedge):
+    """Schedules the next attempt, then starts this one."""
+    if self.__policy:
+      self.__policy.beforeAttempt()
+    if self.__nextDelay < len(self.__delays):
+      self.__timer = self.__clock.callLater(self.__delays[self.__nextDelay], self.__hedge)
+      self.__nextDelay += 1
+    if self.__stats:
+      self.__stats.attempt(isHedge)
+    d = defer.maybeDeferred(self.__fn, *self.__args, **self.__keywordArgs)
+    entry = (d, isHedge)
+    self.__pending.append(entry)
+    d.addBoth(self.__finished, entry)
+
+
+  def __hedge(self):
+    """Starts an extra attempt if the limits allow it."""
+    self.__timer = None
+    if self.__maxInFlight is not None and len(self.__pending) >= self.__maxInFlight:
+      self.__waitingForSlot = True
+      return
+    self.__waitingForSlot = False
+    if self.__policy and not self.__policy.allowRetry():
+      return
+    try:
+      self.__start(True)
+    except Exception: # The policy refused the attempt. # pylint: disable=W0703
+      pass
+
+
+  def __finished(self, result, entry):
+    """Handles the result of an attempt."""
+    if self.result.called or entry not in self.__pending:
+      return None # Swallow errors, including cancellation, from attempts that lost.
+    self.__pending.remove(entry)
+    if self.__stats:
+      self.__stats.attemptFinished()
+
+    if not isinstance(result, failure.Failure):
+      if self.__policy:
+        self.__policy.succeeded()
+      self.__stop()
+      if self.__stats:
+        self.__stats.finished(self.__startedAt, hedgeWon=entry[1])
+      self.result.callback(result)
+      return None
+
+    if self.__policy:
+      self.__policy.failed()
+    if self.__waitingForSlot or self.__timer is not None:
+      if self.__timer is not None:
+        self.__timer.cancel()
+      self.__hedge()
+    if not self.__pending and not self.result.called:
+      self.__stop()
+      self.__fail(result)
+    return None
+
+
+  def __fail(self, err):
+    """Fails the call."""
+    if self.__stats:
+      self.__stats.finished(self.__startedAt, failed=True)
+    self.result.errback(err)
+
+
+  def __stop(self):
+    """Cancels the timer and any attempts that are still running."""
+    if self.__timer is not None:
+      self.__timer.cancel()
+      self.__timer = None
+    self.__waitingForSlot = False
+    pending = self.__pending
+    self.__pending = []
+    for d, _ in pending:
+      if self.__stats:
+        self.__stats.attemptFinished(cancelled=True)
+      d.cancel()
+
+
+  def __cancel(self, _):
+    """Cancels the whole call."""
+    self.__stop()
+    if self.__stats:
+      self.__stats.finished(self.__startedAt, abandoned=True)
@@ -0,0 +1,148 @@
+# Copyright 2012 The greplin-twisted-utils Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for hedged calls."""
+
+from greplin.defer import hedge, inline, metrics, retry
+
+from twisted.internet import defer, task
+
+import unittest
+
+
+
+class HedgeTest(unittest.TestCase):
+  """Tests for hedge."""
+
+  def setUp(self):
+    self.clock = task.Clock()
+    self.attempts = []
+    self.cancelled = []
+    self.stats = metrics.HedgeStats(timer=self.clock.seconds)
+
+
+  def attempt(self, value):
+    """Starts an attempt that is answered by firing the deferred added to self.attempts."""
+    self.assertEquals('value', value)
+    index = len(self.attempts)
+    d = defer.Deferred(lambda _: self.cancelled.append(index))
+    self.attempts.append(d)
+    return d
+
+
+  def hedge(self, delays, **kw):
+    """Starts a hedged call."""
+    return hedge.hedge(self.attempt, delays, args=('value',), stats=self.stats, clock=self.clock, **kw)
+
+
+  def testFirstAnswers(self):
+    """Test that no extra attempt is made when the first answers in time."""
+    result = self.hedge([1])
+    self.attempts[0].callback(10)
+    self.assertEquals(10, result.result)
+    self.clock.advance(1)
+    self.assertEquals(1, len(self.attempts))
+    self.assertEquals((1, 1, 0, 0), (self.stats.calls, self.stats.attempts, self.stats.hedges, self.stats.inFlight))
+
+
+  def testHedgeWins(self):
+    """Test that slow attempts are hedged, and the losers cancelled."""
+    result = self.hedge([1, 2])
+    self.clock.advance(1)
+    self.assertEquals(2, len(self.attempts))
+    self.clock.advance(1)
+    self.assertEquals(2, len(self.attempts))
+    self.clock.advance(1)
+    self.assertEquals(3, len(self.attempts))
+    self.clock.advance(5)
+    self.assertEquals(3, len(self.attempts))
+
+    self.attempts[1].callback(20)
+    self.assertEquals(20, result.result)
+    self.assertEquals([0, 2], self.cancelled)
+    self.assertEquals(1, self.stats.hedgeWins)
+    self.assertEquals(2, self.stats.cancelled)
+    self.assertEquals(2.0, self.stats.hedgeRate())
+    self.assertEquals(0, self.stats.inFlight)
+    self.assertEquals(8, self.stats.latency.total)
+
+
+  def testFailureStartsNextAttempt(self):
+    """Test that a failed attempt starts the next attempt straight away."""
+    result = self.hedge([10])
+    self.attempts[0].errback(ValueError())
+    self.assertEquals(2, len(self.attempts))
+    self.attempts[1].callback(20)
+    self.assertEquals(20, result.result)
+
+
+  def testAllFail(self):
+    """Test that the call fails once every attempt has failed."""
+    result = self.hedge([1])
+    self.clock.advance(1)
+    self.attempts[1].errback(KeyError())
+    self.assertFalse(result.called)
+    self.attempts[0].errback(ValueError())
+    self.assertTrue(result.result.check(ValueError))
+    result.addErrback(lambda _: None) # Consume the error.
+    self.assertEquals(1, self.stats.failures)
+
+
+  def testMaxInFlight(self):
+    """Test that extra attempts wait for a slot."""
+    result = self.hedge([1, 1], maxInFlight=2)
+    self.clock.advance(5)
+    self.assertEquals(2, len(self.attempts))
+    self.attempts[0].errback(ValueError())
+    self.assertEquals(3, len(self.attempts))
+    self.attempts[2].callback(30)
+    self.assertEquals(30, result.result)
+
+
+  def testPolicy(self):
+    """Test that a retry budget caps extra attempts."""
+    budget = retry.RetryBudget(ratio=0, minRetries=1, clock=self.clock)
+    first = self.hedge([1], policy=budget)
+    second = self.hedge([1], policy=budget)
+    self.clock.advance(1)
+    self.assertEquals(3, len(self.attempts))
+    self.assertEquals(1, budget.rejected)
+    first.addErrback(lambda _: None)
+    second.addErrback(lambda _: None)
+    first.cancel()
+    second.cancel()
+
+
+  def testCancel(self):
+    """Test that cancelling the call cancels every attempt, including through inline callbacks."""
+    @inline.callbacks
+    def caller():
+      """Waits for a hedged call."""
+      yield self.hedge([1])
+
+    result = caller()
+    self.clock.advance(1)
+    result.addErrback(lambda _: None)
+    result.cancel()
+    self.assertEquals([0, 1], self.cancelled)
+    self.assertEquals([], self.clock.getDelayedCalls())
+    self.assertEquals((0, 2, 1, 0), (self.stats.inFlight, self.stats.inFlightHighWater, self.stats.abandoned,
+                                     self.stats.latency.count))
+
+
+  def testSynchronous(self):
+    """Test functions that answer straight away."""
+    result = hedge.hedge(lambda: 5, [1], clock=self.clock)
+    self.assertEquals(5, result.result)
+    self.assertEquals([], self.clock.getDelayedCalls())
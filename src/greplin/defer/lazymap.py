@@ -15,57 +15,314 @@
 """DeferredMap class."""
 
 
+from greplin.defer import base
+
 from twisted.internet import defer
+from twisted.python import failure
+
+from collections import deque, OrderedDict
+
+
+
+class _Load(object):
+  """A load of a single key that is in progress.
+
+  Most loads only ever have one observer, so observers is None, a single observer, or a list of two or more.
+  """
+
+  __slots__ = ('observers', 'deferred')
+
+
+  def __init__(self):
+    self.observers = None
+    self.deferred = None
+
+
+  def add(self, observer):
+    """Adds an observer."""
+    if self.observers is None:
+      self.observers = observer
+    elif isinstance(self.observers, list):
+      self.observers.append(observer)
+    else:
+      self.observers = [self.observers, observer]
+
+
+  def remove(self, observer):
+    """Removes an observer."""
+    if self.observers is observer:
+      self.observers = None
+    else:
+      self.observers.remove(observer)
+      if not self.observers:
+        self.observers = None
+
+
+  def fire(self, result):
+    """Calls back each observer with the given result."""
+    if isinstance(self.observers, list):
+      for observer in self.observers:
+        observer.callback(result)
+    elif self.observers is not None:
+      self.observers.callback(result)
+
+
+
+def _abandon(observer):
+  """Canceller for _Observer objects."""
+  observer.map._abandon(observer.key, observer) # pylint: disable=W0212
+
+
+
+class _Observer(base.LowMemoryDeferred):
+  """Deferred returned to a caller waiting for a key to load."""
+
+  __slots__ = ('map', 'key')
+
+
+  def __init__(self, deferredMap, key):
+    base.LowMemoryDeferred.__init__(self, _abandon)
+    self.map = deferredMap
+    self.key = key
+
+
+  def describeDeferred(self):
+    """Describes this Deferred."""
+    return 'DeferredMap(@%x)[%r]' % (id(self.map), self.key)
 
 
 
 class DeferredMap(dict):
-  """Calls the given function on each of the items added to the queue.  Each item can itself be deferred."""
+  """Calls the given function on each of the items added to the queue.  Each item can itself be deferred.
 
-  def __init__(self, fn):
+  If maxSize is given, loaded items beyond that many are evicted using the CLOCK approximation of least recently used.
+  Items that are still loading are never evicted.
+
+  If ttl is given, items expire that many seconds after they are loaded.  It may also be a function called with the key
+  and the loaded value that returns the number of seconds, or None for no expiry.  For maxStale seconds after an item
+  expires, reads keep returning the old value immediately while a single background load refreshes it.  Like ttl,
+  maxStale may be a function of the key and the loaded value.  Failures expire after failureTtl seconds if it is given,
+  otherwise after ttl seconds if it is a number, and are reloaded on the next read if ttl is a function.  They are
+  never served stale.  A failed background load keeps the old value, and waits failureTtl seconds before trying
+  again.  Note that "key in map" is true for expired items.
+
+  If batch is true, fn is instead called with a list of keys and should return a dict (or a deferred dict) mapping
+  each key to its value.  Keys that start loading within batchWindow seconds of each other, or in the same reactor
+  iteration by default, are loaded by a single call.  Keys missing from the result fail with KeyError.  No more than
+  maxBatchSize keys are passed to a single call.
+
+  Cancelling a deferred returned by the map stops it from waiting for the item.  Once every caller waiting for an item
+  has cancelled, the deferred returned by fn is cancelled too, unless cancelAbandonedLoads is false.  Batched loads
+  are only abandoned for keys that have not been passed to fn yet.
+  """
+
+  def __init__(self, fn, maxSize=None, ttl=None, maxStale=0, failureTtl=None, clock=None,
+               batch=False, batchWindow=0, maxBatchSize=None, cancelAbandonedLoads=True):
     dict.__init__(self)
     self.__fn = fn
-    self.__loading = {}
+    self.__loading = {} # Key -> _Load
+    self.__cancelAbandonedLoads = cancelAbandonedLoads
+    self.__maxSize = maxSize
+    self.__ring = deque() # Loaded keys in clock hand order.  May contain keys that have since been deleted.
+    self.__referenced = {} # Key -> whether it was used since the clock hand last passed it.
+    self.__ttl = ttl
+    self.__maxStale = maxStale
+    self.__failureTtl = failureTtl
+    self.__expiry = None # Key -> (time to refresh, time to stop serving the value) for items that expire.
+    if ttl is not None or failureTtl is not None:
+      self.__expiry = {}
+    self.__batch = OrderedDict() if batch else None # Keys waiting to be loaded, in the order they were requested.
+    self.__batchWindow = batchWindow
+    self.__maxBatchSize = maxBatchSize
+    self.__batchCall = None
+    if clock is None and (self.__expiry is not None or batch):
+      from twisted.internet import reactor
+      clock = reactor
+    self.__clock = clock
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.stale = 0
+
+
+  def getStats(self):
+    """Gets stats about hits / misses / evictions / stale reads."""
+    return {'hit': self.hits, 'miss': self.misses, 'eviction': self.evictions, 'stale': self.stale}
 
 
   def refresh(self, key):
     """Forces a refresh of the given item.  If it is currently loading or not loaded, this does nothing."""
     if key in self and not isinstance(dict.__getitem__(self, key), defer.Deferred):
-      dict.__delitem__(self, key)
+      self.__delitem__(key)
+
+
+  def getExpiry(self, key):
+    """Returns the time after which the given loaded item is no longer served, or None if it does not expire."""
+    if self.__expiry is None:
+      return None
+    expiry = self.__expiry.get(key)
+    return expiry and expiry[1]
 
 
   def __getitem__(self, key):
     """Override getitem to lazily load items.  Returns a deferred if the item is not ready, or the item otherwise."""
     if key in self:
+      if self.__expiry is not None and key in self.__expiry:
+        refreshAt, discardAt = self.__expiry[key]
+        now = self.__clock.seconds()
+        if now >= discardAt:
+          self.__delitem__(key)
+          return self.__load(key)
+        elif now >= refreshAt:
+          self.stale += 1
+          if key not in self.__loading:
+            load = self.__loading[key] = _Load()
+            self.__startLoad(key, load)
+
+      self.hits += 1
+      if self.__maxSize is not None:
+        self.__referenced[key] = True
       return dict.__getitem__(self, key)
 
-    isNewRequest = key not in self.__loading
+    return self.__load(key)
+
+
+  def __delitem__(self, key):
+    """Deletes an item."""
+    dict.__delitem__(self, key)
+    self.__forget(key)
+
+
+  def pop(self, key, *default):
+    """Removes an item and returns it, or returns default if it is given and the item is not in the map."""
+    if key not in self:
+      return dict.pop(self, key, *default)
+    value = dict.__getitem__(self, key)
+    self.__delitem__(key)
+    return value
+
+
+  def popitem(self):
+    """Removes and returns an arbitrary (key, item) pair."""
+    key, value = dict.popitem(self)
+    self.__forget(key)
+    return key, value
+
+
+  def clear(self):
+    """Removes every item."""
+    dict.clear(self)
+    if self.__expiry is not None:
+      self.__expiry.clear()
+
+
+  def __forget(self, key):
+    """Forgets when a deleted item expires, so that it can not expire a later value for the same key."""
+    if self.__expiry is not None:
+      self.__expiry.pop(key, None)
+
+
+  def __load(self, key):
+    """Returns a deferred for the result of loading the given key, starting the load if it is not already running."""
+    self.misses += 1
+    load = self.__loading.get(key)
+    isNewRequest = load is None
 
     if isNewRequest:
-      self.__loading[key] = []
+      load = self.__loading[key] = _Load()
 
-    result = defer.Deferred()
-    self.__loading[key].append(result)
+    result = _Observer(self, key)
+    load.add(result)
 
     if isNewRequest:
-      defer.maybeDeferred(self.__fn, key).addBoth(self.__gotResult, key)
+      self.__startLoad(key, load)
 
     return result
 
 
-  def __isActive(self, key):
-    """Checks if the given key is active."""
-    return self.__loading.get(key)
+  def _abandon(self, key, observer):
+    """Stops the given observer waiting for the key, cancelling the load if nobody else is waiting for it."""
+    load = self.__loading[key]
+    load.remove(observer)
+    if load.observers is None and self.__cancelAbandonedLoads:
+      del self.__loading[key]
+      if load.deferred is not None:
+        load.deferred.cancel()
+      elif self.__batch and key in self.__batch:
+        del self.__batch[key]
+        if not self.__batch and self.__batchCall:
+          self.__batchCall.cancel()
+          self.__batchCall = None
+
+
+  def __startLoad(self, key, load):
+    """Starts loading the given key."""
+    if self.__batch is None:
+      load.deferred = defer.maybeDeferred(self.__fn, key)
+      load.deferred.addBoth(self.__gotResult, key)
+      return
+
+    self.__batch[key] = None
+    if self.__maxBatchSize is not None and len(self.__batch) >= self.__maxBatchSize:
+      if self.__batchCall:
+        self.__batchCall.cancel()
+      self.__loadBatch()
+    elif not self.__batchCall:
+      self.__batchCall = self.__clock.callLater(self.__batchWindow, self.__loadBatch)
+
+
+  def __loadBatch(self):
+    """Loads all keys waiting to be loaded with a single call."""
+    keys = list(self.__batch)
+    self.__batch = OrderedDict()
+    self.__batchCall = None
+    if not keys:
+      return
+    defer.maybeDeferred(self.__fn, keys).addBoth(self.__gotBatch, keys)
+
+
+  def __gotBatch(self, results, keys):
+    """Handle the results of loading a batch of keys."""
+    if isinstance(results, failure.Failure):
+      for key in keys:
+        self.__gotResult(results, key)
+    else:
+      for key in keys:
+        if key in results:
+          self.__gotResult(results[key], key)
+        else:
+          self.__gotResult(failure.Failure(KeyError(key)), key)
 
 
   def __set(self, key, result):
     """Calls back the observers for the given key."""
     dict.__setitem__(self, key, result)
-    observers = self.__loading.get(key)
-    if observers:
-      del self.__loading[key]
-      for observer in observers:
-        observer.callback(result)
+    if self.__maxSize is not None:
+      self.__track(key)
+    if self.__expiry is not None:
+      self.__setExpiry(key, result)
+    load = self.__loading.pop(key, None)
+    if load is not None:
+      load.fire(result)
+
+
+  def __setExpiry(self, key, result):
+    """Records when the given newly set item expires."""
+    if isinstance(result, failure.Failure):
+      maxStale = 0
+      if self.__failureTtl is not None:
+        ttl = self.__failureTtl
+      else:
+        ttl = 0 if callable(self.__ttl) else self.__ttl
+    else:
+      ttl = self.__ttl(key, result) if callable(self.__ttl) else self.__ttl
+      maxStale = self.__maxStale(key, result) if callable(self.__maxStale) else self.__maxStale
+
+    if ttl is None:
+      self.__expiry.pop(key, None)
+    else:
+      refreshAt = self.__clock.seconds() + ttl
+      self.__expiry[key] = (refreshAt, refreshAt + maxStale)
 
 
   def __setitem__(self, key, value):
@@ -78,5 +335,134 @@ class DeferredMap(dict):
 
   def __gotResult(self, result, key):
     """Handle a result."""
-    if self.__isActive(key):
-      self.__set(key, result)
+    if key not in self.__loading:
+      return
+
+    if (isinstance(result, failure.Failure) and self.__loading[key].observers is None
+        and dict.__contains__(self, key)):
+      # A background refresh failed, so keep serving the stale value.
+      del self.__loading[key]
+      if self.__failureTtl is not None:
+        _, discardAt = self.__expiry[key]
+        self.__expiry[key] = (self.__clock.seconds() + self.__failureTtl, discardAt)
+      return
+
+    self.__set(key, result)
+
+
+  def __track(self, key):
+    """Adds the given key to the clock, evicting other keys if the map is too large."""
+    if key in self.__referenced:
+      self.__referenced[key] = True
+      return
+
+    self.__referenced[key] = False
+    self.__ring.append(key)
+    while len(self.__ring) > self.__maxSize:
+      self.__advanceClock()
+
+
+  def __advanceClock(self):
+    """Moves the clock hand past one key, evicting it if it has not been used since the hand last passed it."""
+    key = self.__ring.popleft()
+    if not dict.__contains__(self, key):
+      del self.__referenced[key]
+    elif self.__referenced[key]:
+      self.__referenced[key] = False
+      self.__ring.append(key)
+    else:
+      del self.__referenced[key]
+      self.__delitem__(key)
+      self.evictions += 1
+
+
+
+class ShardedDeferredMap(object):
+  """A DeferredMap split into several shards by key hash, for maps holding millions of items.
+
+  Each shard is a separate dict, so as the map grows only one small table is resized at a time rather than every item
+  being copied at once.  That keeps both peak memory and reactor pauses down.  Other arguments are passed to each
+  shard, with maxSize divided between them.  Batched loads are batched per shard.
+  """
+
+  def __init__(self, fn, shards=16, maxSize=None, **kw):
+    if maxSize is not None:
+      maxSize = max(1, maxSize // shards)
+    self.__shards = tuple(DeferredMap(fn, maxSize=maxSize, **kw) for _ in xrange(shards))
+
+
+  def shard(self, key):
+    """Returns the shard holding the given key."""
+    return self.__shards[hash(key) % len(self.__shards)]
+
+
+  def getStats(self):
+    """Gets stats about hits / misses / evictions / stale reads, summed over all shards."""
+    result = {}
+    for shard in self.__shards:
+      for name, value in shard.getStats().iteritems():
+        result[name] = result.get(name, 0) + value
+    return result
+
+
+  def refresh(self, key):
+    """Forces a refresh of the given item.  If it is currently loading or not loaded, this does nothing."""
+    self.shard(key).refresh(key)
+
+
+  def getExpiry(self, key):
+    """Returns the time after which the given loaded item is no longer served, or None if it does not expire."""
+    return self.shard(key).getExpiry(key)
+
+
+  def __getitem__(self, key):
+    """Returns a deferred if the item is not ready, or the item otherwise."""
+    return self.shard(key)[key]
+
+
+  def get(self, key, default=None):
+    """Returns the given item without loading it, or default if it is not in the map."""
+    return self.shard(key).get(key, default)
+
+
+  def pop(self, key, *default):
+    """Removes an item and returns it, or returns default if it is given and the item is not in the map."""
+    return self.shard(key).pop(key, *default)
+
+
+  def clear(self):
+    """Removes every item."""
+    for shard in self.__shards:
+      shard.clear()
+
+
+  def __setitem__(self, key, value):
+    """Proactively sets an item."""
+    self.shard(key)[key] = value
+
+
+  def __delitem__(self, key):
+    """Deletes an item."""
+    del self.shard(key)[key]
+
+
+  def __contains__(self, key):
+    """Checks if the given item is loaded."""
+    return key in self.shard(key)
+
+
+  def __len__(self):
+    """Returns the number of loaded items."""
+    return sum(len(shard) for shard in self.__shards)
+
+
+  def __iter__(self):
+    """Iterates over the loaded keys."""
+    for shard in self.__shards:
+      for key in shard:
+        yield key
+
+
+  def keys(self):
+    """Returns a list of the loaded keys."""
+    return list(self)
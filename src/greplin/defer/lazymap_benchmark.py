@@ -0,0 +1,84 @@
+# Copyright 2012 The greplin-twisted-utils Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Memory benchmark for DeferredMap and ShardedDeferredMap.
+
+Reports the peak memory growth per key while loading keys, and while keys are still loading.  Each case runs in a
+fresh process.  Run as:
+
+  python -m greplin.defer.lazymap_benchmark [count ...]
+"""
+
+from __future__ import absolute_import
+
+from greplin.defer import lazymap
+
+from twisted.internet import defer
+
+import resource
+import subprocess
+import sys
+import time
+
+
+LAYOUTS = {
+  'DeferredMap': lazymap.DeferredMap,
+  'ShardedDeferredMap': lazymap.ShardedDeferredMap,
+}
+
+
+
+def peakMemory():
+  """Returns the peak memory use of this process, in bytes."""
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure(layout, state, count):
+  """Measures a single case, printing the bytes per key and the seconds taken."""
+  if state == 'loaded':
+    m = LAYOUTS[layout](defer.succeed)
+    waiters = None
+  else:
+    # Keep the loads alive, as a real backend would.
+    loads = []
+    m = LAYOUTS[layout](lambda _: loads.append(defer.Deferred()) or loads[-1])
+    waiters = []
+
+  before = peakMemory()
+  start = time.time()
+  for key in xrange(count):
+    result = m[key]
+    if waiters is not None:
+      waiters.append(result)
+  print float(peakMemory() - before) / count, time.time() - start
+
+
+def main():
+  """Runs the benchmark."""
+  if sys.argv[1:2] == ['--case']:
+    measure(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+    return
+
+  counts = [int(arg) for arg in sys.argv[1:]] or [1000000, 10000000]
+  for count in counts:
+    for state in ('loaded', 'loading'):
+      for layout in sorted(LAYOUTS):
+        output = subprocess.check_output(
+            [sys.executable, '-m', 'greplin.defer.lazymap_benchmark', '--case', layout, state, str(count)])
+        bytesPerKey, seconds = output.split()
+        print '%9d keys %-8s %-19s %7.1f bytes/key %6.2fs' % (count, state, layout, float(bytesPerKey), float(seconds))
+
+
+if __name__ == '__main__':
+  main()
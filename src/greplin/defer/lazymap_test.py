@@ -14,9 +14,9 @@
 
 """Tests for the DeferredMap class."""
 
-from greplin.defer import lazymap
+from greplin.defer import base, lazymap
 
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.python import failure
 
 import unittest
@@ -168,3 +168,348 @@ class DeferredMapTest(unittest.TestCase):
     self.__results.pop().callback('hundo')
     self.assertTrue(result.called)
     self.assertEquals('hundo', result.result)
+
+
+  def testMaxSize(self):
+    """Test that least recently used items are evicted."""
+    self.__map = lazymap.DeferredMap(defer.succeed, maxSize=3)
+    for key in (1, 2, 3):
+      self.__map[key] # pylint: disable=W0104
+    self.assertEquals(1, self.__map[1])
+
+    self.__map[4] # pylint: disable=W0104
+    self.assertEquals([1, 3, 4], sorted(self.__map.keys()))
+
+    self.__map[5] # pylint: disable=W0104
+    self.assertEquals([4, 5], sorted(self.__map.keys())[-2:])
+    self.assertEquals(3, len(self.__map))
+    self.assertEquals({'hit': 1, 'miss': 5, 'eviction': 2, 'stale': 0}, self.__map.getStats())
+
+
+  def testMaxSizeKeepsLoading(self):
+    """Test that items still loading are not evicted."""
+    self.__map = lazymap.DeferredMap(self.getDeferred, maxSize=1)
+    first = self.getAndLog(10, '10A')
+    self.getAndLog(20, '20A')
+    self.__results[1].callback(200)
+    self.__results[0].callback(100)
+    self.assertTrue(first.called)
+    self.assertLog(('key', 10), ('key', 20), (200, '20A', 'success'), (100, '10A', 'success'))
+    self.assertEquals([10], self.__map.keys())
+    self.assertEquals(1, self.__map.evictions)
+
+
+  def testTtl(self):
+    """Test that items expire after their ttl."""
+    clock = task.Clock()
+    self.__map = lazymap.DeferredMap(self.getDeferred, ttl=10, clock=clock)
+    self.getAndLog(10, '10A')
+    self.__results[-1].callback(100)
+    self.assertLog(('key', 10), (100, '10A', 'success'))
+
+    clock.advance(9)
+    self.assertEquals(100, self.__map[10])
+
+    clock.advance(1)
+    self.getAndLog(10, '10B')
+    self.__results[-1].callback(101)
+    self.assertLog(('key', 10), (101, '10B', 'success'))
+    self.assertEquals(101, self.__map[10])
+
+
+  def testCallableTtl(self):
+    """Test per item ttls."""
+    clock = task.Clock()
+    self.__map = lazymap.DeferredMap(defer.succeed, ttl=lambda key, value: value, clock=clock)
+    self.__map[5] # pylint: disable=W0104
+    self.__map[10] # pylint: disable=W0104
+    clock.advance(7)
+    self.assertTrue(isinstance(self.__map[5], defer.Deferred)) # Expired, so reloaded.
+    self.assertEquals(10, self.__map[10])
+
+
+  def testCallableMaxStale(self):
+    """Test per item stale windows."""
+    clock = task.Clock()
+    self.__map = lazymap.DeferredMap(self.getDeferred, ttl=10, maxStale=lambda key, value: value, clock=clock)
+    self.__map[1] # pylint: disable=W0104
+    self.__map[5] # pylint: disable=W0104
+    self.__results[0].callback(1)
+    self.__results[1].callback(5)
+    self.assertLog(('key', 1), ('key', 5))
+
+    clock.advance(12)
+    self.assertTrue(isinstance(self.__map[1], defer.Deferred))
+    self.assertEquals(5, self.__map[5])
+    self.assertLog(('key', 1), ('key', 5))
+
+
+  def testGetExpiry(self):
+    """Test getting the time items stop being served."""
+    clock = task.Clock()
+    clock.advance(100)
+    self.__map = lazymap.DeferredMap(self.getDeferred, ttl=10, maxStale=5, clock=clock)
+    self.__map[1] # pylint: disable=W0104
+    self.assertEquals(None, self.__map.getExpiry(1))
+    self.__results[0].callback(1)
+    self.assertEquals(115, self.__map.getExpiry(1))
+    self.assertEquals(None, lazymap.DeferredMap(self.getDeferred).getExpiry(1))
+
+
+  def testStaleWhileRevalidate(self):
+    """Test that expired items are served while a single refresh runs."""
+    clock = task.Clock()
+    self.__map = lazymap.DeferredMap(self.getDeferred, ttl=10, maxStale=5, clock=clock)
+    self.getAndLog(10, '10A')
+    self.__results[-1].callback(100)
+    self.assertLog(('key', 10), (100, '10A', 'success'))
+
+    clock.advance(11)
+    self.assertEquals(100, self.__map[10])
+    self.assertEquals(100, self.__map[10])
+    self.assertLog(('key', 10))
+    self.assertEquals(2, self.__map.stale)
+
+    self.__results[-1].callback(101)
+    self.assertEquals(101, self.__map[10])
+
+    # Past the stale window, callers have to wait.
+    clock.advance(16)
+    self.getAndLog(10, '10B')
+    self.__results[-1].callback(102)
+    self.assertLog(('key', 10), (102, '10B', 'success'))
+
+
+  def testStaleRefreshFailure(self):
+    """Test that a failed background refresh keeps the stale value and backs off."""
+    clock = task.Clock()
+    self.__map = lazymap.DeferredMap(self.getDeferred, ttl=10, maxStale=60, failureTtl=5, clock=clock)
+    self.__map[10] # pylint: disable=W0104
+    self.__results[-1].callback(100)
+
+    clock.advance(10)
+    self.assertEquals(100, self.__map[10])
+    self.__results[-1].errback(TypeError("AN ERROR"))
+    self.assertEquals(100, self.__map[10])
+    self.assertEquals(2, len(self.__results))
+
+    clock.advance(5)
+    self.assertEquals(100, self.__map[10])
+    self.assertEquals(3, len(self.__results))
+
+
+  def testFailureTtl(self):
+    """Test negative caching of failures."""
+    clock = task.Clock()
+    self.__map = lazymap.DeferredMap(self.getDeferred, ttl=60, failureTtl=5, clock=clock)
+    self.getAndLog(10, '10A')
+    self.__results[-1].errback(TypeError("AN ERROR"))
+    self.assertLog(('key', 10), ("AN ERROR", '10A', 'error'))
+    self.assertTrue(isinstance(self.__map[10], failure.Failure))
+
+    clock.advance(5)
+    self.getAndLog(10, '10B')
+    self.__results[-1].callback(100)
+    self.assertLog(('key', 10), (100, '10B', 'success'))
+
+
+  def testFailureWithoutFailureTtl(self):
+    """Test that failures are never passed to a ttl function or served stale."""
+    clock = task.Clock()
+    ttls = []
+
+    def ttl(key, value):
+      """Records the values it is called with."""
+      ttls.append(value)
+      return 10
+
+    self.__map = lazymap.DeferredMap(self.getDeferred, ttl=ttl, maxStale=lambda key, value: 60, clock=clock)
+    self.getAndLog(10, '10A')
+    self.__results[-1].errback(TypeError("AN ERROR"))
+    self.assertLog(('key', 10), ("AN ERROR", '10A', 'error'))
+    self.assertEquals([], ttls)
+
+    self.getAndLog(10, '10B')
+    self.__results[-1].callback(100)
+    self.assertLog(('key', 10), (100, '10B', 'success'))
+    self.assertEquals([100], ttls)
+
+    self.__map = lazymap.DeferredMap(self.getDeferred, ttl=10, maxStale=60, clock=clock)
+    self.getAndLog(10, '10C')
+    self.__results[-1].errback(TypeError("AN ERROR"))
+    clock.advance(10)
+    self.getAndLog(10, '10D')
+    self.assertLog(('key', 10), ("AN ERROR", '10C', 'error'), ('key', 10))
+
+
+  def testPopAndClear(self):
+    """Test that removed items do not expire values loaded later."""
+    clock = task.Clock()
+    self.__map = lazymap.DeferredMap(defer.succeed, ttl=10, clock=clock)
+    self.__map[1] # pylint: disable=W0104
+    self.__map[2] # pylint: disable=W0104
+    self.assertEquals(1, self.__map.pop(1))
+    self.assertEquals(None, self.__map.getExpiry(1))
+    self.assertEquals('default', self.__map.pop(1, 'default'))
+    self.__map.clear()
+    self.assertEquals(None, self.__map.getExpiry(2))
+
+    clock.advance(5)
+    self.__map[2] = 20
+    clock.advance(6)
+    self.assertEquals(20, self.__map[2])
+
+
+  def getBatch(self, keys):
+    """Creates a new deferred for a batch of keys each time it is called."""
+    self.logAppend('keys', sorted(keys))
+    self.__results.append(defer.Deferred())
+    return self.__results[-1]
+
+
+  def testBatch(self):
+    """Test that loads started in the same reactor iteration are batched."""
+    clock = task.Clock()
+    self.__map = lazymap.DeferredMap(self.getBatch, batch=True, clock=clock)
+    self.getAndLog(10, '10A')
+    self.getAndLog(20, '20A')
+    self.getAndLog(10, '10B')
+    self.getAndLog(30, '30A')
+    self.assertLog()
+
+    clock.advance(0)
+    self.assertLog(('keys', [10, 20, 30]))
+    self.__results[-1].callback({10: 100, 20: 200})
+    self.assertLog(
+        (100, '10A', 'success'),
+        (100, '10B', 'success'),
+        (200, '20A', 'success'),
+        (30, '30A', 'error'))
+    self.assertEquals(200, self.__map[20])
+
+
+  def testBatchFailure(self):
+    """Test that a failed batch fails each key."""
+    clock = task.Clock()
+    self.__map = lazymap.DeferredMap(self.getBatch, batch=True, clock=clock)
+    self.getAndLog(10, '10A')
+    self.getAndLog(20, '20A')
+    clock.advance(0)
+    self.__results[-1].errback(TypeError("AN ERROR"))
+    self.assertLog(('keys', [10, 20]), ("AN ERROR", '10A', 'error'), ("AN ERROR", '20A', 'error'))
+
+
+  def testMaxBatchSize(self):
+    """Test that batches are split when they get too big."""
+    clock = task.Clock()
+    self.__map = lazymap.DeferredMap(self.getBatch, batch=True, batchWindow=1, maxBatchSize=2, clock=clock)
+    self.getAndLog(10, '10A')
+    self.getAndLog(20, '20A')
+    self.assertLog(('keys', [10, 20]))
+    self.getAndLog(30, '30A')
+    clock.advance(1)
+    self.assertLog(('keys', [30]))
+
+
+  def testCancel(self):
+    """Test that the load is cancelled when every caller cancels."""
+    first = self.getAndLog(10, '10A')
+    second = self.getAndLog(10, '10B')
+    load = self.__results[-1]
+    self.assertLog(('key', 10))
+
+    first.cancel()
+    self.assertFalse(load.called)
+    self.assertLog(('10A', 'error'))
+
+    second.cancel()
+    self.assertTrue(load.called)
+    self.assertLog(('10B', 'error'))
+
+    self.getAndLog(10, '10C')
+    self.__results[-1].callback(100)
+    self.assertLog(('key', 10), (100, '10C', 'success'))
+
+
+  def testCancelWithoutCancellingLoad(self):
+    """Test that cancelling callers can leave the load running."""
+    self.__map = lazymap.DeferredMap(self.getDeferred, cancelAbandonedLoads=False)
+    self.getAndLog(10, '10A').cancel()
+    self.assertFalse(self.__results[-1].called)
+    self.__results[-1].callback(100)
+    self.assertEquals(100, self.__map[10])
+
+
+  def testCancelBatch(self):
+    """Test that abandoned keys are removed from a pending batch."""
+    clock = task.Clock()
+    self.__map = lazymap.DeferredMap(self.getBatch, batch=True, clock=clock)
+    self.getAndLog(10, '10A')
+    self.getAndLog(20, '20A').cancel()
+    clock.advance(0)
+    self.assertLog(('20A', 'error'), ('keys', [10]))
+
+
+  def testCancelWholeBatch(self):
+    """Test that no load is made if every key in a batch is abandoned."""
+    clock = task.Clock()
+    self.__map = lazymap.DeferredMap(self.getBatch, batch=True, clock=clock)
+    self.getAndLog(10, '10A').cancel()
+    self.getAndLog(20, '20A').cancel()
+    self.assertEquals([], clock.getDelayedCalls())
+    clock.advance(0)
+    self.assertLog(('10A', 'error'), ('20A', 'error'))
+
+
+  def testDescription(self):
+    """Test the description of deferreds returned by the map."""
+    result = self.__map[10]
+    self.assertEqual('DeferredMap(@%x)[10]' % id(self.__map), base.describeDeferred(result).partition(' ')[2])
+
+
+
+class ShardedDeferredMapTest(unittest.TestCase):
+  """Tests for ShardedDeferredMap."""
+
+  def testBasics(self):
+    """Test basics of the sharded map."""
+    results = {}
+    m = lazymap.ShardedDeferredMap(lambda key: results.setdefault(key, defer.Deferred()), shards=4, maxSize=8)
+    pending = [m[key] for key in range(20)]
+    self.assertEquals(0, len(m))
+
+    for key in range(20):
+      results[key].callback(key * 10)
+    self.assertEquals(range(0, 200, 10), [d.result for d in pending])
+    self.assertEquals(8, len(m))
+    self.assertEquals(8, len(m.keys()))
+    self.assertEquals(12, m.getStats()['eviction'])
+
+    m[100] = 'hundo'
+    self.assertTrue(100 in m)
+    self.assertEquals('hundo', m[100])
+    del m[100]
+    self.assertFalse(100 in m)
+
+
+  def testDictMethods(self):
+    """Test the dict methods shared with DeferredMap."""
+    clock = task.Clock()
+    m = lazymap.ShardedDeferredMap(lambda key: key * 10, shards=4, ttl=5, clock=clock)
+    self.assertEquals(None, m.get(1))
+    self.assertEquals('x', m.get(1, 'x'))
+    self.assertEquals(10, m[1].result)
+    self.assertEquals(20, m[2].result)
+    self.assertEquals(10, m.get(1))
+    self.assertEquals(5, m.getExpiry(1))
+    self.assertEquals(None, m.getExpiry(3))
+
+    self.assertEquals(10, m.pop(1))
+    self.assertFalse(1 in m)
+    self.assertEquals(None, m.getExpiry(1))
+    self.assertEquals('x', m.pop(1, 'x'))
+    self.assertRaises(KeyError, m.pop, 1)
+
+    m.clear()
+    self.assertEquals(0, len(m))
+    self.assertEquals(None, m.getExpiry(2))
@@ -0,0 +1,369 @@
+# Copyright 2012 The greplin-twisted-utils Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Opt-in instrumentation for queues, semaphores, hedged calls and pipelines.
+
+Pass a QueueStats or SemaphoreStats object as the stats argument of a queue or semaphore to record its activity, or a
+HedgeStats object as the stats argument of hedge.hedge.  Pipelines keep StageStats for each stage.  Stats objects
+created with a name are added to REGISTRY, which can be served with metricsbrowser.MetricsResource.
+"""
+
+from __future__ import absolute_import
+
+import bisect
+import time
+import weakref
+
+
+DEFAULT_BOUNDS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+
+
+
+class Histogram(object):
+  """Histogram of durations with fixed bucket bounds.
+
+  counts[i] is the number of values v with bounds[i - 1] < v <= bounds[i].  The last count is for values larger
+  than every bound.
+  """
+
+  __slots__ = ('bounds', 'counts', 'count', 'total')
+
+
+  def __init__(self, bounds=DEFAULT_BOUNDS):
+    self.bounds = tuple(bounds)
+    self.counts = [0] * (len(self.bounds) + 1)
+    self.count = 0
+    self.total = 0.0
+
+
+  def add(self, value):
+    """Records a value."""
+    self.counts[bisect.bisect_left(self.bounds, value)] += 1
+    self.count += 1
+    self.total += value
+
+
+  def snapshot(self):
+    """Returns the contents of the histogram as a dict."""
+    return {
+      'bounds': list(self.bounds),
+      'counts': list(self.counts),
+      'count': self.count,
+      'total': self.total,
+    }
+
+
+
+class Registry(object):
+  """A set of named stats objects.
+
+  Only weak references are kept, so a stats object leaves the registry once the queue or semaphore using it, and
+  anything else referring to it, is gone.
+  """
+
+  def __init__(self):
+    self.__stats = weakref.WeakValueDictionary()
+
+
+  def register(self, name, stats):
+    """Adds the stats object under the given name, replacing any existing one."""
+    self.__stats[name] = stats
+
+
+  def unregister(self, name):
+    """Removes the stats object with the given name, if any."""
+    self.__stats.pop(name, None)
+
+
+  def get(self, name):
+    """Gets the stats object with the given name."""
+    return self.__stats[name]
+
+
+  def snapshot(self):
+    """Returns a dict mapping name to a snapshot of each registered stats object."""
+    return dict((name, stats.snapshot()) for name, stats in self.__stats.items())
+
+
+REGISTRY = Registry()
+
+
+
+class _Stats(object):
+  """Base class for stats objects."""
+
+  COUNTERS = ()
+
+  GAUGES = ('waiting', 'waitingHighWater')
+
+
+  def __init__(self, name, registry, timer):
+    self.name = name
+    self._timer = timer
+    for counter in self.COUNTERS + self.GAUGES:
+      setattr(self, counter, 0)
+    if name is not None:
+      registry.register(name, self)
+
+
+  def setWaiting(self, waiting):
+    """Records the number of callers waiting."""
+    self.waiting = waiting
+    if waiting > self.waitingHighWater:
+      self.waitingHighWater = waiting
+
+
+  def snapshot(self):
+    """Returns the current values as a dict."""
+    result = dict((counter, getattr(self, counter)) for counter in self.COUNTERS + self.GAUGES)
+    result.update(self._histograms())
+    return result
+
+
+  def _histograms(self):
+    """Returns a dict of histogram snapshots.  Stats objects without histograms have none."""
+    return {}
+
+
+
+class QueueStats(_Stats):
+  """Stats for a queue.
+
+  @ivar enqueued: Number of items added.
+  @ivar dequeued: Number of items removed.
+  @ivar dropped: Number of items removed by clearing the queue.
+  @ivar expired: Number of items dropped because their deadline passed.  These are not counted as dequeued.
+  @ivar size: Current number of items in the queue.
+  @ivar highWater: Largest number of items seen in the queue.
+  @ivar waiting: Current number of callers waiting for an item.
+  @ivar waitingHighWater: Largest number of callers seen waiting for an item.
+  @ivar latency: Histogram of seconds between an item being added and removed.
+  """
+
+  COUNTERS = ('enqueued', 'dequeued', 'dropped', 'expired', 'size', 'highWater')
+
+
+  def __init__(self, name=None, bounds=DEFAULT_BOUNDS, registry=REGISTRY, timer=time.time):
+    _Stats.__init__(self, name, registry, timer)
+    self.latency = Histogram(bounds)
+
+
+  def put(self, count, size):
+    """Records count items being added, leaving size items queued.  Returns the time they were added."""
+    self.enqueued += count
+    self.size = size
+    if size > self.highWater:
+      self.highWater = size
+    return self._timer()
+
+
+  def got(self, enqueuedAt, size):
+    """Records an item added at enqueuedAt being removed, leaving size items queued."""
+    self.dequeued += 1
+    self.size = size
+    self.latency.add(self._timer() - enqueuedAt)
+
+
+  def cleared(self, count):
+    """Records count items being dropped from the queue at once."""
+    self.dropped += count
+    self.size = 0
+
+
+  def expiredItems(self, count, size):
+    """Records count items being dropped because their deadline passed, leaving size items queued."""
+    self.expired += count
+    self.size = size
+
+
+  def _histograms(self):
+    """Returns a dict of histogram snapshots."""
+    return {'latency': self.latency.snapshot()}
+
+
+
+class HedgeStats(_Stats):
+  """Stats for calls made with hedge.hedge.
+
+  @ivar calls: Number of calls.
+  @ivar attempts: Number of attempts started, including the first attempt of each call.
+  @ivar hedges: Number of extra attempts started.
+  @ivar hedgeWins: Number of calls answered by an extra attempt.
+  @ivar failures: Number of calls that failed.
+  @ivar abandoned: Number of calls cancelled by the caller before getting an answer.
+  @ivar cancelled: Number of attempts cancelled because another attempt answered first or the call was cancelled.
+  @ivar inFlight: Current number of attempts in flight.
+  @ivar inFlightHighWater: Largest number of attempts seen in flight.
+  @ivar latency: Histogram of seconds between a call starting and it getting an answer.
+  """
+
+  COUNTERS = ('calls', 'attempts', 'hedges', 'hedgeWins', 'failures', 'abandoned', 'cancelled')
+
+  GAUGES = ('inFlight', 'inFlightHighWater')
+
+
+  def __init__(self, name=None, bounds=DEFAULT_BOUNDS, registry=REGISTRY, timer=time.time):
+    _Stats.__init__(self, name, registry, timer)
+    self.latency = Histogram(bounds)
+
+
+  def started(self):
+    """Records a call starting.  Returns the time it started."""
+    self.calls += 1
+    return self._timer()
+
+
+  def attempt(self, isHedge):
+    """Records an attempt starting."""
+    self.attempts += 1
+    if isHedge:
+      self.hedges += 1
+    self.setInFlight(self.inFlight + 1)
+
+
+  def attemptFinished(self, cancelled=False):
+    """Records an attempt finishing."""
+    self.setInFlight(self.inFlight - 1)
+    if cancelled:
+      self.cancelled += 1
+
+
+  def setInFlight(self, inFlight):
+    """Records the number of attempts in flight."""
+    self.inFlight = inFlight
+    if inFlight > self.inFlightHighWater:
+      self.inFlightHighWater = inFlight
+
+
+  def finished(self, startedAt, hedgeWon=False, failed=False, abandoned=False):
+    """Records the call that started at startedAt finishing.  Abandoned calls got no answer, so are not timed."""
+    if hedgeWon:
+      self.hedgeWins += 1
+    if failed:
+      self.failures += 1
+    if abandoned:
+      self.abandoned += 1
+    else:
+      self.latency.add(self._timer() - startedAt)
+
+
+  def hedgeRate(self):
+    """Returns the number of extra attempts per call."""
+    return float(self.hedges) / self.calls if self.calls else 0.0
+
+
+  def _histograms(self):
+    """Returns a dict of histogram snapshots."""
+    return {'latency': self.latency.snapshot()}
+
+
+
+class StageStats(_Stats):
+  """Stats for a pipeline stage.
+
+  @ivar received: Number of items taken from the previous stage.
+  @ivar emitted: Number of items passed to the next stage.  For batch stages, this counts batches.
+  @ivar busy: Histogram of seconds spent processing each item.
+  @ivar startedAt: Time the stage started, or None if it has not.
+  """
+
+  COUNTERS = ('received', 'emitted')
+
+
+  def __init__(self, name=None, bounds=DEFAULT_BOUNDS, registry=REGISTRY, timer=time.time):
+    _Stats.__init__(self, name, registry, timer)
+    self.busy = Histogram(bounds)
+    self.startedAt = None
+
+
+  def start(self):
+    """Records the stage starting."""
+    self.startedAt = self._timer()
+
+
+  def receive(self):
+    """Records an item being taken from the previous stage.  Returns the time it was taken."""
+    self.received += 1
+    return self._timer()
+
+
+  def emit(self, receivedAt=None):
+    """Records an item being passed on.  If receivedAt is given, records the time spent processing it."""
+    self.emitted += 1
+    if receivedAt is not None:
+      self.busy.add(self._timer() - receivedAt)
+
+
+  def throughput(self):
+    """Returns the number of items emitted per second since the stage started."""
+    if self.startedAt is None:
+      return 0.0
+    elapsed = self._timer() - self.startedAt
+    return float(self.emitted) / elapsed if elapsed > 0 else 0.0
+
+
+  def snapshot(self):
+    """Returns the current values as a dict."""
+    result = _Stats.snapshot(self)
+    result['throughput'] = self.throughput()
+    return result
+
+
+  def _histograms(self):
+    """Returns a dict of histogram snapshots."""
+    return {'busy': self.busy.snapshot()}
+
+
+
+class SemaphoreStats(_Stats):
+  """Stats for a semaphore.
+
+  @ivar acquired: Number of times the semaphore was acquired.
+  @ivar inUse: Current number of tokens held.
+  @ivar inUseHighWater: Largest number of tokens seen held at once.
+  @ivar waiting: Current number of callers waiting for a token.
+  @ivar waitingHighWater: Largest number of callers seen waiting for a token.
+  @ivar wait: Histogram of seconds between a token being requested and acquired.
+  """
+
+  COUNTERS = ('acquired', 'inUse', 'inUseHighWater')
+
+
+  def __init__(self, name=None, bounds=DEFAULT_BOUNDS, registry=REGISTRY, timer=time.time):
+    _Stats.__init__(self, name, registry, timer)
+    self.wait = Histogram(bounds)
+
+
+  def requested(self):
+    """Records a token being requested.  Returns the time it was requested."""
+    return self._timer()
+
+
+  def acquire(self, requestedAt, inUse):
+    """Records a token requested at requestedAt being acquired, leaving inUse tokens held."""
+    self.acquired += 1
+    self.setInUse(inUse)
+    self.wait.add(self._timer() - requestedAt)
+
+
+  def setInUse(self, inUse):
+    """Records the number of tokens held."""
+    self.inUse = inUse
+    if inUse > self.inUseHighWater:
+      self.inUseHighWater = inUse
+
+
+  def _histograms(self):
+    """Returns a dict of histogram snapshots."""
+    return {'wait': self.wait.snapshot()}
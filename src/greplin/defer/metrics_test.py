@@ -0,0 +1,208 @@
+# Copyright 2012 The greplin-twisted-utils Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for queue and semaphore metrics."""
+
+from greplin.defer import metrics, queue, semaphore
+
+from twisted.internet import task
+
+import gc
+import unittest
+
+
+
+class FakeTimer(object):
+  """Timer that only moves when told to."""
+
+  def __init__(self):
+    self.now = 1000.0
+
+
+  def __call__(self):
+    return self.now
+
+
+
+class HistogramTest(unittest.TestCase):
+  """Tests for Histogram."""
+
+  def testBuckets(self):
+    """Test values land in the right buckets."""
+    histogram = metrics.Histogram((1, 10))
+    for value in (0, 1, 2, 10, 11, 100):
+      histogram.add(value)
+    self.assertEquals({'bounds': [1, 10], 'counts': [2, 2, 2], 'count': 6, 'total': 124.0}, histogram.snapshot())
+
+
+
+class QueueStatsTest(unittest.TestCase):
+  """Tests for instrumented queues."""
+
+  def setUp(self):
+    """Sets up the test."""
+    self.registry = metrics.Registry()
+    self.timer = FakeTimer()
+    self.stats = metrics.QueueStats('q', bounds=(1, 10), registry=self.registry, timer=self.timer)
+
+
+  def testMaxSizeQueue(self):
+    """Test stats for a MaxSizeQueue."""
+    q = queue.MaxSizeQueue(5, stats=self.stats)
+    q.push(1, 2, 3)
+    self.timer.now += 5
+    q.push(4)
+    self.assertEquals(1, q.shift())
+    self.assertEquals([2, 3], q.shiftMany(2))
+    self.timer.now += 0.5
+    q.clear()
+
+    snapshot = self.registry.snapshot()['q']
+    self.assertEquals(4, snapshot['enqueued'])
+    self.assertEquals(3, snapshot['dequeued'])
+    self.assertEquals(1, snapshot['dropped'])
+    self.assertEquals(0, snapshot['size'])
+    self.assertEquals(4, snapshot['highWater'])
+    self.assertEquals([0, 3, 0], snapshot['latency']['counts'])
+
+
+  def testMaxSizeDeferredQueue(self):
+    """Test waiting callers are counted for a MaxSizeDeferredQueue."""
+    q = queue.MaxSizeDeferredQueue(5, backlog=2, stats=self.stats)
+    q.shift()
+    q.shift()
+    self.assertEquals(2, self.stats.waiting)
+    q.push(1)
+    self.assertEquals(1, self.stats.waiting)
+    self.assertEquals(2, self.stats.waitingHighWater)
+    self.assertEquals(1, self.stats.dequeued)
+
+
+  def testDeferredPriorityQueue(self):
+    """Test stats for a DeferredPriorityQueue."""
+    q = queue.DeferredPriorityQueue(sortKey=lambda e: e, stats=self.stats)
+    q.put(3)
+    q.put(1)
+    self.timer.now += 20
+    self.assertEquals(1, q.get().result)
+    self.assertEquals(3, q.get().result)
+    waiter = q.get()
+    self.assertEquals(1, self.stats.waiting)
+    q.put(5)
+    self.assertEquals(5, waiter.result)
+
+    self.assertEquals(0, self.stats.waiting)
+    self.assertEquals(3, self.stats.enqueued)
+    self.assertEquals(3, self.stats.dequeued)
+    self.assertEquals(2, self.stats.highWater)
+    self.assertEquals([1, 0, 2], self.stats.latency.counts)
+
+
+
+  def testUnhashableKeys(self):
+    """Test that put times survive a priority queue switching to unhashable sort keys."""
+    q = queue.DeferredPriorityQueue(sortKey=lambda e: e, stats=self.stats)
+    q.put(3)
+    self.timer.now += 20
+    q.put([1])
+    self.assertEquals(3, q.get().result)
+    self.assertEquals([1], q.get().result)
+    self.assertEquals(2, self.stats.dequeued)
+    self.assertEquals(20, self.stats.latency.total)
+
+
+  def testDeadlineQueueExpiry(self):
+    """Test that expired items are counted separately from items handed out."""
+    clock = task.Clock()
+    q = queue.DeferredDeadlineQueue(lambda e: e, clock=clock, stats=self.stats)
+    q.put(5)
+    q.put(50)
+    q.put(-1)
+    clock.advance(10)
+    self.timer.now += 20
+    self.assertEquals(50, q.get().result)
+
+    self.assertEquals(2, self.stats.enqueued)
+    self.assertEquals(1, self.stats.dequeued)
+    self.assertEquals(2, self.stats.expired)
+    self.assertEquals(1, self.stats.latency.count)
+    self.assertEquals(0, self.stats.size)
+
+
+
+class RegistryTest(unittest.TestCase):
+  """Tests for Registry."""
+
+  def testWeakReferences(self):
+    """Test that stats objects leave the registry when nothing else refers to them."""
+    registry = metrics.Registry()
+    stats = metrics.QueueStats('q', registry=registry)
+    q = queue.MaxSizeQueue(5, stats=stats)
+    del stats
+    self.assertEquals(['q'], registry.snapshot().keys())
+    del q
+    gc.collect()
+    self.assertEquals({}, registry.snapshot())
+
+
+  def testStatsWithoutHistograms(self):
+    """Test that stats objects without histograms can still be snapshotted."""
+    registry = metrics.Registry()
+    stats = metrics._Stats('plain', registry, None) # pylint: disable=W0212
+    self.assertEquals({'plain': {'waiting': 0, 'waitingHighWater': 0}}, registry.snapshot())
+    del stats
+
+
+
+class SemaphoreStatsTest(unittest.TestCase):
+  """Tests for instrumented semaphores."""
+
+  def testSemaphore(self):
+    """Test stats for a DeferredPrioritySemaphore."""
+    stats = metrics.SemaphoreStats(registry=metrics.Registry())
+    sem = semaphore.DeferredPrioritySemaphore(2, stats=stats)
+    sem.acquire()
+    sem.acquire()
+    sem.acquire()
+    self.assertEquals(2, stats.acquired)
+    self.assertEquals(1, stats.waiting)
+    sem.release()
+    self.assertEquals(3, stats.acquired)
+    self.assertEquals(0, stats.waiting)
+    sem.release()
+    sem.release()
+    self.assertEquals(0, stats.inUse)
+    self.assertEquals(2, stats.inUseHighWater)
+    self.assertEquals(1, stats.waitingHighWater)
+    self.assertEquals(3, stats.wait.count)
+
+
+  def testCancelledAcquire(self):
+    """Test that cancelled acquires stop being counted as waiting, and that the given timer is used."""
+    timer = FakeTimer()
+    stats = metrics.SemaphoreStats(registry=metrics.Registry(), timer=timer)
+    sem = semaphore.DeferredPrioritySemaphore(1, stats=stats)
+    sem.acquire()
+    cancelled = sem.acquire()
+    waiter = sem.acquire()
+    cancelled.addErrback(lambda _: None)
+    cancelled.cancel()
+    self.assertEquals(1, stats.waiting)
+    self.assertEquals(1, len(sem.waiting))
+
+    timer.now += 2
+    sem.release()
+    self.assertTrue(waiter.called)
+    self.assertEquals(0, stats.waiting)
+    self.assertEquals(2.0, stats.wait.total)
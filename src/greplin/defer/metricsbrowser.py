@@ -0,0 +1,47 @@
+# Copyright 2012 The greplin-twisted-utils Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Defines a Twisted Web resource for reporting queue and semaphore metrics."""
+
+
+from greplin.defer import metrics
+
+import json
+
+from twisted.web import resource
+
+
+
+class MetricsResource(resource.Resource):
+  """Twisted web resource that renders a metrics registry as JSON.
+
+  The "name" query argument may be repeated to restrict the output to the given stats objects.
+  """
+
+  isLeaf = True
+
+
+  def __init__(self, registry=metrics.REGISTRY):
+    resource.Resource.__init__(self)
+    self.__registry = registry
+
+
+  def render_GET(self, request):
+    """Renders a GET request by dumping the current snapshot of the registry."""
+    snapshot = self.__registry.snapshot()
+    if 'name' in request.args:
+      names = set(request.args['name'])
+      snapshot = dict((name, value) for name, value in snapshot.iteritems() if name in names)
+    request.setHeader('Content-Type', 'application/json')
+    return json.dumps(snapshot, sort_keys=True)
@@ -0,0 +1,213 @@
+# Copyright 2012 The greplin-twisted-utils Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Runs a function over many items with bounded concurrency."""
+
+from greplin.defer import inline
+
+from twisted.internet import defer
+from twisted.python import failure
+
+from collections import deque
+
+
+_NOTHING = object()
+
+
+
+def parallelMap(fn, iterable, concurrency, ordered=True, failFast=True):
+  """Calls fn on each item of iterable, with at most concurrency calls running at once.
+
+  Returns an iterator of deferreds, one per item, that fire with the results in the order of the items if ordered is
+  true, or in the order they finish otherwise.  Typical use from inline callbacks is:
+
+    for d in parallelMap(fn, items, 10):
+      result = yield d
+
+  Items are only taken from iterable as earlier results are used, so at most concurrency items are running or have
+  results waiting to be used at any time, however long iterable is.
+
+  If failFast is true, the first failure stops new calls, cancels running ones, and is the result of the next
+  deferred, after which the iterator stops.  Otherwise each failed call's deferred fails and the rest carry on.
+  """
+  return ParallelMap(fn, iterable, concurrency, ordered, failFast)
+
+
+
+@inline.callbacks
+def gather(fn, iterable, concurrency, ordered=True, failFast=True):
+  """Like parallelMap, but returns a deferred list of all the results.
+
+  If failFast is false, the list instead contains a (success, result) tuple for each item, like DeferredList.
+  """
+  results = []
+  for d in parallelMap(fn, iterable, concurrency, ordered, failFast):
+    if failFast:
+      results.append((yield d))
+    else:
+      try:
+        results.append((True, (yield d)))
+      except Exception: # pylint: disable=W0703
+        results.append((False, failure.Failure()))
+  defer.returnValue(results)
+
+
+
+class ParallelMap(object):
+  """Iterator of deferred results returned by parallelMap.  Cancelling any of its deferreds cancels the whole map."""
+
+  def __init__(self, fn, iterable, concurrency, ordered=True, failFast=True):
+    self.__fn = fn
+    self.__source = iter(iterable)
+    self.__lookahead = _NOTHING
+    self.__concurrency = concurrency
+    self.__ordered = ordered
+    self.__failFast = failFast
+    self.__running = {} # Index -> deferred for calls that have not finished.
+    self.__done = {} if ordered else deque() # Results that have not been used yet, by index if ordered.
+    self.__waiting = deque() # Deferreds returned by next that do not have a result yet.
+    self.__started = 0
+    self.__returned = 0
+    self.__nextResult = 0
+    self.__failure = None
+    self.__failureReturned = False
+    self.__stopped = False
+    self.__filling = False
+    self.__fill()
+
+
+  def __iter__(self):
+    return self
+
+
+  def next(self):
+    """Returns a deferred for the next result."""
+    if not self.__hasMore():
+      raise StopIteration
+    self.__returned += 1
+    d = defer.Deferred(lambda _: self.cancel())
+    self.__waiting.append(d)
+    self.__deliver()
+    self.__fill()
+    return d
+
+
+  def cancel(self):
+    """Stops starting calls, and cancels the running ones."""
+    self.__stopped = True
+    running = self.__running
+    self.__running = {}
+    for d in running.itervalues():
+      d.cancel()
+    waiting = self.__waiting
+    self.__waiting = deque()
+    for d in waiting:
+      if not d.called:
+        d.cancel()
+
+
+  def __peek(self):
+    """Returns whether the source has another item, reading it ahead if necessary."""
+    if self.__lookahead is _NOTHING:
+      try:
+        self.__lookahead = next(self.__source)
+      except StopIteration:
+        return False
+      except Exception: # pylint: disable=W0703
+        self.__fail(failure.Failure())
+        return False
+    return True
+
+
+  def __hasMore(self):
+    """Returns whether next has more deferreds to return."""
+    if not self.__stopped and (self.__returned < self.__started or self.__peek()):
+      return True
+    return self.__failure is not None and not self.__failureReturned
+
+
+  def __fill(self):
+    """Starts calls while there are free slots and items left."""
+    if self.__filling:
+      return # Calls that finish straight away are handled by the loop below instead of recursing.
+    self.__filling = True
+    try:
+      while not self.__stopped and len(self.__running) + len(self.__done) < self.__concurrency and self.__peek():
+        item = self.__lookahead
+        self.__lookahead = _NOTHING
+        index = self.__started
+        self.__started += 1
+        d = defer.maybeDeferred(self.__fn, item)
+        if not d.called:
+          self.__running[index] = d
+        d.addBoth(self.__finished, index)
+    finally:
+      self.__filling = False
+
+
+  def __finished(self, result, index):
+    """Handles the result of a call."""
+    self.__running.pop(index, None)
+    if self.__stopped:
+      return None # Swallow cancellation errors.
+
+    if isinstance(result, failure.Failure) and self.__failFast:
+      self.__fail(result)
+      return None
+
+    if self.__ordered:
+      self.__done[index] = result
+    else:
+      self.__done.append(result)
+    self.__deliver()
+    self.__fill()
+    return None
+
+
+  def __fail(self, err):
+    """Stops the map because of the given failure, passing it on to the next deferred."""
+    self.__failure = err
+    self.__stopped = True
+    self.__done.clear()
+    running = self.__running
+    self.__running = {}
+    for d in running.itervalues():
+      d.cancel()
+    self.__deliver()
+
+
+  def __deliver(self):
+    """Fires waiting deferreds with results that are ready."""
+    while self.__waiting:
+      if self.__failure is not None:
+        self.__failureReturned = True
+        waiting = self.__waiting
+        self.__waiting = deque()
+        for d in waiting:
+          d.errback(self.__failure)
+        return
+      if self.__ordered:
+        if self.__nextResult not in self.__done:
+          return
+        result = self.__done.pop(self.__nextResult)
+        self.__nextResult += 1
+      elif self.__done:
+        result = self.__done.popleft()
+      else:
+        return
+      d = self.__waiting.popleft()
+      if isinstance(result, failure.Failure):
+        d.errback(result)
+      else:
+        d.callback(result)
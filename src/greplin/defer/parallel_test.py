@@ -0,0 +1,132 @@
+# Copyright 2012 The greplin-twisted-utils Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for bounded concurrency maps."""
+
+from greplin.defer import inline, parallel
+
+from twisted.internet import defer
+
+import unittest
+
+
+
+class ParallelMapTest(unittest.TestCase):
+  """Tests for parallelMap and gather."""
+
+  def setUp(self):
+    self.calls = {}
+    self.pulled = []
+    self.cancelled = []
+
+
+  def call(self, item):
+    """Starts a call that is answered by firing self.calls[item]."""
+    d = self.calls[item] = defer.Deferred(lambda _: self.cancelled.append(item))
+    return d
+
+
+  def items(self, count):
+    """Generates items, recording which have been taken."""
+    for i in xrange(count):
+      self.pulled.append(i)
+      yield i
+
+
+  def testConcurrency(self):
+    """Test that items are only taken as slots free up."""
+    results = parallel.parallelMap(self.call, self.items(1000000), 2)
+    self.assertEquals([0, 1], self.pulled)
+    self.assertEquals([0, 1], sorted(self.calls))
+
+    first = results.next()
+    self.calls[1].callback('b')
+    self.assertFalse(first.called)
+    self.assertEquals([0, 1], sorted(self.calls))
+    self.calls[0].callback('a')
+    self.assertEquals('a', first.result)
+    self.assertEquals([0, 1, 2], sorted(self.calls))
+    self.assertEquals('b', results.next().result)
+    self.assertEquals([0, 1, 2, 3], sorted(self.calls))
+
+
+  def testUnordered(self):
+    """Test getting results in the order they finish."""
+    results = parallel.parallelMap(self.call, self.items(3), 3, ordered=False)
+    self.calls[2].callback('c')
+    self.calls[0].callback('a')
+    self.assertEquals('c', results.next().result)
+    self.assertEquals('a', results.next().result)
+    last = results.next()
+    self.calls[1].callback('b')
+    self.assertEquals('b', last.result)
+    self.assertRaises(StopIteration, results.next)
+
+
+  def testInlineCallbacks(self):
+    """Test consuming results from inline callbacks."""
+    log = []
+
+    @inline.callbacks
+    def consume():
+      """Consumes the results."""
+      for d in parallel.parallelMap(self.call, self.items(4), 2):
+        log.append((yield d))
+
+    done = consume()
+    for i in range(4):
+      self.calls[i].callback(i * 10)
+    self.assertEquals([0, 10, 20, 30], log)
+    self.assertTrue(done.called)
+
+
+  def testFailFast(self):
+    """Test that the first failure stops the map."""
+    results = parallel.parallelMap(self.call, self.items(10), 3)
+    self.calls[1].errback(ValueError())
+    self.assertEquals([0, 2], self.cancelled)
+    d = results.next()
+    self.assertTrue(d.result.check(ValueError))
+    d.addErrback(lambda _: None) # Consume the error.
+    self.assertRaises(StopIteration, results.next)
+    self.assertEquals(3, len(self.calls))
+
+
+  def testCollectErrors(self):
+    """Test that failures can be collected along with results."""
+    def call(item):
+      """Fails for odd items."""
+      if item % 2:
+        raise ValueError(item)
+      return item
+
+    results = parallel.gather(call, self.items(5), 2, failFast=False)
+    self.assertEquals([True, False, True, False, True], [success for success, _ in results])
+    self.assertEquals([0, 2, 4], [value for success, value in results if success])
+    self.assertTrue(results[1][1].check(ValueError))
+
+
+  def testGatherSynchronous(self):
+    """Test that many calls that finish straight away do not recurse."""
+    self.assertEquals(range(0, 20000, 2), parallel.gather(lambda x: x * 2, xrange(10000), 1000))
+
+
+  def testCancel(self):
+    """Test that cancelling a result cancels the map."""
+    results = parallel.parallelMap(self.call, self.items(10), 2)
+    d = results.next()
+    d.addErrback(lambda _: None)
+    d.cancel()
+    self.assertEquals([0, 1], sorted(self.cancelled))
+    self.assertRaises(StopIteration, results.next)
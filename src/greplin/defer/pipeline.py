@@ -0,0 +1,267 @@
+# Copyright 2012 The greplin-twisted-utils Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Streaming pipelines: stages connected by bounded queues, each running as soon as it has input.
+
+For example:
+
+  pipeline.Pipeline(readRows()).map(transform, concurrency=10).batch(100, timeout=1).sink(writeRows).run()
+
+Each stage takes items from a MaxSizeDeferredQueue and waits for space in the next one before passing items on, so a
+slow stage holds back the stages before it and memory stays bounded.  Stage functions may return deferreds, so they
+can be written with inline.callbacks.
+"""
+
+from greplin.defer import inline, metrics, queue
+
+from twisted.internet import defer
+from twisted.python import failure
+
+
+_END = object()
+
+
+
+def _firstOf(d, seconds, clock):
+  """Returns a deferred that fires with True when d fires, or with False after seconds if that is sooner.
+
+  Does not change the result of d, so it can still be waited for afterwards.
+  """
+  result = defer.Deferred()
+  timer = clock.callLater(max(seconds, 0), result.callback, False)
+
+  def fired(value):
+    """Stops the timer."""
+    if timer.active():
+      timer.cancel()
+      result.callback(True)
+    return value
+
+  d.addBoth(fired)
+  return result
+
+
+
+class _Stage(object):
+  """A stage of a pipeline."""
+
+  def __init__(self, kind, name, run, concurrency, stats):
+    self.kind = kind
+    self.name = name
+    self.run = run
+    self.concurrency = concurrency
+    self.stats = stats
+    self.active = 0
+
+
+
+class Pipeline(object):
+  """A source of items followed by stages that process them.
+
+  Items are passed between stages through queues holding at most bufferSize items.  If name is given, the stats of
+  each stage and queue are added to metrics.REGISTRY as name.stageName and name.stageName.queue.
+  """
+
+  def __init__(self, source, bufferSize=100, name=None, clock=None):
+    if clock is None:
+      from twisted.internet import reactor
+      clock = reactor
+    self.__source = source
+    self.__bufferSize = bufferSize
+    self.__name = name
+    self.__clock = clock
+    self.__stages = []
+    self.__workers = []
+    self.__result = None
+    self.__queues = None
+    self.__stopped = False
+    self.stats = {} # Stage name -> metrics.StageStats
+
+
+  def __addStage(self, kind, name, run, concurrency):
+    """Adds a stage."""
+    name = name or '%d.%s' % (len(self.__stages) + 1, kind)
+    stats = metrics.StageStats(self.__statsName(name), timer=self.__clock.seconds)
+    self.stats[name] = stats
+    self.__stages.append(_Stage(kind, name, run, concurrency, stats))
+    return self
+
+
+  def __statsName(self, name):
+    """Returns the registry name for the given stage name, or None if this pipeline is not registered."""
+    return self.__name and '%s.%s' % (self.__name, name)
+
+
+  def map(self, fn, concurrency=1, name=None):
+    """Adds a stage that passes on fn(item) for each item.  With concurrency above 1, results may be reordered."""
+    return self.__addStage('map', name, lambda stage, inq, outq: self.__mapWorker(stage, fn, inq, outq), concurrency)
+
+
+  def batch(self, size, timeout=None, name=None):
+    """Adds a stage that passes on lists of up to size items.
+
+    If timeout is given, a partial batch is passed on once timeout seconds have passed since its first item arrived.
+    """
+    return self.__addStage('batch', name, lambda stage, inq, outq: self.__batchWorker(stage, size, timeout, inq, outq),
+                           1)
+
+
+  def sink(self, fn, concurrency=1, name=None):
+    """Adds a final stage that calls fn on each item and discards the results."""
+    return self.__addStage('sink', name, lambda stage, inq, outq: self.__mapWorker(stage, fn, inq, None), concurrency)
+
+
+  def run(self):
+    """Starts the pipeline.  Returns a deferred that fires when every item has been through every stage.
+
+    If any stage fails, the whole pipeline is stopped and the deferred fails with that error.  Cancelling the deferred
+    also stops the pipeline.
+    """
+    if not self.__stages or self.__stages[-1].kind != 'sink':
+      self.sink(lambda _: None, name='discard')
+    self.__result = defer.Deferred(lambda _: self.__stop())
+
+    queues = []
+    for stage in self.__stages:
+      stats = None
+      if self.__name:
+        stats = metrics.QueueStats(self.__statsName(stage.name) + '.queue', timer=self.__clock.seconds)
+      queues.append(queue.MaxSizeDeferredQueue(self.__bufferSize, stage.concurrency, stats))
+
+    for index in reversed(range(len(self.__stages))):
+      stage = self.__stages[index]
+      stage.stats.start()
+      outq = queues[index + 1] if index + 1 < len(queues) else None
+      for _ in range(stage.concurrency):
+        stage.active += 1
+        self.__startWorker(stage.run, stage, queues[index], outq)
+    self.__queues = queues # Kept so that their stats stay registered while the pipeline is referenced.
+    self.__startWorker(self.__feed, queues[0])
+    return self.__result
+
+
+  def __startWorker(self, fn, *args):
+    """Starts a worker, stopping the pipeline if it fails."""
+    try:
+      d = fn(*args)
+    except: # pylint: disable=W0702
+      self.__failed(failure.Failure())
+      return
+    if isinstance(d, defer.Deferred):
+      self.__workers.append(d)
+      d.addErrback(self.__failed)
+
+
+  def __failed(self, err):
+    """Stops the pipeline because of the given error."""
+    if not self.__stopped:
+      self.__stop()
+      self.__result.errback(err)
+
+
+  def __stop(self):
+    """Stops every worker."""
+    self.__stopped = True
+    workers = self.__workers
+    self.__workers = []
+    for d in workers:
+      if not d.called:
+        d.cancel()
+
+
+  def __finishWorker(self, stage, inq, outq):
+    """Handles a worker reaching the end of its input."""
+    stage.active -= 1
+    if stage.active:
+      inq.push(_END) # Let the other workers of the stage see the end too.
+    elif outq is not None:
+      outq.push(_END)
+    elif not self.__result.called:
+      self.__result.callback(None)
+
+
+  @inline.callbacks
+  def __feed(self, outq):
+    """Passes the source items to the first stage."""
+    source = iter(self.__source)
+    while True:
+      yield outq.waitForSpace()
+      if self.__stopped:
+        return
+      try:
+        item = next(source)
+      except StopIteration:
+        break
+      outq.push(item)
+    outq.push(_END)
+
+
+  @inline.callbacks
+  def __mapWorker(self, stage, fn, inq, outq):
+    """Takes items from inq and passes fn(item) on to outq, if there is one."""
+    stats = stage.stats
+    while True:
+      item = yield inq.shift()
+      if self.__stopped:
+        return
+      if item is _END:
+        self.__finishWorker(stage, inq, outq)
+        return
+      receivedAt = stats.receive()
+      result = yield fn(item)
+      stats.emit(receivedAt)
+      if outq is not None:
+        yield outq.waitForSpace()
+        outq.push(result)
+
+
+  @inline.callbacks
+  def __emitBatch(self, stage, items, outq):
+    """Passes a batch on to outq once it has space."""
+    yield outq.waitForSpace()
+    stage.stats.emit()
+    outq.push(items)
+
+
+  @inline.callbacks
+  def __batchWorker(self, stage, size, timeout, inq, outq):
+    """Takes items from inq and passes them on to outq in lists."""
+    items = []
+    deadline = None
+    pending = None
+    while True:
+      if pending is None:
+        pending = inq.shift()
+      if items and timeout is not None and isinstance(pending, defer.Deferred) and not pending.called:
+        arrived = yield _firstOf(pending, deadline - self.__clock.seconds(), self.__clock)
+        if not arrived:
+          yield self.__emitBatch(stage, items, outq)
+          items = []
+          continue
+
+      item = yield pending
+      pending = None
+      if item is _END:
+        if items:
+          yield self.__emitBatch(stage, items, outq)
+        self.__finishWorker(stage, inq, outq)
+        return
+
+      stage.stats.receive()
+      if not items:
+        deadline = self.__clock.seconds() + (timeout or 0)
+      items.append(item)
+      if len(items) >= size:
+        yield self.__emitBatch(stage, items, outq)
+        items = []
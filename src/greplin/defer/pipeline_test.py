@@ -0,0 +1,146 @@
+# Copyright 2012 The greplin-twisted-utils Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for streaming pipelines."""
+
+from greplin.defer import inline, metrics, pipeline
+
+from twisted.internet import defer, task
+
+import unittest
+
+
+
+class PipelineTest(unittest.TestCase):
+  """Tests for Pipeline."""
+
+  def setUp(self):
+    self.clock = task.Clock()
+    self.pulled = []
+    self.output = []
+
+
+  def items(self, count):
+    """Generates items, recording which have been taken."""
+    for i in xrange(count):
+      self.pulled.append(i)
+      yield i
+
+
+  def testSynchronous(self):
+    """Test a pipeline of functions that return straight away."""
+    result = pipeline.Pipeline(self.items(10), clock=self.clock).map(lambda x: x * 2).batch(4) \
+        .sink(self.output.append).run()
+    self.assertTrue(result.called)
+    self.assertEquals([[0, 2, 4, 6], [8, 10, 12, 14], [16, 18]], self.output)
+
+
+  def testBackpressure(self):
+    """Test that a slow stage holds back the source."""
+    calls = []
+
+    def slow(item):
+      """Returns a deferred that is fired by the test."""
+      d = defer.Deferred()
+      calls.append((item, d))
+      return d
+
+    p = pipeline.Pipeline(self.items(1000), bufferSize=2, clock=self.clock).map(slow).sink(self.output.append)
+    result = p.run()
+    self.assertEquals(1, len(calls))
+    self.assertEquals(3, len(self.pulled)) # One being processed and two queued.
+
+    calls[0][1].callback('a')
+    self.assertEquals(['a'], self.output)
+    self.assertEquals(2, len(calls))
+    self.assertEquals(4, len(self.pulled))
+    self.assertFalse(result.called)
+    self.assertEquals(1, p.stats['1.map'].emitted)
+
+
+  def testConcurrency(self):
+    """Test running several copies of a stage at once."""
+    calls = []
+
+    @inline.callbacks
+    def slow(item):
+      """Waits for the test to fire a deferred."""
+      d = defer.Deferred()
+      calls.append(d)
+      yield d
+      defer.returnValue(item)
+
+    result = pipeline.Pipeline(self.items(5), clock=self.clock).map(slow, concurrency=3) \
+        .sink(self.output.append).run()
+    self.assertEquals(3, len(calls))
+    while not result.called:
+      calls.pop(0).callback(None)
+    self.assertEquals(range(5), sorted(self.output))
+
+
+  def testBatchTimeout(self):
+    """Test that partial batches are passed on after the timeout."""
+    source = defer.Deferred()
+
+    @inline.callbacks
+    def generate(item):
+      """Waits for the source deferred before passing items on, except for the first two."""
+      if item >= 2:
+        yield source
+      defer.returnValue(item)
+
+    result = pipeline.Pipeline(self.items(3), clock=self.clock).map(generate).batch(10, timeout=5) \
+        .sink(self.output.append).run()
+    self.clock.advance(4)
+    self.assertEquals([], self.output)
+    self.clock.advance(1)
+    self.assertEquals([[0, 1]], self.output)
+    source.callback(None)
+    self.assertEquals([[0, 1], [2]], self.output)
+    self.assertTrue(result.called)
+
+
+  def testFailure(self):
+    """Test that a failing stage stops the pipeline."""
+    waiting = defer.Deferred()
+
+    def fail(item):
+      """Waits on the second item and fails on the third."""
+      if item == 2:
+        raise ValueError()
+      return waiting if item == 1 else item
+
+    result = pipeline.Pipeline(self.items(100), bufferSize=5, clock=self.clock).map(fail, concurrency=2) \
+        .sink(self.output.append).run()
+    self.assertTrue(result.result.check(ValueError))
+    result.addErrback(lambda _: None) # Consume the error.
+    self.assertTrue(waiting.called) # Cancelled.
+    waiting.addErrback(lambda _: None)
+    self.assertTrue(len(self.pulled) < 100)
+
+
+  def testStats(self):
+    """Test per stage metrics."""
+    registry = metrics.REGISTRY
+    p = pipeline.Pipeline(self.items(6), name='testPipeline', clock=self.clock)
+    p.map(lambda x: x, name='copy').batch(3).run()
+    self.clock.advance(2)
+    self.assertEquals(6, p.stats['copy'].received)
+    self.assertEquals(2, p.stats['2.batch'].emitted)
+    self.assertEquals(1.0, p.stats['2.batch'].throughput())
+    self.assertEquals(7, registry.get('testPipeline.copy.queue').dequeued) # Including the end of the input.
+    self.assertEquals(2, registry.snapshot()['testPipeline.discard']['received'])
+    for name in registry.snapshot().keys():
+      if name.startswith('testPipeline.'):
+        registry.unregister(name)
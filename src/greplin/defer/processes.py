@@ -0,0 +1,402 @@
+# Copyright 2012 The greplin-twisted-utils Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Deferred classes for running work in other processes."""
+
+import bisect
+import cPickle
+import functools
+import itertools
+import mmap
+import multiprocessing
+import threading
+
+import Queue
+
+from twisted.internet import defer, reactor
+from twisted.python import failure
+
+
+
+class WorkerCrashedError(Exception):
+  """Raised for calls that were running in a worker process that died."""
+
+
+
+class RemoteError(Exception):
+  """Raised for calls whose error or result could not be sent back from the worker process."""
+
+
+
+class WrapperStoppedError(Exception):
+  """Raised for calls that had not been sent to a worker process when the wrapper was stopped."""
+
+
+
+class SharedBytes(object):
+  """Handle for bytes stored in a SharedMemory.  Only the handle is pickled when it is passed to a worker process."""
+
+  __slots__ = ('offset', 'length')
+
+  def __init__(self, offset, length):
+    self.offset = offset
+    self.length = length
+
+
+  def __getstate__(self):
+    return self.offset, self.length
+
+
+  def __setstate__(self, state):
+    self.offset, self.length = state
+
+
+
+class SharedMemory(object):
+  """Memory shared between a process and the worker processes it starts afterwards.
+
+  The parent process copies bytes in with store, and passes the returned handle to workers, which see a read-only
+  buffer over the same memory instead of a pickled copy.
+  """
+
+  def __init__(self, size):
+    self.size = size
+    self.map = mmap.mmap(-1, size)
+    self.__free = [(0, size)] # Sorted (offset, length) blocks that are not in use.
+
+
+  def store(self, data):
+    """Copies data in, returning a SharedBytes handle, or None if there is not enough room."""
+    length = len(data)
+    for index, (offset, free) in enumerate(self.__free):
+      if free >= length:
+        if free == length:
+          del self.__free[index]
+        else:
+          self.__free[index] = (offset + length, free - length)
+        self.map[offset:offset + length] = data
+        return SharedBytes(offset, length)
+    return None
+
+
+  def release(self, handle):
+    """Makes the memory used by the given handle available again."""
+    offset, length = handle.offset, handle.length
+    if not length:
+      return
+    index = bisect.bisect(self.__free, (offset, length))
+    if index < len(self.__free) and offset + length == self.__free[index][0]:
+      length += self.__free.pop(index)[1]
+    if index and self.__free[index - 1][0] + self.__free[index - 1][1] == offset:
+      index -= 1
+      offset, previous = self.__free.pop(index)
+      length += previous
+    self.__free.insert(index, (offset, length))
+
+
+  def available(self):
+    """Returns the number of bytes not in use."""
+    return sum(length for _, length in self.__free)
+
+
+  def view(self, handle):
+    """Returns a read-only buffer over the bytes for the given handle."""
+    return buffer(self.map, handle.offset, handle.length)
+
+
+
+def _resolve(value, memory):
+  """Replaces a SharedBytes handle with a buffer over its bytes."""
+  return memory.view(value) if isinstance(value, SharedBytes) else value
+
+
+
+def _handles(call):
+  """Returns the SharedBytes handles in the arguments of a call."""
+  _, args, kw = call[:3]
+  return [value for value in itertools.chain(args, kw.itervalues()) if isinstance(value, SharedBytes)]
+
+
+
+def _picklable(result):
+  """Returns the given (success, value) result, or a RemoteError result if it cannot be pickled."""
+  try:
+    cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL)
+    return result
+  except Exception: # pylint: disable=W0703
+    return False, RemoteError(repr(result[1]))
+
+
+
+def _serve(conn, inherited, fn, args, kw, memory):
+  """Runs in a worker process: builds the target, then runs batches of calls until told to stop.
+
+  inherited is the parent's ends of the pipes to this and the other workers.  They are closed so that this worker sees
+  the end of its pipe, and exits, if the parent process dies.
+  """
+  for other in inherited:
+    other.close()
+  target = fn(*args, **kw)
+  while True:
+    try:
+      message = conn.recv()
+    except (EOFError, IOError):
+      return
+    if message is None:
+      return
+    batchId, calls = message
+    results = []
+    for name, callArgs, callKw in calls:
+      if memory is not None:
+        callArgs = [_resolve(value, memory) for value in callArgs]
+        callKw = dict((key, _resolve(value, memory)) for key, value in callKw.iteritems())
+      try:
+        results.append((True, getattr(target, name)(*callArgs, **callKw)))
+      except Exception as e: # Errors are passed back to the caller. # pylint: disable=W0703
+        results.append((False, e))
+    try:
+      conn.send((batchId, results))
+    except Exception: # pylint: disable=W0703
+      conn.send((batchId, [_picklable(result) for result in results]))
+
+
+
+class _Worker(object):
+  """A worker process and the calls it has been given."""
+
+  def __init__(self, fn, args, kw, memory, siblings):
+    parentConn, childConn = multiprocessing.Pipe()
+    inherited = [parentConn] + [sibling.conn for sibling in siblings]
+    self.process = multiprocessing.Process(target=_serve, args=(childConn, inherited, fn, args, kw, memory))
+    self.process.daemon = True
+    self.process.start()
+    childConn.close()
+    self.conn = parentConn
+    self.alive = True
+    self.outstanding = 0
+    self.pending = [] # (name, args, kw, deferred) for calls that have not been sent yet.
+    self.batches = {} # Batch id -> (calls, queue for blocking calls or None) for batches that have been sent.
+
+
+  def stop(self):
+    """Tells the process to exit, and waits for it to finish."""
+    if self.alive:
+      self.alive = False
+      try:
+        self.conn.send(None)
+      except IOError:
+        pass # Already gone.
+    self.process.join()
+    self.conn.close()
+
+
+
+class ProcessWrapper(object):
+  """Object that wraps access to another object inside a pool of worker processes.
+
+  fn(*args, **kw) is called once in each worker process to build its copy of the object, so fn and the arguments must
+  be picklable, as must the arguments and results of every call.  Methods are called as for threads.ThreadWrapper: as
+  originally named for blocking access, or as "asyncDoSlowWork" for a deferred.  Unlike ThreadWrapper, every name is
+  treated as a method: non-callable attributes of the object cannot be read through the wrapper.  Names that start and
+  end with double underscores raise AttributeError instead of being sent to the workers.
+
+  Async calls go to the worker with the fewest calls running.  They are queued and sent together at the end of the
+  current reactor iteration, or as soon as maxBatchSize calls are waiting for one worker.  A blocking call takes any
+  queued calls for its worker with it.  If a worker process dies the calls sent to it fail with WorkerCrashedError, and it
+  is restarted when it is next given work.  Calls queued for it but not yet sent go to the new process.
+
+  @ivar restarts: The number of times a worker process has been restarted.
+  """
+
+  memory = None
+
+
+  def __init__(self, processes, maxBatchSize, fn, *args, **kw):
+    self.__maxBatchSize = maxBatchSize
+    self.__factory = (fn, args, kw)
+    self.__batchIds = itertools.count()
+    self.__flushCall = None
+    self.__workers = []
+    for _ in range(processes):
+      self.__workers.append(self.__startWorker())
+    self.restarts = 0
+
+
+  def __startWorker(self):
+    """Starts a worker process, and a thread that reads its results."""
+    fn, args, kw = self.__factory
+    worker = _Worker(fn, args, kw, self.memory, [other for other in self.__workers if not other.conn.closed])
+    reader = threading.Thread(target=self.__read, args=(worker,), name='ProcessWrapper-%d' % worker.process.pid)
+    reader.daemon = True
+    reader.start()
+    return worker
+
+
+  def __getattr__(self, item):
+    if item.startswith('__') and item.endswith('__'):
+      raise AttributeError(item)
+    if item.startswith('async'):
+      return functools.partial(self.__callAsync, item[5].lower() + item[6:])
+    else:
+      return functools.partial(self.__callBlocking, item)
+
+
+  def __choose(self):
+    """Returns the live worker with the fewest calls, restarting a dead one if it has fewer."""
+    index = min(range(len(self.__workers)), key=lambda i: self.__workers[i].outstanding)
+    worker = self.__workers[index]
+    if not worker.alive:
+      worker.stop()
+      replacement = self.__workers[index] = self.__startWorker()
+      # Queued calls were never sent to the dead worker, so its replacement can run them.
+      replacement.pending = worker.pending
+      replacement.outstanding = len(worker.pending)
+      worker.pending = []
+      worker = replacement
+      self.restarts += 1
+    return worker
+
+
+  def __callAsync(self, name, *args, **kw):
+    """Queues a call, returning a deferred for its result."""
+    worker = self.__choose()
+    d = defer.Deferred()
+    worker.outstanding += 1
+    worker.pending.append((name, args, kw, d))
+    if len(worker.pending) >= self.__maxBatchSize:
+      self.__send(worker, None)
+    elif self.__flushCall is None:
+      self.__flushCall = reactor.callLater(0, self.flushBatches)
+    return d
+
+
+  def __callBlocking(self, name, *args, **kw):
+    """Sends any queued calls for a worker along with the given one, blocking until they return."""
+    worker = self.__choose()
+    worker.outstanding += 1
+    worker.pending.append((name, args, kw, None))
+    queue = Queue.Queue()
+    calls = self.__send(worker, queue)
+    result = self.__finished(worker, queue.get(), calls)
+    if isinstance(result, failure.Failure):
+      result.raiseException()
+    return result
+
+
+  def flushBatches(self):
+    """Sends any queued calls to the worker processes now."""
+    if self.__flushCall is not None:
+      if self.__flushCall.active():
+        self.__flushCall.cancel()
+      self.__flushCall = None
+    for worker in self.__workers:
+      if worker.pending:
+        self.__send(worker, None)
+
+
+  def __send(self, worker, queue):
+    """Sends a worker its queued calls, returning them.  Results are put on queue if one is given."""
+    calls = worker.pending
+    worker.pending = []
+    batchId = self.__batchIds.next()
+    worker.batches[batchId] = (calls, queue)
+    try:
+      worker.conn.send((batchId, [(name, args, kw) for name, args, kw, _ in calls]))
+    except Exception: # pylint: disable=W0703
+      if worker.batches.pop(batchId, None):
+        results = [(False, failure.Failure())] * len(calls)
+        if queue is not None:
+          queue.put(results)
+        else:
+          self.__finished(worker, results, calls)
+    return calls
+
+
+  def __read(self, worker):
+    """Runs in a thread, passing results from a worker back to the reactor thread."""
+    while True:
+      try:
+        batchId, results = worker.conn.recv()
+      except (EOFError, IOError):
+        break
+      self.__deliver(worker, batchId, results)
+
+    worker.alive = False
+    batches = worker.batches
+    worker.batches = {}
+    for batchId, (calls, _) in batches.items():
+      self.__deliver(worker, batchId, [(False, WorkerCrashedError(worker.process.pid))] * len(calls), batches)
+
+
+  def __deliver(self, worker, batchId, results, batches=None):
+    """Passes the results of a batch to whoever is waiting for them.  Called from the reader thread."""
+    calls, queue = (worker.batches if batches is None else batches).pop(batchId)
+    if queue is not None:
+      queue.put(results)
+    else:
+      reactor.callFromThread(self.__finished, worker, results, calls)
+
+
+  def __finished(self, worker, results, calls):
+    """Fires the deferreds for a batch, returning the result of the blocking call if there is one."""
+    worker.outstanding -= len(results)
+    if self.memory is not None:
+      for call in calls:
+        for handle in _handles(call):
+          self.memory.release(handle)
+    last = None
+    for index, (success, value) in enumerate(results):
+      if not success and not isinstance(value, failure.Failure):
+        value = failure.Failure(value)
+      d = calls[index][3]
+      if d is None:
+        last = value
+      elif isinstance(value, failure.Failure):
+        d.errback(value)
+      else:
+        d.callback(value)
+    return last
+
+
+  def stop(self):
+    """Stops the worker processes.  Calls that are still queued fail with WrapperStoppedError."""
+    if self.__flushCall is not None:
+      if self.__flushCall.active():
+        self.__flushCall.cancel()
+      self.__flushCall = None
+    for worker in self.__workers:
+      calls = worker.pending
+      worker.pending = []
+      if calls:
+        self.__finished(worker, [(False, WrapperStoppedError())] * len(calls), calls)
+      worker.stop()
+
+
+
+class SharedMemoryProcessWrapper(ProcessWrapper):
+  """ProcessWrapper that can pass large byte strings to its workers through shared memory instead of pickling them.
+
+  Call share(data) and pass the handle it returns as an argument in place of data.  The worker receives a read-only
+  buffer over the shared copy, so only the handle's offset and length are pickled.  The memory is released when the
+  call finishes, so each handle should only be passed to one call.
+  """
+
+  def __init__(self, processes, maxBatchSize, sharedMemorySize, fn, *args, **kw):
+    self.memory = SharedMemory(sharedMemorySize) # Must exist before the workers are started.
+    ProcessWrapper.__init__(self, processes, maxBatchSize, fn, *args, **kw)
+
+
+  def share(self, data):
+    """Returns a handle to pass to a call instead of data, or data itself if there is not enough shared memory free."""
+    return self.memory.store(data) or data
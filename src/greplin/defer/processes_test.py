@@ -0,0 +1,231 @@
+# Copyright 2012 The greplin-twisted-utils Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for process wrappers."""
+
+from __future__ import absolute_import
+
+from greplin.defer import processes
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+import hashlib
+import os
+import signal
+import time
+
+
+
+class Calculator(object):
+  """Object to run in worker processes."""
+
+  def __init__(self, base):
+    self.base = base
+    self.calls = 0
+
+
+  def add(self, x):
+    """Adds to the base number, returning the result and the number of calls made so far."""
+    self.calls += 1
+    return self.base + x, self.calls
+
+
+  def digest(self, data):
+    """Returns the type, length and hash of the given data."""
+    return type(data).__name__, len(data), hashlib.md5(data).hexdigest()
+
+
+  def pid(self):
+    """Returns the process id."""
+    return os.getpid()
+
+
+  def fail(self):
+    """Raises an error."""
+    raise ValueError('bad')
+
+
+  def unpicklable(self):
+    """Returns something that can't be sent back."""
+    return lambda: None
+
+
+  def crash(self):
+    """Kills the process."""
+    os._exit(1) # pylint: disable=W0212
+
+
+
+class ProcessWrapperTest(unittest.TestCase):
+  """Tests for ProcessWrapper."""
+
+  def setUp(self):
+    self.wrapper = processes.ProcessWrapper(1, 10, Calculator, 100)
+
+
+  def tearDown(self):
+    self.wrapper.stop()
+
+
+  def testBlocking(self):
+    """Test blocking calls, which keep their target between calls."""
+    self.assertEquals((101, 1), self.wrapper.add(1))
+    self.assertEquals((102, 2), self.wrapper.add(2))
+    self.assertNotEquals(os.getpid(), self.wrapper.pid())
+
+
+  def testBlockingCallTakesQueuedCalls(self):
+    """Test that queued calls are sent with the next blocking call."""
+    first = self.wrapper.asyncAdd(1)
+    second = self.wrapper.asyncAdd(2)
+    self.assertFalse(first.called)
+    self.assertEquals((103, 3), self.wrapper.add(3))
+    self.assertEquals((101, 1), first.result)
+    self.assertEquals((102, 2), second.result)
+
+
+  def testErrors(self):
+    """Test that errors are passed back to the caller."""
+    failed = self.wrapper.asyncFail()
+    self.assertRaises(processes.RemoteError, self.wrapper.unpicklable)
+    self.assertTrue(failed.result.check(ValueError))
+    failed.addErrback(lambda _: None) # Consume the error.
+    self.assertRaises(ValueError, self.wrapper.fail)
+
+
+  def testSpecialNames(self):
+    """Test that special method lookups are not sent to the workers."""
+    self.assertFalse(hasattr(self.wrapper, '__getstate__'))
+    self.assertRaises(AttributeError, getattr, self.wrapper, '__getnewargs__')
+
+
+  def testRestart(self):
+    """Test that crashed workers fail their calls and are restarted."""
+    pid = self.wrapper.pid()
+    self.assertRaises(processes.WorkerCrashedError, self.wrapper.crash)
+    self.assertEquals((101, 1), self.wrapper.add(1))
+    self.assertNotEquals(pid, self.wrapper.pid())
+    self.assertEquals(1, self.wrapper.restarts)
+
+
+
+class ProcessWrapperAsyncTest(unittest.TestCase):
+  """Tests for async calls to ProcessWrapper, which need the reactor to deliver results."""
+
+  def setUp(self):
+    self.wrapper = processes.ProcessWrapper(1, 2, Calculator, 100)
+
+
+  def tearDown(self):
+    self.wrapper.stop()
+
+
+  def testAsync(self):
+    """Test that async calls are sent in batches, immediately once a batch is full and otherwise on the next turn."""
+    calls = [self.wrapper.asyncAdd(i) for i in range(3)]
+    return defer.gatherResults(calls).addCallback(self.assertEquals, [(100, 1), (101, 2), (102, 3)])
+
+
+  def testFlush(self):
+    """Test sending queued calls explicitly."""
+    d = self.wrapper.asyncAdd(1)
+    self.wrapper.flushBatches()
+    return d.addCallback(self.assertEquals, (101, 1))
+
+
+  @defer.inlineCallbacks
+  def testCrashDuringAsyncCall(self):
+    """Test that every call in the batch of a crashed worker fails, and that the worker is restarted."""
+    crash = self.wrapper.asyncCrash()
+    add = self.wrapper.asyncAdd(1)
+    yield self.assertFailure(crash, processes.WorkerCrashedError)
+    yield self.assertFailure(add, processes.WorkerCrashedError)
+    result = yield self.wrapper.asyncAdd(2)
+    self.assertEquals((102, 1), result)
+    self.assertEquals(1, self.wrapper.restarts)
+
+
+  @defer.inlineCallbacks
+  def testKilledWithQueuedCalls(self):
+    """Test that calls queued for a worker that is killed are run by its replacement."""
+    worker = self.wrapper._ProcessWrapper__workers[0] # pylint: disable=W0212
+    first = self.wrapper.asyncAdd(1)
+    os.kill(worker.process.pid, signal.SIGKILL)
+    while worker.alive: # Wait without running the reactor, so the queued call is not sent to the dead worker.
+      time.sleep(0.01)
+    second = self.wrapper.asyncAdd(2)
+    self.wrapper.flushBatches()
+    results = yield defer.gatherResults([first, second])
+    self.assertEquals([(101, 1), (102, 2)], results)
+    self.assertEquals(1, self.wrapper.restarts)
+
+
+  def testStopFailsQueuedCalls(self):
+    """Test that calls that have not been sent fail when the wrapper is stopped."""
+    d = self.wrapper.asyncAdd(1)
+    self.wrapper.stop()
+    return self.assertFailure(d, processes.WrapperStoppedError)
+
+
+
+class SharedMemoryTest(unittest.TestCase):
+  """Tests for SharedMemory."""
+
+  def testStoreAndRelease(self):
+    """Test that released memory is reused, and neighbouring free blocks are merged."""
+    memory = processes.SharedMemory(10)
+    first = memory.store('abcd')
+    second = memory.store('efg')
+    self.assertEquals('efg', str(memory.view(second)))
+    self.assertEquals(None, memory.store('hijk'))
+
+    memory.release(first)
+    self.assertEquals(7, memory.available())
+    third = memory.store('xy')
+    self.assertEquals(0, third.offset)
+    memory.release(second)
+    memory.release(third)
+    self.assertEquals(10, memory.available())
+    self.assertEquals(0, memory.store('0123456789').offset)
+
+
+
+class SharedMemoryProcessWrapperTest(unittest.TestCase):
+  """Tests for SharedMemoryProcessWrapper."""
+
+  def setUp(self):
+    self.wrapper = processes.SharedMemoryProcessWrapper(2, 10, 1 << 20, Calculator, 0)
+
+
+  def tearDown(self):
+    self.wrapper.stop()
+
+
+  def testShare(self):
+    """Test passing bytes through shared memory."""
+    data = os.urandom(600 << 10)
+    handle = self.wrapper.share(data)
+    self.assertTrue(isinstance(handle, processes.SharedBytes))
+    self.assertEquals(('buffer', len(data), hashlib.md5(data).hexdigest()), self.wrapper.digest(handle))
+    self.assertEquals(1 << 20, self.wrapper.memory.available())
+
+
+  def testFull(self):
+    """Test that data is passed as is when there is not enough shared memory."""
+    first = self.wrapper.share('a' * (600 << 10))
+    second = self.wrapper.share('b' * (600 << 10))
+    self.assertTrue(isinstance(first, processes.SharedBytes))
+    self.assertEquals('str', self.wrapper.digest(second)[0])
+    self.assertEquals('buffer', self.wrapper.digest(first)[0])
@@ -22,16 +22,22 @@ from greplin.defer import event
 from twisted.internet import defer
 
 import heapq
+import itertools
 
 
 
 class MaxSizeQueue(object):
-  """A queue with a maximum size.  When full, puts return a deferred that should be waited on before adding more."""
+  """A queue with a maximum size.  When full, puts return a deferred that should be waited on before adding more.
 
-  def __init__(self, maxSize):
+  If a metrics.QueueStats object is given, the queue's activity is recorded in it.
+  """
+
+  def __init__(self, maxSize, stats=None):
     self.__maxSize = maxSize
     self.__queue = deque()
     self.__queueTooFullEvent = None
+    self.__stats = stats
+    self.__times = deque() if stats else None
 
 
   def _waitForSpace(self):
@@ -58,6 +64,9 @@ class MaxSizeQueue(object):
 
   def clear(self):
     """Clears the queue."""
+    if self.__stats:
+      self.__stats.cleared(len(self.__queue))
+      self.__times.clear()
     self.__queue.clear()
     self.__checkIfNoLongerFull()
 
@@ -65,6 +74,8 @@ class MaxSizeQueue(object):
   def push(self, *items):
     """Push the following items asynchronously.  Will defer if the queue is particularly full."""
     self.__queue.extend(items)
+    if self.__stats:
+      self.__times.extend([self.__stats.put(len(items), len(self.__queue))] * len(items))
     if self.isFull():
       return self._waitForSpace()
     else:
@@ -79,6 +90,8 @@ class MaxSizeQueue(object):
   def shift(self):
     """Pop an item and return it.  This may also callback the queue too full defer."""
     result = self.__queue.popleft()
+    if self.__stats:
+      self.__stats.got(self.__times.popleft(), len(self.__queue))
     self.__checkIfNoLongerFull()
     return result
 
@@ -90,6 +103,10 @@ class MaxSizeQueue(object):
     else:
       result = tuple(self.__queue)
       self.__queue.clear()
+    if self.__stats:
+      size = len(self.__queue)
+      for _ in result:
+        self.__stats.got(self.__times.popleft(), size)
     self.__checkIfNoLongerFull()
     return result
 
@@ -112,10 +129,11 @@ class MaxSizeQueue(object):
 class MaxSizeDeferredQueue(MaxSizeQueue):
   """A queue with a maximum size and the ability to wait for items."""
 
-  def __init__(self, maxSize, backlog = 0):
-    MaxSizeQueue.__init__(self, maxSize)
+  def __init__(self, maxSize, backlog = 0, stats=None):
+    MaxSizeQueue.__init__(self, maxSize, stats)
     self.__backlogSize = backlog
     self.__backlog = deque()
+    self.__stats = stats
 
 
   def push(self, *items):
@@ -124,6 +142,8 @@ class MaxSizeDeferredQueue(MaxSizeQueue):
     while not self.isEmpty() and self.__backlog:
       deferred = self.__backlog.popleft()
       deferred.callback(self.shift())
+    if self.__stats:
+      self.__stats.setWaiting(len(self.__backlog))
     return result
 
 
@@ -134,12 +154,51 @@ class MaxSizeDeferredQueue(MaxSizeQueue):
         raise defer.QueueUnderflow()
       deferred = defer.Deferred()
       self.__backlog.append(deferred)
+      if self.__stats:
+        self.__stats.setWaiting(len(self.__backlog))
       return deferred
     else:
       return MaxSizeQueue.shift(self)
 
 
 
+class _Bucket(deque):
+  """Items in a DeferredPriorityQueue that share a sort key, in the order they were put.
+
+  Only used for keys with two or more items; a key with one item maps straight to it.
+  """
+
+  __slots__ = ()
+
+
+
+def _append(buckets, key, value):
+  """Adds a value to the end of the bucket for the given key.  Returns whether the key is new."""
+  current = buckets.get(key, _Bucket)
+  if current is _Bucket:
+    buckets[key] = value
+    return True
+  if isinstance(current, _Bucket):
+    current.append(value)
+  else:
+    buckets[key] = _Bucket((current, value))
+  return False
+
+
+
+def _popLeft(buckets, key):
+  """Removes and returns the first value in the bucket for the given key, and whether the bucket is now empty."""
+  current = buckets[key]
+  if not isinstance(current, _Bucket):
+    del buckets[key]
+    return current, True
+  value = current.popleft()
+  if len(current) == 1:
+    buckets[key] = current[0]
+  return value, False
+
+
+
 class DeferredPriorityQueue(object):
   """Similar to DeferredQueue
      - http://twistedmatrix.com/trac/browser/tags/releases/twisted-11.1.0/twisted/internet/defer.py#L1372
@@ -147,6 +206,13 @@ class DeferredPriorityQueue(object):
      made to retrieve an object when the queue is empty, a L{Deferred} is
      returned which will fire when an object becomes available.
 
+     Items with equal sort keys are returned in the order they were put,
+     and are never compared to each other.  Items are grouped by sort key,
+     with a heap of the distinct keys, so queues with few distinct keys
+     use little memory per item.  Once a sort key turns out to be
+     unhashable, the queue switches to a heap of (key, sequence, item)
+     tuples instead.
+
     @ivar sortKey: The function used to sort this priority queue
 
     @ivar size: The maximum number of objects to allow into the queue
@@ -157,15 +223,23 @@ class DeferredPriorityQueue(object):
     one time.  When an attempt is made to get an object which would
     exceed this limit, L{QueueUnderflow} is raised synchronously.  C{None}
     for no limit.
+
+    @ivar stats: A L{metrics.QueueStats} to record activity in, or C{None}.
   """
 
 
-  def __init__(self, sortKey=None, size=None, backlog=None):
+  def __init__(self, sortKey=None, size=None, backlog=None, stats=None):
     self.waiting = []
-    self.pending = [] #This is le heap
     self.size = size
     self.backlog = backlog
     self.sortKey = sortKey
+    self.stats = stats
+    self._count = 0
+    self._keys = [] # Heap of the distinct sort keys of pending items.
+    self._buckets = {} # Sort key -> its item, or a _Bucket of its items.
+    self._times = {} if stats else None # Sort key -> when its items were put, shaped like _buckets.
+    self._entries = None # Heap of (key, sequence, [time put,] item) tuples, once a key was unhashable.
+    self._sequence = None
 
 
   def _cancelGet(self, d):
@@ -181,8 +255,8 @@ class DeferredPriorityQueue(object):
     @param d: The deferred that has been canceled.
     """
     self.waiting.remove(d)
-    #TODO - Improve this from O(n * log(n))
-    heapq.heapify(self.waiting)
+    if self.stats:
+      self.stats.setWaiting(len(self.waiting))
 
 
   def put(self, obj):
@@ -192,9 +266,12 @@ class DeferredPriorityQueue(object):
     @raise QueueOverflow: Too many objects are in this queue.
     """
     if self.waiting:
+      if self.stats:
+        self.stats.got(self.stats.put(1, 0), 0)
+        self.stats.setWaiting(len(self.waiting) - 1)
       self.waiting.pop(0).callback(obj)
-    elif self.size is None or len(self.pending) < self.size:
-      heapq.heappush(self.pending, (self.sortKey(obj), obj))
+    elif self.size is None or self._count < self.size:
+      self._push(self.sortKey(obj), obj)
     else:
       raise defer.QueueOverflow()
 
@@ -209,11 +286,13 @@ class DeferredPriorityQueue(object):
     @raise QueueUnderflow: Too many (more than C{backlog})
     L{Deferred}s are already waiting for an object from this queue.
     """
-    if self.pending:
-      return defer.succeed(heapq.heappop(self.pending)[1])
+    if self._count:
+      return defer.succeed(self._pop())
     elif self.backlog is None or len(self.waiting) < self.backlog:
       d = defer.Deferred(canceller=self._cancelGet)
       self.waiting.append(d)
+      if self.stats:
+        self.stats.setWaiting(len(self.waiting))
       return d
     else:
       raise defer.QueueUnderflow()
@@ -221,5 +300,174 @@ class DeferredPriorityQueue(object):
 
   def clear(self):
     """Clear this queue."""
-    if self.pending:
-      self.pending = []
+    if self._count:
+      if self.stats:
+        self.stats.cleared(self._count)
+      self._count = 0
+      self._keys = []
+      self._buckets = {}
+      if self._times is not None:
+        self._times = {}
+      if self._entries is not None:
+        self._entries = []
+
+
+  def __len__(self):
+    """Returns the number of pending items."""
+    return self._count
+
+
+  def _push(self, key, obj):
+    """Adds an item with the given sort key to the pending items."""
+    self._count += 1
+    enqueuedAt = self.stats.put(1, self._count) if self.stats else None
+    if self._entries is None:
+      try:
+        hash(key)
+      except TypeError:
+        self.__useEntries()
+      else:
+        if _append(self._buckets, key, obj):
+          heapq.heappush(self._keys, key)
+        if self._times is not None:
+          _append(self._times, key, enqueuedAt)
+        return
+    if self.stats:
+      heapq.heappush(self._entries, (key, self._sequence.next(), enqueuedAt, obj))
+    else:
+      heapq.heappush(self._entries, (key, self._sequence.next(), obj))
+
+
+  def __useEntries(self):
+    """Moves the pending items into a heap of entries, which works for unhashable keys."""
+    self._sequence = itertools.count()
+    entries = []
+    for key in self._keys:
+      items = self._buckets[key]
+      items = list(items) if isinstance(items, _Bucket) else [items]
+      if self._times is not None:
+        times = self._times[key]
+        times = list(times) if isinstance(times, _Bucket) else [times]
+        entries.extend((key, self._sequence.next(), enqueuedAt, obj) for enqueuedAt, obj in zip(times, items))
+      else:
+        entries.extend((key, self._sequence.next(), obj) for obj in items)
+    heapq.heapify(entries)
+    self._entries = entries
+    self._keys = []
+    self._buckets = {}
+    if self._times is not None:
+      self._times = {}
+
+
+  def _peekKey(self):
+    """Returns the smallest sort key of any pending item."""
+    if self._entries is not None:
+      return self._entries[0][0]
+    return self._keys[0]
+
+
+  def _pop(self, expired=False):
+    """Removes and returns the first pending item with the smallest sort key.
+
+    Items removed because they expired are recorded as expired rather than dequeued.
+    """
+    self._count -= 1
+    enqueuedAt = None
+    if self._entries is not None:
+      entry = heapq.heappop(self._entries)
+      obj = entry[-1]
+      if self.stats:
+        enqueuedAt = entry[2]
+    else:
+      key = self._keys[0]
+      obj, emptied = _popLeft(self._buckets, key)
+      if self._times is not None:
+        enqueuedAt, _ = _popLeft(self._times, key)
+      if emptied:
+        heapq.heappop(self._keys)
+
+    if self.stats:
+      if expired:
+        self.stats.expiredItems(1, self._count)
+      else:
+        self.stats.got(enqueuedAt, self._count)
+    return obj
+
+
+
+class DeferredDeadlineQueue(DeferredPriorityQueue):
+  """A DeferredPriorityQueue that serves items earliest-deadline-first.
+
+    Items whose deadline has already passed are never handed out.  Instead they are removed in bulk and passed to
+    C{onExpired}, which is the place to fail whatever is waiting on them.  Under overload this keeps consumers
+    working on requests whose callers are still listening.
+
+    @ivar deadline: Function mapping an item to the time, as returned by C{clock.seconds()}, after which the item
+    is no longer worth processing.
+
+    @ivar onExpired: Function called with a list of expired items, or C{None} to silently drop them.
+
+    @ivar expired: The number of items that have expired so far.
+  """
+
+
+  def __init__(self, deadline, onExpired=None, size=None, backlog=None, clock=None, stats=None):
+    DeferredPriorityQueue.__init__(self, deadline, size, backlog, stats)
+    self.deadline = deadline
+    self.onExpired = onExpired
+    self.expired = 0
+    if clock is None:
+      from twisted.internet import reactor
+      clock = reactor
+    self._clock = clock
+
+
+  def __expireItems(self, items):
+    """Counts and reports the given expired items."""
+    self.expired += len(items)
+    if self.onExpired:
+      self.onExpired(items)
+
+
+  def expire(self):
+    """
+    Remove all items whose deadline has passed.  This happens automatically on each get(), but may also be called
+    periodically to shed load from a queue that is not being drained.
+
+    @return: The number of items that expired.
+    """
+    now = self._clock.seconds()
+    items = []
+    while self._count and self._peekKey() <= now:
+      items.append(self._pop(expired=True))
+    if items:
+      self.__expireItems(items)
+    return len(items)
+
+
+  def put(self, obj):
+    """
+    Add an object to this queue.  Objects that are already past their deadline are expired immediately.
+
+    @raise QueueOverflow: Too many objects are in this queue.
+    """
+    if self.deadline(obj) <= self._clock.seconds():
+      if self.stats:
+        self.stats.expiredItems(1, self._count)
+      self.__expireItems([obj])
+    else:
+      DeferredPriorityQueue.put(self, obj)
+
+
+  def get(self):
+    """
+    Attempt to retrieve and remove the unexpired object with the earliest deadline.
+
+    @return: a L{Deferred} which fires with the next object available in
+    the queue.
+
+    @raise QueueUnderflow: Too many (more than C{backlog})
+    L{Deferred}s are already waiting for an object from this queue.
+    """
+    self.expire()
+    return DeferredPriorityQueue.get(self)
@@ -0,0 +1,103 @@
+# Copyright 2012 The greplin-twisted-utils Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Memory and speed benchmark for DeferredPriorityQueue.
+
+Compares the queue against the (sortKey(obj), obj) heap it used to be built on.  Run as:
+
+  python -m greplin.defer.queue_benchmark [count]
+"""
+
+from __future__ import absolute_import
+
+from greplin.defer import queue
+
+import heapq
+import random
+import sys
+import time
+
+
+
+def footprint(objects):
+  """Returns the bytes used by the given objects, counting each distinct object once.
+
+  Small ints and other shared keys are only counted once, however many entries refer to them.
+  """
+  seen = set()
+  total = 0
+  for obj in objects:
+    if id(obj) not in seen:
+      seen.add(id(obj))
+      total += sys.getsizeof(obj)
+  return total
+
+
+def tupleHeapFootprint(heap):
+  """Returns the bytes used by a heap of (key, item) tuples, excluding the items themselves."""
+  return sys.getsizeof(heap) + footprint([entry for entry in heap] + [entry[0] for entry in heap])
+
+
+def queueFootprint(q):
+  """Returns the bytes used by a DeferredPriorityQueue, excluding the items themselves."""
+  # pylint: disable=W0212
+  if q._entries is not None:
+    entries = q._entries
+    return sys.getsizeof(entries) + footprint(
+        list(entries) + [entry[0] for entry in entries] + [entry[1] for entry in entries])
+  buckets = [bucket for bucket in q._buckets.itervalues() if isinstance(bucket, queue._Bucket)]
+  return sys.getsizeof(q._keys) + sys.getsizeof(q._buckets) + footprint(q._keys + buckets)
+
+
+def run(name, count, keyFn):
+  """Benchmarks both representations on count items whose sort keys are computed by keyFn."""
+  items = [object() for _ in xrange(count)]
+  keys = [keyFn(i) for i in xrange(count)]
+  random.shuffle(keys)
+  keyOf = dict(zip(map(id, items), keys)).__getitem__
+  sortKey = lambda item: keyOf(id(item))
+
+  start = time.time()
+  heap = []
+  for item in items:
+    heapq.heappush(heap, (sortKey(item), item))
+  heapBytes = tupleHeapFootprint(heap)
+  while heap:
+    heapq.heappop(heap)
+  heapTime = time.time() - start
+
+  start = time.time()
+  q = queue.DeferredPriorityQueue(sortKey=sortKey)
+  for item in items:
+    q.put(item)
+  queueBytes = queueFootprint(q)
+  while len(q):
+    q.get()
+  queueTime = time.time() - start
+
+  print '%-24s tuple heap: %6.1f bytes/item %6.2fs   DeferredPriorityQueue: %6.1f bytes/item %6.2fs' % (
+      name, float(heapBytes) / count, heapTime, float(queueBytes) / count, queueTime)
+
+
+def main():
+  """Runs the benchmark."""
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+  run('10 priorities', count, lambda i: i % 10)
+  run('1000 priorities', count, lambda i: i % 1000)
+  run('unique float priorities', count, float)
+  run('unhashable priorities', count, lambda i: [i % 1000])
+
+
+if __name__ == '__main__':
+  main()
@@ -14,7 +14,7 @@
 
 """Tests for the StepTask class."""
 
-from twisted.internet import defer
+from twisted.internet import defer, task
 
 import unittest
 
@@ -215,3 +215,120 @@ class DeferredPriorityQueueTest(unittest.TestCase):
        "result: Deferred",
        "callback get returned 7"
       ], self.log)
+
+
+
+  def testEqualKeysAreFifo(self):
+    """Test that items with equal keys come out in insertion order without being compared."""
+    class Incomparable(object):
+      """Object that refuses to be compared."""
+
+      def __init__(self, name):
+        self.name = name
+
+      def __cmp__(self, other):
+        raise AssertionError('Compared items')
+
+    q = queue.DeferredPriorityQueue(sortKey=lambda e: len(e.name))
+    for name in ('bb', 'a', 'cc', 'b', 'aa', 'ccc'):
+      q.put(Incomparable(name))
+    self.assertEquals(6, len(q))
+    self.assertEquals(['a', 'b', 'bb', 'cc', 'aa', 'ccc'], [q.get().result.name for _ in range(6)])
+    self.assertEquals(0, len(q))
+
+
+  def testUnhashableKeys(self):
+    """Test that sort keys only need to be comparable."""
+    q = queue.DeferredPriorityQueue(sortKey=lambda e: [e % 3, -e])
+    for i in range(6):
+      q.put(i)
+    self.assertEquals(6, len(q))
+    self.assertEquals([3, 0, 4, 1, 5, 2], [q.get().result for _ in range(6)])
+
+
+  def testSwitchToUnhashableKeys(self):
+    """Test that items queued before the first unhashable key keep their order."""
+    q = queue.DeferredPriorityQueue(sortKey=lambda e: e[0])
+    for item in ((1, 'a'), (2, 'b'), (1, 'c'), ([0], 'd'), (1, 'e')):
+      q.put(item)
+    self.assertEquals(5, len(q))
+    self.assertEquals(['a', 'c', 'e', 'b', 'd'], [q.get().result[1] for _ in range(5)])
+    self.assertEquals(0, len(q))
+
+
+  def testSizeAndClear(self):
+    """Test the size limit and clearing."""
+    q = queue.DeferredPriorityQueue(sortKey=lambda e: e % 2, size=3)
+    q.put(1)
+    q.put(2)
+    q.put(3)
+    self.assertRaises(defer.QueueOverflow, q.put, 4)
+    self.assertEquals(3, len(q))
+
+    q.clear()
+    self.assertEquals(0, len(q))
+    self.assertFalse(q.get().called)
+
+
+
+class DeferredDeadlineQueueTest(unittest.TestCase):
+  """Tests for DeferredDeadlineQueue."""
+
+
+  def setUp(self):
+    """Sets up the test."""
+    self.clock = task.Clock()
+    self.expiredItems = []
+    self.queue = queue.DeferredDeadlineQueue(
+        deadline=lambda e: e[0], onExpired=self.expiredItems.append, clock=self.clock)
+
+
+  def testEarliestDeadlineFirst(self):
+    """Test that items are returned in deadline order."""
+    self.queue.put((30, 'c'))
+    self.queue.put((10, 'a'))
+    self.queue.put((20, 'b'))
+    self.assertEquals((10, 'a'), self.queue.get().result)
+    self.assertEquals((20, 'b'), self.queue.get().result)
+    self.assertEquals((30, 'c'), self.queue.get().result)
+    self.assertEquals(0, self.queue.expired)
+
+
+  def testExpiry(self):
+    """Test that expired items are skipped and reported in bulk."""
+    self.queue.put((10, 'a'))
+    self.queue.put((20, 'b'))
+    self.queue.put((30, 'c'))
+
+    self.clock.advance(20)
+    self.assertEquals((30, 'c'), self.queue.get().result)
+    self.assertEquals([[(10, 'a'), (20, 'b')]], self.expiredItems)
+    self.assertEquals(2, self.queue.expired)
+
+    result = self.queue.get()
+    self.assertFalse(result.called)
+
+
+  def testPutExpired(self):
+    """Test putting an item that is already past its deadline."""
+    self.clock.advance(50)
+    result = self.queue.get()
+    self.queue.put((40, 'late'))
+    self.assertFalse(result.called)
+    self.assertEquals([[(40, 'late')]], self.expiredItems)
+    self.assertEquals(1, self.queue.expired)
+
+    self.queue.put((60, 'ok'))
+    self.assertEquals((60, 'ok'), result.result)
+
+
+  def testExplicitExpire(self):
+    """Test shedding expired items without a get."""
+    self.queue = queue.DeferredDeadlineQueue(deadline=lambda e: e[0], clock=self.clock)
+    self.queue.put((10, 'a'))
+    self.queue.put((20, 'b'))
+    self.clock.advance(15)
+    self.assertEquals(1, self.queue.expire())
+    self.assertEquals(0, self.queue.expire())
+    self.assertEquals(1, self.queue.expired)
+    self.assertEquals((20, 'b'), self.queue.get().result)
@@ -19,9 +19,229 @@ from greplin.defer import inline, time
 from twisted.internet import defer
 from twisted.python import failure
 
+import collections
+
+
+CLOSED = 'closed'
+
+OPEN = 'open'
+
+HALF_OPEN = 'halfOpen'
+
+
+
+class CircuitOpenError(Exception):
+  """Raised instead of calling a function whose circuit breaker is open."""
+
+
+
+class RetryPolicy(object):
+  """Base class for objects that decide whether retryCall may call or retry a function.  Does not limit anything.
+
+  A single policy object is meant to be shared by every call to the same dependency.
+  """
+
+  def started(self):
+    """Called when a new call starts, before its first attempt."""
+
+
+  def beforeAttempt(self):
+    """Called before each attempt.  Raises an exception to fail the call without making the attempt."""
+
+
+  def allowRetry(self):
+    """Called after a retryable failure.  Returns whether the call may be retried."""
+    return True
+
+
+  def succeeded(self):
+    """Called when an attempt got an answer: either a result, or a failure that is not retried."""
+
+
+  def failed(self):
+    """Called when an attempt failed in a way that would be retried."""
+
+
+
+class RetryPolicies(RetryPolicy):
+  """Combines several policies.  Attempts and retries are only allowed if every policy allows them."""
+
+  def __init__(self, *policies):
+    self.policies = policies
+
+
+  def started(self):
+    """Called when a new call starts, before its first attempt."""
+    for policy in self.policies:
+      policy.started()
+
+
+  def beforeAttempt(self):
+    """Called before each attempt.  Raises an exception to fail the call without making the attempt."""
+    for policy in self.policies:
+      policy.beforeAttempt()
+
+
+  def allowRetry(self):
+    """Called after a retryable failure.  Returns whether the call may be retried."""
+    return all(policy.allowRetry() for policy in self.policies)
+
+
+  def succeeded(self):
+    """Called when an attempt got an answer: either a result, or a failure that is not retried."""
+    for policy in self.policies:
+      policy.succeeded()
+
+
+  def failed(self):
+    """Called when an attempt failed in a way that would be retried."""
+    for policy in self.policies:
+      policy.failed()
+
+
+
+class RetryBudget(RetryPolicy):
+  """Limits retries to minRetries plus ratio times the number of calls started in the last window seconds.
+
+  While the dependency is healthy few calls need retrying and the budget is never reached.  When it is down, the
+  budget stops callers multiplying its load by the number of retries.
+
+  @ivar calls: Number of calls started.
+  @ivar retries: Number of retries allowed.
+  @ivar rejected: Number of retries refused because the budget was used up.
+  """
+
+  def __init__(self, ratio = 0.1, minRetries = 10, window = 10, buckets = 10, clock = None):
+    if clock is None:
+      from twisted.internet import reactor
+      clock = reactor
+    self.__clock = clock
+    self.__ratio = ratio
+    self.__minRetries = minRetries
+    self.__window = window
+    self.__bucketSize = float(window) / buckets
+    self.__buckets = collections.deque() # [bucket index, calls, retries] for the current window, oldest first.
+    self.__windowCalls = 0
+    self.__windowRetries = 0
+    self.calls = 0
+    self.retries = 0
+    self.rejected = 0
+
+
+  def __currentBucket(self):
+    """Returns the bucket for the current time, dropping buckets that are no longer in the window."""
+    index = int(self.__clock.seconds() / self.__bucketSize)
+    buckets = self.__buckets
+    while buckets and buckets[0][0] <= index - self.__window / self.__bucketSize:
+      _, calls, retries = buckets.popleft()
+      self.__windowCalls -= calls
+      self.__windowRetries -= retries
+    if not buckets or buckets[-1][0] != index:
+      buckets.append([index, 0, 0])
+    return buckets[-1]
+
+
+  def started(self):
+    """Called when a new call starts, before its first attempt."""
+    self.__currentBucket()[1] += 1
+    self.__windowCalls += 1
+    self.calls += 1
+
+
+  def allowRetry(self):
+    """Called after a retryable failure.  Returns whether the call may be retried."""
+    bucket = self.__currentBucket()
+    if self.__windowRetries >= self.__minRetries + self.__ratio * self.__windowCalls:
+      self.rejected += 1
+      return False
+    bucket[2] += 1
+    self.__windowRetries += 1
+    self.retries += 1
+    return True
+
+
+
+class CircuitBreaker(RetryPolicy):
+  """Fails calls straight away while a dependency appears to be down.
+
+  The breaker starts CLOSED.  After failureThreshold consecutive retryable failures it becomes OPEN, and attempts fail
+  with CircuitOpenError without being made.  After resetTimeout seconds it becomes HALF_OPEN and lets halfOpenAttempts
+  attempts through: if one gets an answer it closes again, and if one fails it opens again.  If the trial attempts
+  have not finished after another resetTimeout seconds, more are let through.
+
+  @ivar state: CLOSED, OPEN or HALF_OPEN.
+  @ivar opened: Number of times the breaker opened.
+  @ivar rejected: Number of attempts failed without being made.
+  """
+
+  def __init__(self, failureThreshold = 5, resetTimeout = 30, halfOpenAttempts = 1, clock = None):
+    if clock is None:
+      from twisted.internet import reactor
+      clock = reactor
+    self.__clock = clock
+    self.__failureThreshold = failureThreshold
+    self.__resetTimeout = resetTimeout
+    self.__halfOpenAttempts = halfOpenAttempts
+    self.__failures = 0
+    self.__trials = 0
+    self.__changedAt = None
+    self.state = CLOSED
+    self.opened = 0
+    self.rejected = 0
+
+
+  def __setState(self, state):
+    """Changes the state of the breaker."""
+    self.state = state
+    self.__changedAt = self.__clock.seconds()
+    self.__failures = 0
+    self.__trials = 0
+
+
+  def beforeAttempt(self):
+    """Called before each attempt.  Raises CircuitOpenError to fail the call without making the attempt."""
+    if self.state == CLOSED:
+      return
+    if self.__clock.seconds() >= self.__changedAt + self.__resetTimeout:
+      self.__setState(HALF_OPEN)
+    if self.state == OPEN or self.__trials >= self.__halfOpenAttempts:
+      self.rejected += 1
+      raise CircuitOpenError()
+    self.__trials += 1
+
+
+  def allowRetry(self):
+    """Called after a retryable failure.  Refuses retries while open, so the call fails with the real error."""
+    return self.state != OPEN
+
+
+  def succeeded(self):
+    """Called when an attempt got an answer: either a result, or a failure that is not retried."""
+    if self.state == CLOSED:
+      self.__failures = 0
+    else:
+      self.__setState(CLOSED)
+
+
+  def failed(self):
+    """Called when an attempt failed in a way that would be retried."""
+    if self.state == HALF_OPEN:
+      self.__setState(OPEN)
+      self.opened += 1
+    elif self.state == CLOSED:
+      self.__failures += 1
+      if self.__failures >= self.__failureThreshold:
+        self.__setState(OPEN)
+        self.opened += 1
+
+
+
+NO_POLICY = RetryPolicy()
+
+
 
 @inline.callbacks
-def retryCall(fn, args=None, keywordArgs=None, failureTester=None, sleepManager=None):
+def retryCall(fn, args=None, keywordArgs=None, failureTester=None, sleepManager=None, policy=None):
   """Calls the given function, automatically retrying as necessary.
 
   Arguments:
@@ -30,18 +250,38 @@ def retryCall(fn, args=None, keywordArgs=None, failureTester=None, sleepManager=
     sleepManager: A sleep manager to control how long to sleep between retries.
     args: Args to pass to the function.
     keywordArgs: keywordArgs to pass to the function.
+    policy: A RetryPolicy, such as a RetryBudget or CircuitBreaker, shared by calls to the same dependency.
 
   Returns:
     A deferred that will be called on success.
   """
   sleepManager = sleepManager or time.SleepManager()
+  policy = policy or NO_POLICY
+  policy.started()
   while True:
+    policy.beforeAttempt()
     try:
       result = yield fn(*args, **keywordArgs)
-      defer.returnValue(result)
     except Exception: # pylint: disable=W0703
-      failureTester(failure.Failure())
+      _handleFailure(failure.Failure(), failureTester, policy)
       yield sleepManager.sleep()
+    else:
+      policy.succeeded()
+      defer.returnValue(result)
+
+
+
+def _handleFailure(err, failureTester, policy):
+  """Raises the failure unless the call should be retried.  Called before sleeping, so a call that may not be retried
+  fails straight away with its own error."""
+  try:
+    failureTester(err)
+  except: # Failure.trap raises the failure itself, which is not an Exception. # pylint: disable=W0702
+    policy.succeeded()
+    raise
+  policy.failed()
+  if not policy.allowRetry():
+    err.raiseException()
 
 
 
@@ -55,7 +295,7 @@ class RetryCall(object):
 
 
   @inline.callbacks
-  def __call__(self, fn, args=None, keywordArgs=None, failureTester=None, sleepManager=None):
+  def __call__(self, fn, args=None, keywordArgs=None, failureTester=None, sleepManager=None, policy=None):
     """Calls the given function, automatically retrying as necessary.
 
     Arguments:
@@ -64,21 +304,27 @@ class RetryCall(object):
       sleepManager: A sleep manager to control how long to sleep between retries.
       args: Args to pass to the function.
       keywordArgs: keywordArgs to pass to the function.
+      policy: A RetryPolicy, such as a RetryBudget or CircuitBreaker, shared by calls to the same dependency.
 
     Returns:
       A deferred that will be called on success.
     """
     sleepManager = sleepManager or time.SleepManager()
+    policy = policy or NO_POLICY
+    policy.started()
     while True:
+      policy.beforeAttempt()
       try:
         result = yield fn(*args, **keywordArgs)
-        defer.returnValue(result)
       except Exception as e: # pylint: disable=W0703
         self.lastError = e
-        failureTester(failure.Failure())
+        self.iteration += 1
+        _handleFailure(failure.Failure(), failureTester, policy)
         yield sleepManager.sleep()
-      finally:
+      else:
         self.iteration += 1
+        policy.succeeded()
+        defer.returnValue(result)
 
 
   def describeDeferred(self):
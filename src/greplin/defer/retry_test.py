@@ -16,7 +16,7 @@
 
 from greplin.defer import inline, retry, time
 
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.trial import unittest
 
 
@@ -47,6 +47,16 @@ class LoggingSleeper(object):
 
 
 
+class InstantSleeper(LoggingSleeper):
+  """Fake sleep manager that logs actions and does not wait for the reactor."""
+
+  def sleep(self):
+    """Fake sleep by returning an already fired deferred."""
+    self.log.append('sleep')
+    return defer.succeed(None)
+
+
+
 class RetryCallTest(unittest.TestCase):
   """Tests for retryCall."""
 
@@ -97,6 +107,77 @@ class RetryCallTest(unittest.TestCase):
     self.assertEquals(expectedLog, self.log)
 
 
+  def callWithPolicy(self, steps, policy):
+    """Calls the test function with the given steps and policy, returning the result or 'failed'."""
+    self.steps = steps
+    result = retry.retryCall(
+        self._function, self.expectedArgs, self.expectedKeywords, self._checkFailure, InstantSleeper(self.log), policy)
+    if isinstance(result, defer.Deferred):
+      result = result.result
+    return result
+
+
+  def testBudget(self):
+    """Tests that retries stop when the retry budget is used up."""
+    clock = task.Clock()
+    budget = retry.RetryBudget(ratio=0.5, minRetries=0, window=10, clock=clock)
+    self.assertEquals(100, self.callWithPolicy([OkException(), 100], budget))
+    self.assertEquals(200, self.callWithPolicy([200], budget))
+    self.assertRaises(OkException, self.callWithPolicy, [OkException(), OkException()], budget)
+    self.assertEquals((3, 2, 1), (budget.calls, budget.retries, budget.rejected))
+
+    clock.advance(10)
+    self.assertEquals(300, self.callWithPolicy([OkException(), 300], budget))
+    self.assertEquals((4, 3, 1), (budget.calls, budget.retries, budget.rejected))
+
+
+  def testCircuitBreaker(self):
+    """Tests that calls fail fast while the circuit breaker is open."""
+    clock = task.Clock()
+    breaker = retry.CircuitBreaker(failureThreshold=2, resetTimeout=10, clock=clock)
+    self.assertRaises(OkException, self.callWithPolicy, [OkException(), OkException()], breaker)
+    self.assertEquals(retry.OPEN, breaker.state)
+    self.assertEquals(['function', 'testFailure', 'sleep', 'function', 'testFailure'], self.log)
+
+    self.assertRaises(retry.CircuitOpenError, self.callWithPolicy, [100], breaker)
+    self.assertEquals((1, 1), (breaker.opened, breaker.rejected))
+
+    clock.advance(10)
+    self.assertRaises(OkException, self.callWithPolicy, [OkException()], breaker)
+    self.assertEquals((2, 1), (breaker.opened, breaker.rejected))
+
+    clock.advance(10)
+    self.assertEquals(200, self.callWithPolicy([200], breaker))
+    self.assertEquals(retry.CLOSED, breaker.state)
+
+
+  def testCircuitBreakerHalfOpen(self):
+    """Tests that only the allowed number of trial attempts are made while half open."""
+    clock = task.Clock()
+    breaker = retry.CircuitBreaker(failureThreshold=1, resetTimeout=10, halfOpenAttempts=1, clock=clock)
+    breaker.failed()
+    clock.advance(10)
+    breaker.beforeAttempt()
+    self.assertEquals(retry.HALF_OPEN, breaker.state)
+    self.assertRaises(retry.CircuitOpenError, breaker.beforeAttempt)
+
+    clock.advance(10) # The trial attempt never finished, so another is allowed.
+    breaker.beforeAttempt()
+    breaker.succeeded()
+    self.assertEquals(retry.CLOSED, breaker.state)
+
+
+  def testBadExceptionClosesBreaker(self):
+    """Tests that failures that are not retried count as answers."""
+    breaker = retry.CircuitBreaker(failureThreshold=2, clock=task.Clock())
+    budget = retry.RetryBudget(clock=task.Clock())
+    policy = retry.RetryPolicies(breaker, budget)
+    self.assertRaises(BadException, self.callWithPolicy, [OkException(), BadException()], policy)
+    self.assertRaises(BadException, self.callWithPolicy, [OkException(), BadException()], policy)
+    self.assertEquals(retry.CLOSED, breaker.state)
+    self.assertEquals(2, budget.retries)
+
+
   def testWorksOnFirstTry(self):
     """Tests the basic case of the function succeeding on the first try."""
     return self.assertLog([
@@ -29,15 +29,18 @@ class DeferredPrioritySemaphore(defer._ConcurrencyPrimitive): # pylint: disable=
   @ivar tokens: At most this many users may acquire this semaphore at
       once.
   @type tokens: C{int}
+
+  @ivar stats: A L{metrics.SemaphoreStats} to record activity in, or C{None}.
   """
 
-  def __init__(self, tokens):
+  def __init__(self, tokens, stats=None):
     defer._ConcurrencyPrimitive.__init__(self) # pylint: disable=W0212
     if tokens < 1:
       raise ValueError("DeferredSemaphore requires tokens >= 1")
     self.tokens = tokens
     self.limit = tokens
     self.counter = 0
+    self.stats = stats
 
 
   def _cancelAcquire(self, d):
@@ -53,11 +56,13 @@ class DeferredPrioritySemaphore(defer._ConcurrencyPrimitive): # pylint: disable=
     @param d: The deferred that has been canceled.
     """
     for e in self.waiting:
-      if e[1] == d:
+      if e[2] is d:
         self.waiting.remove(e)
         # TODO - Improve from O(n * log(n))
         heapq.heapify(self.waiting)
         break
+    if self.stats:
+      self.stats.setWaiting(len(self.waiting))
 
 
   def acquire(self, priority=0):
@@ -72,10 +77,15 @@ class DeferredPrioritySemaphore(defer._ConcurrencyPrimitive): # pylint: disable=
     d = base.LowMemoryDeferred(self._cancelAcquire)
     self.counter += 1
     d.describeDeferred = functools.partial(self._describe, d, self.counter, priority)
+    requestedAt = self.stats and self.stats.requested()
     if not self.tokens:
-      heapq.heappush(self.waiting, (priority, self.counter, d))
+      heapq.heappush(self.waiting, (priority, self.counter, d, requestedAt))
+      if self.stats:
+        self.stats.setWaiting(len(self.waiting))
     else:
       self.tokens -= 1
+      if self.stats:
+        self.stats.acquire(requestedAt, self.limit - self.tokens)
       d.callback(self)
     return d
 
@@ -92,8 +102,13 @@ class DeferredPrioritySemaphore(defer._ConcurrencyPrimitive): # pylint: disable=
     if self.waiting:
       # someone is waiting to acquire token
       self.tokens -= 1
-      _, __, d = heapq.heappop(self.waiting)
+      _, __, d, requestedAt = heapq.heappop(self.waiting)
+      if self.stats:
+        self.stats.setWaiting(len(self.waiting))
+        self.stats.acquire(requestedAt, self.limit - self.tokens)
       d.callback(self)
+    elif self.stats:
+      self.stats.setInUse(self.limit - self.tokens)
 
 
   def _describe(self, d, counter, priority):
@@ -0,0 +1,232 @@
+# Copyright 2012 The greplin-twisted-utils Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Cache shared between processes on the same host through a memory mapped file."""
+
+from __future__ import absolute_import
+
+from twisted.internet import defer
+
+import cPickle
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import time
+
+
+MAGIC = 'GTUSHMC1'
+
+FILE_HEADER = struct.Struct('<8sII')
+
+FILE_HEADER_SIZE = 64
+
+SEQUENCE = struct.Struct('<I')
+
+SLOT_HEADER = struct.Struct('<IdQ') # Payload length, expiry time, key hash.  Follows the sequence number.
+
+SLOT_HEADER_SIZE = SEQUENCE.size + SLOT_HEADER.size
+
+
+
+class SharedMemoryCache(object):
+  """Cache of pickled values in a memory mapped file that can be shared by several processes.
+
+  The file holds a fixed number of fixed size slots, and each key can live in one of a few neighbouring slots.  When
+  they are all in use, the one expiring soonest is replaced.  Values whose pickled form does not fit in a slot are not
+  cached.
+
+  Reads take no locks.  Each slot has a sequence number that writers make odd while they are changing the slot, so a
+  reader that sees the sequence number change (or find it odd) treats the slot as a miss.  Writers serialize with an
+  exclusive flock on the file.
+
+  Use wrap() or wrapBatch() to put the cache in front of a DeferredMap's load function, so that a process can use
+  values that another process already loaded.
+
+  Values are unpickled, and unpickling data can run arbitrary code, so anyone who can write to the file can run code
+  in every process that uses it.  The file is created readable and writable only by its owner, and a file that is
+  owned by another user or writable by group or others is refused.  Only share a cache between processes that trust
+  each other, and keep it in a directory other users can not write to.
+  """
+
+  def __init__(self, path, ttl=60, slots=65536, slotSize=512, ways=4, timer=time.time):
+    self.__ttl = ttl
+    self.__slots = slots
+    self.__slotSize = slotSize
+    self.__ways = min(ways, slots)
+    self.__timer = timer
+
+    size = FILE_HEADER_SIZE + slots * slotSize
+    self.__file = os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0600), 'r+b')
+    fcntl.flock(self.__file, fcntl.LOCK_EX)
+    try:
+      stat = os.fstat(self.__file.fileno())
+      if stat.st_uid != os.getuid() or stat.st_mode & 022:
+        raise ValueError('%s may be written by other users, so it can not be trusted' % path)
+      if stat.st_size < FILE_HEADER_SIZE or self.__readMagic() == '\0' * len(MAGIC):
+        # A new file, or one whose creator died before writing the header.
+        self.__file.truncate(0)
+        self.__file.truncate(size)
+        self.__map = mmap.mmap(self.__file.fileno(), size)
+        FILE_HEADER.pack_into(self.__map, 0, MAGIC, slots, slotSize)
+      else:
+        self.__map = mmap.mmap(self.__file.fileno(), 0)
+        if FILE_HEADER.unpack_from(self.__map, 0) != (MAGIC, slots, slotSize) or len(self.__map) != size:
+          self.__map.close()
+          raise ValueError('%s is not a shared cache with %d slots of %d bytes' % (path, slots, slotSize))
+    except Exception:
+      self.__file.close() # Also releases the lock.
+      raise
+    fcntl.flock(self.__file, fcntl.LOCK_UN)
+
+
+  def __readMagic(self):
+    """Reads the magic bytes at the start of the file."""
+    self.__file.seek(0)
+    return self.__file.read(len(MAGIC))
+
+
+  def close(self):
+    """Unmaps and closes the file."""
+    self.__map.close()
+    self.__file.close()
+
+
+  def __hash(self, keyData):
+    """Returns a hash of the given pickled key that is the same in every process."""
+    return struct.unpack_from('<Q', hashlib.md5(keyData).digest())[0]
+
+
+  def __offsets(self, keyHash):
+    """Returns the offsets of the slots the key with the given hash may be in."""
+    first = keyHash % self.__slots
+    return [FILE_HEADER_SIZE + ((first + i) % self.__slots) * self.__slotSize for i in xrange(self.__ways)]
+
+
+  def get(self, key):
+    """Gets the value for the given key.  Raises KeyError if it is missing or expired."""
+    keyHash = self.__hash(cPickle.dumps(key, cPickle.HIGHEST_PROTOCOL))
+    mapped = self.__map
+    for offset in self.__offsets(keyHash):
+      sequence = SEQUENCE.unpack_from(mapped, offset)[0]
+      if sequence & 1:
+        continue
+      length, expires, slotHash = SLOT_HEADER.unpack_from(mapped, offset + SEQUENCE.size)
+      if slotHash != keyHash or not length:
+        continue
+      payload = mapped[offset + SLOT_HEADER_SIZE:offset + SLOT_HEADER_SIZE + length]
+      if SEQUENCE.unpack_from(mapped, offset)[0] != sequence:
+        continue
+      if expires <= self.__timer():
+        break
+      storedKey, value = cPickle.loads(payload)
+      if storedKey == key:
+        return value
+    raise KeyError(key)
+
+
+  def set(self, key, value, ttl=None):
+    """Stores a value for the given key.  Returns whether it fit in a slot."""
+    keyData = cPickle.dumps(key, cPickle.HIGHEST_PROTOCOL)
+    payload = cPickle.dumps((key, value), cPickle.HIGHEST_PROTOCOL)
+    if len(payload) > self.__slotSize - SLOT_HEADER_SIZE:
+      return False
+    keyHash = self.__hash(keyData)
+    expires = self.__timer() + (self.__ttl if ttl is None else ttl)
+    self.__write(keyHash, payload, expires)
+    return True
+
+
+  def delete(self, key):
+    """Removes the value for the given key, if any."""
+    self.__write(self.__hash(cPickle.dumps(key, cPickle.HIGHEST_PROTOCOL)), None, 0)
+
+
+  def __write(self, keyHash, payload, expires):
+    """Writes the payload to the best slot for the given key hash, or clears the key's slot if payload is None."""
+    mapped = self.__map
+    fcntl.flock(self.__file, fcntl.LOCK_EX)
+    try:
+      best = bestExpires = None
+      for offset in self.__offsets(keyHash):
+        length, slotExpires, slotHash = SLOT_HEADER.unpack_from(mapped, offset + SEQUENCE.size)
+        if slotHash == keyHash and length:
+          best = offset
+          break
+        if not length:
+          slotExpires = 0
+        if best is None or slotExpires < bestExpires:
+          best, bestExpires = offset, slotExpires
+      else:
+        if payload is None:
+          return
+
+      # Make the sequence number odd while writing.  It may already be odd if a writer died part way through.
+      sequence = SEQUENCE.unpack_from(mapped, best)[0] | 1
+      SEQUENCE.pack_into(mapped, best, sequence)
+      if payload is None:
+        SLOT_HEADER.pack_into(mapped, best + SEQUENCE.size, 0, 0, 0)
+      else:
+        mapped[best + SLOT_HEADER_SIZE:best + SLOT_HEADER_SIZE + len(payload)] = payload
+        SLOT_HEADER.pack_into(mapped, best + SEQUENCE.size, len(payload), expires, keyHash)
+      SEQUENCE.pack_into(mapped, best, (sequence + 1) & 0xFFFFFFFF)
+    finally:
+      fcntl.flock(self.__file, fcntl.LOCK_UN)
+
+
+  def wrap(self, fn):
+    """Returns a version of the single key load function fn that uses this cache."""
+
+    def load(key):
+      """Loads a key from the cache, or from fn and then stores it in the cache."""
+      try:
+        return self.get(key)
+      except KeyError:
+        return defer.maybeDeferred(fn, key).addCallback(self.__store, key)
+
+    return load
+
+
+  def wrapBatch(self, fn):
+    """Returns a version of the batch load function fn that uses this cache."""
+
+    def load(keys):
+      """Loads keys from the cache, and the rest from fn, storing them in the cache."""
+      results = {}
+      missing = []
+      for key in keys:
+        try:
+          results[key] = self.get(key)
+        except KeyError:
+          missing.append(key)
+      if not missing:
+        return results
+      return defer.maybeDeferred(fn, missing).addCallback(self.__storeBatch, results)
+
+    return load
+
+
+  def __store(self, value, key):
+    """Stores a newly loaded value, passing it through."""
+    self.set(key, value)
+    return value
+
+
+  def __storeBatch(self, loaded, results):
+    """Stores newly loaded values, returning them merged into results."""
+    for key, value in loaded.iteritems():
+      self.set(key, value)
+    results.update(loaded)
+    return results
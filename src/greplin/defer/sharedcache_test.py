@@ -0,0 +1,181 @@
+# Copyright 2012 The greplin-twisted-utils Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the shared memory cache."""
+
+from greplin.defer import lazymap, sharedcache
+
+from twisted.internet import defer
+
+import os
+import shutil
+import tempfile
+import unittest
+
+
+
+class FakeTimer(object):
+  """Timer that only moves when told to."""
+
+  def __init__(self):
+    self.now = 1000.0
+
+
+  def __call__(self):
+    return self.now
+
+
+
+class SharedMemoryCacheTest(unittest.TestCase):
+  """Tests for SharedMemoryCache."""
+
+  def setUp(self):
+    """Sets up the test."""
+    self.dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir, 'cache')
+    self.timer = FakeTimer()
+    self.caches = []
+
+
+  def tearDown(self):
+    """Cleans up the test."""
+    for cache in self.caches:
+      cache.close()
+    shutil.rmtree(self.dir)
+
+
+  def open(self, **kw):
+    """Opens a cache on the test file."""
+    kw.setdefault('slots', 8)
+    kw.setdefault('slotSize', 128)
+    self.caches.append(sharedcache.SharedMemoryCache(self.path, ttl=10, timer=self.timer, **kw))
+    return self.caches[-1]
+
+
+  def testBasics(self):
+    """Test getting and setting values."""
+    cache = self.open()
+    self.assertRaises(KeyError, cache.get, 'a')
+    self.assertTrue(cache.set('a', [1, 2]))
+    self.assertTrue(cache.set(('b', 3), 'bee'))
+    self.assertEquals([1, 2], cache.get('a'))
+    self.assertEquals('bee', cache.get(('b', 3)))
+
+    cache.set('a', 'replaced')
+    self.assertEquals('replaced', cache.get('a'))
+
+    cache.delete('a')
+    self.assertRaises(KeyError, cache.get, 'a')
+    cache.delete('a')
+
+
+  def testShared(self):
+    """Test that values written by one cache are visible to another using the same file."""
+    first = self.open()
+    second = self.open()
+    first.set('a', 1)
+    self.assertEquals(1, second.get('a'))
+    second.set('a', 2)
+    self.assertEquals(2, first.get('a'))
+
+
+  def testMismatchedFile(self):
+    """Test opening a file created with a different layout."""
+    self.open()
+    self.assertRaises(ValueError, self.open, slots=16)
+
+
+  def testExpiry(self):
+    """Test that values expire."""
+    cache = self.open()
+    cache.set('a', 1)
+    cache.set('b', 2, ttl=20)
+    self.timer.now += 10
+    self.assertRaises(KeyError, cache.get, 'a')
+    self.assertEquals(2, cache.get('b'))
+
+
+  def testTooBig(self):
+    """Test that values too big for a slot are not stored."""
+    cache = self.open()
+    self.assertFalse(cache.set('a', 'x' * 200))
+    self.assertRaises(KeyError, cache.get, 'a')
+
+
+  def testReplacement(self):
+    """Test that a full cache replaces the entries expiring soonest."""
+    cache = self.open(slots=2, ways=2)
+    cache.set('a', 1, ttl=5)
+    cache.set('b', 2, ttl=20)
+    cache.set('c', 3)
+    self.assertRaises(KeyError, cache.get, 'a')
+    self.assertEquals(2, cache.get('b'))
+    self.assertEquals(3, cache.get('c'))
+
+
+  def testHeaderNeverWritten(self):
+    """Test that a file whose creator died before writing the header is set up again."""
+    with open(self.path, 'wb') as f:
+      f.truncate(1024)
+    os.chmod(self.path, 0600)
+    cache = self.open()
+    cache.set('a', 1)
+    self.assertEquals(1, cache.get('a'))
+
+
+  def testUntrustedFile(self):
+    """Test that files other users can write to are refused."""
+    self.open()
+    os.chmod(self.path, 0666)
+    self.assertRaises(ValueError, self.open)
+
+
+  def testWrap(self):
+    """Test using the cache from DeferredMaps in different processes."""
+    calls = []
+    def load(key):
+      """Loads a value."""
+      calls.append(key)
+      return defer.succeed(key * 2)
+
+    pid = os.fork()
+    if not pid:
+      status = 1
+      try:
+        cache = sharedcache.SharedMemoryCache(self.path, slots=8, slotSize=128)
+        if lazymap.DeferredMap(cache.wrap(load))[2].result == 4:
+          status = 0
+      finally:
+        os._exit(status) # pylint: disable=W0212
+    self.assertEquals(0, os.waitpid(pid, 0)[1])
+
+    second = lazymap.DeferredMap(self.open().wrap(load))
+    self.assertEquals(4, second[2].result)
+    self.assertEquals([], calls)
+
+
+  def testWrapBatch(self):
+    """Test using the cache in front of a batch load function."""
+    calls = []
+    def load(keys):
+      """Loads values."""
+      calls.append(sorted(keys))
+      return dict((key, key * 2) for key in keys)
+
+    cache = self.open()
+    cache.set(1, 'cached')
+    load = cache.wrapBatch(load)
+    self.assertEquals({1: 'cached', 2: 4}, load([1, 2]).result)
+    self.assertEquals({1: 'cached', 2: 4}, load([1, 2]))
+    self.assertEquals([[2]], calls)
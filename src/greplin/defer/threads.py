@@ -14,12 +14,13 @@
 
 """Deferred classes for threading."""
 
+from collections import deque
 import functools
 
 import Queue
 
-from twisted.internet import reactor, threads
-from twisted.python import failure
+from twisted.internet import defer, reactor, threads
+from twisted.python import failure, threadpool
 
 
 
@@ -65,8 +66,184 @@ class ThreadWrapper(object):
     original = getattr(self.__target, item)
     if hasattr(original, '__call__'):
       if async:
-        return functools.partial(threads.deferToThreadPool, reactor, self.__threadPool, original)
+        return functools.partial(self._callAsync, original)
       else:
-        return functools.partial(self.__block, original)
+        return functools.partial(self._callBlocking, original)
     else:
       return original
+
+
+  def _callAsync(self, fn, *args, **kw):
+    """Calls the given function in the thread pool, returning a deferred."""
+    return threads.deferToThreadPool(reactor, self.__threadPool, fn, *args, **kw)
+
+
+  def _callBlocking(self, fn, *args, **kw):
+    """Calls the given function in the thread pool, blocking until it returns."""
+    return self.__block(fn, *args, **kw)
+
+
+
+def _runBatch(calls):
+  """Runs a batch of calls in order, returning a list of their results or failures."""
+  results = []
+  for fn, args, kw, _ in calls:
+    try:
+      results.append(fn(*args, **kw))
+    except: # pylint: disable=W0702
+      results.append(failure.Failure())
+  return results
+
+
+
+class BatchingThreadWrapper(ThreadWrapper):
+  """ThreadWrapper that hands calls to the thread pool in batches, for APIs made of many small calls.
+
+  Async calls are queued and handed over together at the end of the current reactor iteration, or as soon as
+  maxBatchSize calls are waiting, so a run of calls costs one thread handoff instead of one each.  A blocking call takes
+  any queued calls with it.  The calls in a batch run in order in one thread, and each call's deferred fires with its own
+  result, in the order the calls were made.
+  """
+
+  def __init__(self, threadPool, maxBatchSize, fn, *args, **kw):
+    self.__threadPool = threadPool
+    self.__maxBatchSize = maxBatchSize
+    self.__pending = [] # (fn, args, kw, deferred) for calls that have not been handed over yet.
+    self.__flushCall = None
+    self.__batches = deque() # [calls, results] for batches whose deferreds have not been fired, oldest first.
+    self.handoffs = 0
+    ThreadWrapper.__init__(self, threadPool, fn, *args, **kw)
+
+
+  def _callAsync(self, fn, *args, **kw):
+    """Queues a call, returning a deferred for its result."""
+    d = defer.Deferred()
+    self.__pending.append((fn, args, kw, d))
+    if len(self.__pending) >= self.__maxBatchSize:
+      self.flushBatch()
+    elif self.__flushCall is None:
+      self.__flushCall = reactor.callLater(0, self.flushBatch)
+    return d
+
+
+  def _callBlocking(self, fn, *args, **kw):
+    """Runs any queued calls followed by the given one in a single handoff, blocking until they return."""
+    calls = self.__take()
+    calls.append((fn, args, kw, None))
+    batch = [calls, None]
+    self.__batches.append(batch)
+    self.handoffs += 1
+
+    queue = Queue.Queue()
+    self.__threadPool.callInThreadWithCallback(lambda *result: queue.put(result), _runBatch, calls)
+    success, results = queue.get()
+    if not success:
+      results = [results] * len(calls)
+    result = results.pop()
+    self.__finished(batch, results)
+    if isinstance(result, failure.Failure):
+      result.raiseException()
+    return result
+
+
+  def flushBatch(self):
+    """Hands any queued calls to the thread pool now."""
+    calls = self.__take()
+    if calls:
+      batch = [calls, None]
+      self.__batches.append(batch)
+      self.handoffs += 1
+      self.__threadPool.callInThreadWithCallback(
+          lambda success, results: reactor.callFromThread(
+              self.__finished, batch, results if success else [results] * len(calls)),
+          _runBatch, calls)
+
+
+  def __take(self):
+    """Takes the queued calls."""
+    if self.__flushCall is not None:
+      if self.__flushCall.active():
+        self.__flushCall.cancel()
+      self.__flushCall = None
+    calls = self.__pending
+    self.__pending = []
+    return calls
+
+
+  def __finished(self, batch, results):
+    """Records the results of a batch, and fires the deferreds of every finished batch that is next in order."""
+    batch[1] = results
+    while self.__batches and self.__batches[0][1] is not None:
+      calls, results = self.__batches.popleft()
+      for (_, _, _, d), result in zip(calls, results):
+        if d is not None:
+          if isinstance(result, failure.Failure):
+            d.errback(result)
+          else:
+            d.callback(result)
+
+
+
+class _CountingThreadWrapper(ThreadWrapper):
+  """ThreadWrapper that counts the calls it is running."""
+
+  def __init__(self, threadPool, fn, *args, **kw):
+    self.outstanding = 0
+    ThreadWrapper.__init__(self, threadPool, fn, *args, **kw)
+
+
+  def _callAsync(self, fn, *args, **kw):
+    """Calls the given function in the thread pool, counting it until it finishes."""
+    self.outstanding += 1
+    d = ThreadWrapper._callAsync(self, fn, *args, **kw)
+    d.addBoth(self.__finished)
+    return d
+
+
+  def _callBlocking(self, fn, *args, **kw):
+    """Calls the given function in the thread pool, counting it until it returns."""
+    self.outstanding += 1
+    try:
+      return ThreadWrapper._callBlocking(self, fn, *args, **kw)
+    finally:
+      self.outstanding -= 1
+
+
+  def __finished(self, result):
+    """Stops counting a call."""
+    self.outstanding -= 1
+    return result
+
+
+
+class PinnedThreadWrapper(object):
+  """Wraps several copies of an object, each created and only ever called in its own dedicated thread.
+
+  This suits objects that are not thread safe, such as many C extensions, while letting libraries that release the GIL
+  use several cores.  Methods are called as for ThreadWrapper.  By default each call goes to the copy with the fewest
+  calls running; forKey(key) returns the copy for a given key, so that calls for the same key always go to the same copy.
+  """
+
+  def __init__(self, replicas, fn, *args, **kw):
+    self.__threadPools = [threadpool.ThreadPool(1, 1, 'PinnedThreadWrapper-%d' % i) for i in range(replicas)]
+    self.replicas = [_CountingThreadWrapper(pool, fn, *args, **kw) for pool in self.__threadPools]
+
+
+  def forKey(self, key):
+    """Returns the copy for the given key."""
+    return self.replicas[hash(key) % len(self.replicas)]
+
+
+  def leastLoaded(self):
+    """Returns the copy with the fewest calls running."""
+    return min(self.replicas, key=lambda replica: replica.outstanding)
+
+
+  def stop(self):
+    """Stops the threads."""
+    for pool in self.__threadPools:
+      pool.stop()
+
+
+  def __getattr__(self, item):
+    return getattr(self.leastLoaded(), item)
@@ -0,0 +1,121 @@
+# Copyright 2012 The greplin-twisted-utils Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for thread wrappers."""
+
+from greplin.defer import threads
+
+from twisted.python import threadpool
+
+import threading
+import unittest
+
+
+
+class Library(object):
+  """Object with small blocking calls."""
+
+  def __init__(self):
+    self.calls = []
+    self.threads = set()
+    self.createdIn = threading.currentThread()
+
+
+  def add(self, x, y):
+    """Adds two numbers."""
+    self.calls.append(('add', x, y))
+    self.threads.add(threading.currentThread())
+    return x + y
+
+
+  def fail(self):
+    """Raises an error."""
+    self.calls.append(('fail',))
+    raise ValueError()
+
+
+
+class BatchingThreadWrapperTest(unittest.TestCase):
+  """Tests for BatchingThreadWrapper."""
+
+  def setUp(self):
+    self.pool = threadpool.ThreadPool(1, 1)
+    self.wrapper = threads.BatchingThreadWrapper(self.pool, 10, Library)
+
+
+  def tearDown(self):
+    self.pool.stop()
+
+
+  def testBlockingCallTakesQueuedCalls(self):
+    """Test that queued calls are run in order with the next blocking call, in one handoff."""
+    first = self.wrapper.asyncAdd(1, 2)
+    second = self.wrapper.asyncAdd(3, 4)
+    self.assertFalse(first.called)
+    handoffs = self.wrapper.handoffs
+
+    self.assertEquals(11, self.wrapper.add(5, 6))
+    self.assertEquals(3, first.result)
+    self.assertEquals(7, second.result)
+    self.assertEquals(handoffs + 1, self.wrapper.handoffs)
+    self.assertEquals([('add', 1, 2), ('add', 3, 4), ('add', 5, 6)], self.wrapper.calls)
+    self.assertFalse(threading.currentThread() in self.wrapper.threads)
+
+
+  def testFailures(self):
+    """Test that a failing call only fails its own deferred."""
+    failed = self.wrapper.asyncFail()
+    self.assertEquals(3, self.wrapper.add(1, 2))
+    self.assertTrue(failed.result.check(ValueError))
+    failed.addErrback(lambda _: None) # Consume the error.
+    self.assertRaises(ValueError, self.wrapper.fail)
+
+
+
+class PinnedThreadWrapperTest(unittest.TestCase):
+  """Tests for PinnedThreadWrapper."""
+
+  def setUp(self):
+    self.wrapper = threads.PinnedThreadWrapper(3, Library)
+
+
+  def tearDown(self):
+    self.wrapper.stop()
+
+
+  def testPinnedToThread(self):
+    """Test that each copy is created and called in its own thread."""
+    for i in range(30):
+      self.assertEquals(i + 1, self.wrapper.forKey(i).add(i, 1))
+    createdIn = set()
+    for replica in self.wrapper.replicas:
+      self.assertEquals(10, len(replica.calls))
+      self.assertEquals(set([replica.createdIn]), replica.threads)
+      createdIn.add(replica.createdIn)
+    self.assertEquals(3, len(createdIn))
+
+
+  def testForKey(self):
+    """Test that calls for the same key go to the same copy."""
+    self.wrapper.forKey('a').add(1, 2)
+    self.wrapper.forKey('a').add(3, 4)
+    self.assertEquals([('add', 1, 2), ('add', 3, 4)], self.wrapper.forKey('a').calls)
+
+
+  def testLeastLoaded(self):
+    """Test that calls go to the copy with the fewest calls running."""
+    self.wrapper.asyncAdd(1, 2)
+    self.wrapper.asyncAdd(3, 4)
+    self.assertEquals([1, 1, 0], [replica.outstanding for replica in self.wrapper.replicas])
+    self.assertEquals(self.wrapper.replicas[2], self.wrapper.leastLoaded())
@@ -71,10 +71,88 @@ def timeoutDeferred(seconds, deferred):
 
 
 
+class Backoff(object):
+  """Base class for policies that decide how a SleepManager's delay grows.
+
+  The delay starts at minSleep.  Each sleep lasts sleepFor(delay) seconds, after which the delay becomes
+  nextDelay(delay).  Backoff objects hold no per-task state, so one can be shared by many SleepManagers.  This base
+  class keeps the delay constant.
+  """
+
+  def sleepFor(self, delay, minSleep, maxSleep): # pylint: disable=W0613
+    """Returns how many seconds to sleep when the delay is the given number of seconds."""
+    return delay
+
+
+  def nextDelay(self, delay, minSleep, maxSleep): # pylint: disable=W0613
+    """Returns the delay to use after sleeping with the given delay."""
+    return delay
+
+
+
+class LinearBackoff(Backoff):
+  """Adds increment seconds to the delay after each sleep."""
+
+  def __init__(self, increment):
+    self.increment = increment
+
+
+  def nextDelay(self, delay, minSleep, maxSleep):
+    """Returns the delay to use after sleeping with the given delay."""
+    return min(delay + self.increment, maxSleep)
+
+
+
+class ExponentialBackoff(Backoff):
+  """Multiplies the delay by factor after each sleep.  Sleeps for exactly the delay."""
+
+  def __init__(self, factor = 2):
+    self.factor = factor
+
+
+  def nextDelay(self, delay, minSleep, maxSleep):
+    """Returns the delay to use after sleeping with the given delay."""
+    return min(delay * self.factor, maxSleep)
+
+
+
+class FullJitterBackoff(ExponentialBackoff):
+  """Grows the delay exponentially, but sleeps for a random time between zero and the delay.
+
+  Spreads retries from clients that failed together the most, at the cost of some retrying almost immediately.
+  """
+
+  def sleepFor(self, delay, minSleep, maxSleep):
+    """Returns how many seconds to sleep when the delay is the given number of seconds."""
+    return random.uniform(0, delay)
+
+
+
+class EqualJitterBackoff(ExponentialBackoff):
+  """Grows the delay exponentially, and sleeps for half the delay plus a random time up to the other half."""
+
+  def sleepFor(self, delay, minSleep, maxSleep):
+    """Returns how many seconds to sleep when the delay is the given number of seconds."""
+    return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+
+
+class DecorrelatedJitterBackoff(Backoff):
+  """Picks each delay at random between minSleep and three times the previous delay.
+
+  The delay grows about as fast as exponential backoff, but clients that failed together drift apart.
+  """
+
+  def nextDelay(self, delay, minSleep, maxSleep):
+    """Returns the delay to use after sleeping with the given delay."""
+    return min(random.uniform(minSleep, delay * 3), maxSleep)
+
+
+
 class SleepManager(object):
   """Manages the amount of time to sleep between iterations of a task."""
 
-  def __init__(self, minSleep = 60, maxSleep = 60 * 10, increment = 60, jitter = 0):
+  def __init__(self, minSleep = 60, maxSleep = 60 * 10, increment = 60, jitter = 0, backoff = None):
     """Initializes the SleepManager.
 
     Args:
@@ -83,11 +161,14 @@ class SleepManager(object):
       increment: the number of seconds to increase the delay each time
       jitter: if non-zero, a random floating point number of seconds up to this number will be added to the delay.
               This is useful to help prevent many separate SleepManager objects from getting in sync.
+      backoff: a Backoff that controls how the delay grows, such as DecorrelatedJitterBackoff.  Defaults to
+               LinearBackoff(increment).
     """
     self.__minSleep = minSleep
     self.__maxSleep = maxSleep
     self.__increment = increment
     self.__jitter = jitter
+    self.__backoff = backoff or LinearBackoff(increment)
     self.delay = self.__minSleep
 
 
@@ -96,18 +177,27 @@ class SleepManager(object):
     self.delay = self.__minSleep
 
 
-  def sleep(self):
-    """Returns a deferred that sleeps the current amount of delay."""
-    delayTime = self.delay
+  def nextSleep(self):
+    """Returns the number of seconds to sleep next, and advances the delay.
+
+    A zero sleep does not advance the delay, so a manager started at 0 stays at 0 as it always has.
+    """
+    delayTime = self.__backoff.sleepFor(self.delay, self.__minSleep, self.__maxSleep)
     if self.__jitter:
       delayTime += random.random() * self.__jitter
+    if delayTime:
+      self.delay = self.__backoff.nextDelay(self.delay, self.__minSleep, self.__maxSleep)
+    return delayTime
+
+
+  def sleep(self):
+    """Returns a deferred that sleeps the current amount of delay."""
+    delayTime = self.nextSleep()
     if not delayTime:
       return defer.succeed(None)
-    d = sleep(delayTime)
-    self.delay = min(self.delay + self.__increment, self.__maxSleep)
-    return d
+    return sleep(delayTime)
 
 
   def clone(self):
     """Clones this object."""
-    return SleepManager(self.__minSleep, self.__maxSleep, self.__increment, self.__jitter)
+    return SleepManager(self.__minSleep, self.__maxSleep, self.__increment, self.__jitter, self.__backoff)
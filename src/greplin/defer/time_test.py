@@ -0,0 +1,99 @@
+# Copyright 2012 The greplin-twisted-utils Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for SleepManager and its backoff policies."""
+
+from greplin.defer import time
+
+import random
+import unittest
+
+
+
+class SleepManagerTest(unittest.TestCase):
+  """Tests for SleepManager."""
+
+  def sleeps(self, manager, count):
+    """Returns the next count sleeps of the given manager."""
+    return [manager.nextSleep() for _ in range(count)]
+
+
+  def testLinear(self):
+    """Test the default linear backoff."""
+    manager = time.SleepManager(1, 4, 2)
+    self.assertEquals([1, 3, 4, 4], self.sleeps(manager, 4))
+    manager.reset()
+    self.assertEquals(1, manager.nextSleep())
+
+
+  def testZeroDelay(self):
+    """Test that a zero delay never grows."""
+    manager = time.SleepManager(0, 100, 10)
+    self.assertEquals([0, 0, 0], self.sleeps(manager, 3))
+    self.assertEquals(0, manager.delay)
+
+
+  def testConstant(self):
+    """Test that the base backoff keeps the delay constant."""
+    manager = time.SleepManager(2, 10, backoff=time.Backoff())
+    self.assertEquals([2, 2, 2], self.sleeps(manager, 3))
+
+
+  def testExponential(self):
+    """Test exponential backoff."""
+    manager = time.SleepManager(1, 10, backoff=time.ExponentialBackoff(3))
+    self.assertEquals([1, 3, 9, 10], self.sleeps(manager, 4))
+
+
+  def testFullJitter(self):
+    """Test that full jitter sleeps between zero and the exponential delay."""
+    manager = time.SleepManager(1, 8, backoff=time.FullJitterBackoff())
+    for limit in (1, 2, 4, 8, 8):
+      self.assertTrue(0 <= manager.nextSleep() <= limit)
+
+
+  def testEqualJitter(self):
+    """Test that equal jitter sleeps between half and all of the exponential delay."""
+    manager = time.SleepManager(2, 16, backoff=time.EqualJitterBackoff())
+    for limit in (2, 4, 8, 16, 16):
+      self.assertTrue(limit / 2.0 <= manager.nextSleep() <= limit)
+
+
+  def testDecorrelatedJitter(self):
+    """Test that decorrelated jitter stays between the minimum and three times the previous sleep."""
+    manager = time.SleepManager(1, 100, backoff=time.DecorrelatedJitterBackoff())
+    previous = manager.nextSleep()
+    self.assertEquals(1, previous)
+    for _ in range(20):
+      current = manager.nextSleep()
+      self.assertTrue(1 <= current <= min(100, previous * 3))
+      previous = current
+
+
+  def testJitterSpreadsClients(self):
+    """Test that clients that start together drift apart."""
+    random.seed(1)
+    managers = [time.SleepManager(1, 60, backoff=time.DecorrelatedJitterBackoff()) for _ in range(10)]
+    for manager in managers:
+      self.sleeps(manager, 3)
+    self.assertEquals(10, len(set(manager.nextSleep() for manager in managers)))
+
+
+  def testClone(self):
+    """Test that clones share the backoff policy but not the delay."""
+    manager = time.SleepManager(1, 10, backoff=time.ExponentialBackoff())
+    manager.nextSleep()
+    clone = manager.clone()
+    self.assertEquals([1, 2], self.sleeps(clone, 2))
+    self.assertEquals(2, manager.nextSleep())
@@ -16,74 +16,456 @@
 
 from greplin.defer import lazymap
 
-from twisted.internet import defer, interfaces
-from twisted.python.failure import Failure
+from twisted.internet import defer, error, interfaces, task
+from twisted.names import dns
 
 from zope.interface import implements
 
 import collections
-import time
+import json
+import logging
+import os
+import random
+import socket
+
+
+FIRST = 'first'
+
+ROUND_ROBIN = 'roundRobin'
+
+RANDOM = 'random'
+
+
+
+class HeavyHitters(object):
+  """Approximate counts for the most frequent keys, using a fixed amount of memory (the Space-Saving algorithm).
+
+  At most size keys are tracked, so a size of 0 tracks nothing.  When a new key arrives and the table is full, it replaces a key with the lowest
+  count and inherits that count, so counts are upper bounds.  Any key seen more than total / size times is tracked.
+  Keys are grouped into buckets by count, so each add takes constant time however many keys are tracked.
+  """
+
+  def __init__(self, size):
+    self.__size = size
+    self.__counts = {} # Key -> count.
+    self.__buckets = {} # Count -> set of keys with that count.
+    self.__minCount = 0
+
+
+  def add(self, key):
+    """Counts an occurrence of the given key.  Does nothing if size is 0."""
+    if self.__size < 1:
+      return
+    counts = self.__counts
+    count = counts.get(key)
+    if count is not None:
+      self.__unlink(key, count)
+    elif len(counts) < self.__size:
+      count = 0
+      self.__minCount = 1
+    else:
+      count = self.__minCount
+      smallest = self.__buckets[count].pop()
+      del counts[smallest]
+      if not self.__buckets[count]:
+        del self.__buckets[count]
+        self.__minCount = count + 1
+
+    counts[key] = count + 1
+    self.__buckets.setdefault(count + 1, set()).add(key)
+
+
+  def __unlink(self, key, count):
+    """Removes the given key from the bucket for its count."""
+    bucket = self.__buckets[count]
+    bucket.remove(key)
+    if not bucket:
+      del self.__buckets[count]
+      if count == self.__minCount:
+        self.__minCount = count + 1
+
+
+  def getCounts(self):
+    """Returns a dict of the tracked keys and their counts."""
+    return dict(self.__counts)
+
+
+
+class HostAddresses(object):
+  """The addresses found for a name, and how many seconds they may be cached for, or None to use the default."""
+
+  __slots__ = ('addresses', 'ttl', 'turn')
+
+
+  def __init__(self, addresses, ttl=None):
+    self.addresses = addresses
+    self.ttl = ttl
+    self.turn = 0
+
+
+
+def addressesFromRecords(answers, minTtl=0, maxTtl=None):
+  """Gets the addresses in the given answer records.
+
+  A records come before AAAA records.  The ttl is the lowest ttl of all the answers, including the CNAMEs that led to
+  the addresses, clamped to minTtl and maxTtl.  Raises DNSLookupError if there are no addresses.
+  """
+  ipv4 = []
+  ipv6 = []
+  ttl = None
+  for record in answers:
+    if record.type == dns.A:
+      ipv4.append(record.payload.dottedQuad())
+    elif record.type == dns.AAAA:
+      ipv6.append(socket.inet_ntop(socket.AF_INET6, record.payload.address))
+    elif record.type != dns.CNAME:
+      continue
+    ttl = record.ttl if ttl is None else min(ttl, record.ttl)
+
+  addresses = tuple(ipv4 + ipv6)
+  if not addresses:
+    raise error.DNSLookupError('No addresses found')
+  ttl = max(ttl, minTtl)
+  if maxTtl is not None:
+    ttl = min(ttl, maxTtl)
+  return HostAddresses(addresses, ttl)
+
+
+
+def _fromJson(value):
+  """Converts lists loaded from JSON back to the tuples they were saved from, so they can be used as keys."""
+  if isinstance(value, list):
+    return tuple(_fromJson(item) for item in value)
+  if isinstance(value, unicode):
+    return value.encode('utf-8')
+  return value
+
+
+
+class _FallbackStore(object):
+  """Last known addresses for hosts, bounded in size and age."""
+
+  def __init__(self, maxSize, maxAge, clock):
+    self.__maxSize = maxSize
+    self.__maxAge = maxAge
+    self.__clock = clock
+    self.__entries = collections.OrderedDict() # Key -> (address, time stored), least recently stored first.
+
+
+  def __setitem__(self, key, address):
+    """Stores the address for the given key, dropping the oldest entries if the store is full."""
+    self.set(key, address, self.__clock.seconds())
+
+
+  def set(self, key, address, stored):
+    """Stores the address for the given key as if it was stored at the given time, unless that is too long ago."""
+    if self.__maxAge is not None and self.__clock.seconds() - stored > self.__maxAge:
+      return
+    self.__entries.pop(key, None)
+    self.__entries[key] = (address, stored)
+    while len(self.__entries) > self.__maxSize:
+      self.__entries.popitem(last=False)
+
+
+  def __getitem__(self, key):
+    """Gets the address for the given key, raising KeyError if there is none or it is too old."""
+    address, stored = self.__entries[key]
+    if self.__maxAge is not None and self.__clock.seconds() - stored > self.__maxAge:
+      raise KeyError(key)
+    return address
+
+
+  def __len__(self):
+    """Returns the number of stored entries."""
+    return len(self.__entries)
+
+
+  def items(self):
+    """Returns a list of (key, address, time stored) for the entries that are not too old, oldest first."""
+    now = self.__clock.seconds()
+    result = [(key, address, stored) for key, (address, stored) in self.__entries.iteritems()
+              if self.__maxAge is None or now - stored <= self.__maxAge]
+    result.sort(key=lambda item: item[2])
+    return result
 
 
 
 class CachingDNS(object):
-  """DNS resolver that uses a short lived local cache to improve performance."""
+  """DNS resolver that uses a short lived local cache to improve performance.
+
+  Memory use is bounded: at most maxSize names are cached and fallbackMaxSize fallback addresses are kept, fallback
+  addresses older than fallbackMaxAge seconds are not used, and per host stats are only kept for the topHosts most
+  frequent names in each category.
+
+  Names are cached for timeout seconds.  Once a name is in the last refreshAhead fraction of that time, lookups still
+  return the cached address immediately but also start a single background lookup to refresh it, so names that are
+  used often never wait for a lookup.  Failures are not cached.
+
+  If useRecordTtl is true, original must be a full twisted.names IResolver rather than an IResolverSimple.  Names are
+  then looked up with lookupAddress (and lookupIPV6Address if ipv6 is true) and cached for the ttl of the returned
+  records, clamped to between minTtl and maxTtl seconds, instead of for timeout seconds.  getAllHostsByName returns
+  every address found for a name, IPv4 addresses first.
+
+  When a name has several addresses, getHostByName picks one according to selection: FIRST always returns the first,
+  ROUND_ROBIN cycles through them and RANDOM picks one at random.  Callers can report addresses they failed to connect
+  to with reportFailure, which demotes the address for demoteFor seconds: it is not picked while any address of the
+  same name is healthy, and getAllHostsByName lists it last.  reportSuccess restores an address straight away.
+
+  If snapshotPath is given, the cached names and fallback addresses are loaded from that file on startup and saved to
+  it every snapshotInterval seconds, so a restarted process does not have to resolve every name again before it can
+  serve.  Loaded names expire when they would have in the process that saved them, and names that have already expired
+  are only used as fallbacks, subject to fallbackMaxAge.
+  """
   implements(interfaces.IResolverSimple)
 
 
-  def __init__(self, original, timeout = 60, useFallback = True):
+  def __init__(self, original, timeout = 60, useFallback = True, maxSize = 100000, fallbackMaxSize = 100000,
+               fallbackMaxAge = None, topHosts = 100, refreshAhead = 0.1, useRecordTtl = False, minTtl = 0,
+               maxTtl = 3600, ipv6 = False, selection = FIRST, demoteFor = 30, snapshotPath = None,
+               snapshotInterval = 300, clock = None):
+    if clock is None:
+      from twisted.internet import reactor
+      clock = reactor
     self._original = original
+    self._clock = clock
+    self._selection = selection
+    self._demoteFor = demoteFor
+    self._demoted = {} # Address -> time the demotion ends.
+    self._maxDemoted = maxSize
     self._timeout = timeout
-    self._fallback = {} if useFallback else None
-    self._cache = lazymap.DeferredMap(self.__fetchHost)
-    self._stats = {
-      'miss': collections.defaultdict(int),
-      'hit': collections.defaultdict(int),
-      'error': collections.defaultdict(int),
-      'fallback': collections.defaultdict(int),
-    }
+    self._refreshAhead = refreshAhead
+    self._minTtl = minTtl
+    self._maxTtl = maxTtl
+    self._ipv6 = ipv6
+    self._fallback = _FallbackStore(fallbackMaxSize, fallbackMaxAge, clock) if useFallback else None
+    self._cache = lazymap.DeferredMap(self.__fetchRecords if useRecordTtl else self.__fetchHost, maxSize=maxSize,
+                                      ttl=self.__freshFor, maxStale=self.__staleFor, failureTtl=0, clock=clock)
+    self._totals = dict.fromkeys(('miss', 'hit', 'error', 'fallback'), 0)
+    self._stats = dict((name, HeavyHitters(topHosts)) for name in self._totals)
+    self._snapshotCall = None
+    if snapshotPath is not None:
+      if os.path.exists(snapshotPath):
+        try:
+          self.loadSnapshot(snapshotPath)
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+          logging.warning('Ignoring unreadable DNS cache snapshot %s', snapshotPath, exc_info = True)
+      self._snapshotCall = task.LoopingCall(self.__saveSnapshotPeriodically, snapshotPath)
+      self._snapshotCall.clock = clock
+      self._snapshotCall.start(snapshotInterval, now=False)
+
+
+  def __count(self, name, key):
+    """Counts an event for the given key."""
+    self._totals[name] += 1
+    self._stats[name].add(str(key))
+
+
+  def __lifetime(self, hosts):
+    """Returns how many seconds the given addresses may be cached for."""
+    return self._timeout if hosts.ttl is None else hosts.ttl
+
+
+  def __freshFor(self, _, hosts):
+    """Returns how many seconds the given addresses are used before being refreshed."""
+    return self.__lifetime(hosts) * (1 - self._refreshAhead)
+
+
+  def __staleFor(self, _, hosts):
+    """Returns how many seconds the given addresses are still used while being refreshed."""
+    return self.__lifetime(hosts) * self._refreshAhead
 
 
   def __fetchHost(self, args):
     """Actually fetches the host name."""
-    return self._original.getHostByName(*args).addCallback(lambda x: (x, time.time()))
+    result = self._original.getHostByName(*args).addCallback(lambda address: HostAddresses((address,)))
+    return result.addCallback(self.__fetchedHost, args)
+
+
+  def __fetchRecords(self, args):
+    """Actually fetches the address records for the host name."""
+    lookups = [self._original.lookupAddress(*args)]
+    if self._ipv6:
+      lookups.append(self._original.lookupIPV6Address(*args))
+    result = defer.DeferredList(lookups, consumeErrors=True).addCallback(self.__gotRecords)
+    return result.addCallback(self.__fetchedHost, args)
+
+
+  def __gotRecords(self, results):
+    """Combines the answers to the address lookups, failing only if none of them found an address."""
+    answers = []
+    for success, result in results:
+      if success:
+        answers.extend(result[0])
+    try:
+      return addressesFromRecords(answers, self._minTtl, self._maxTtl)
+    except error.DNSLookupError:
+      for success, result in results:
+        if not success:
+          return result
+      raise
+
+
+  def __fetchedHost(self, hosts, key):
+    """Records newly fetched addresses as the fallback for the given key."""
+    if self._fallback is not None:
+      self._fallback[key] = hosts
+    return hosts
 
 
   def __fallback(self, err, key):
     """Returns the fallback for the given key."""
+    if self._fallback is not None:
+      try:
+        result = self._fallback[key]
+      except KeyError:
+        pass
+      else:
+        self.__count('fallback', key)
+        return result
+    self.__count('error', key)
+    return err
+
+
+  def saveSnapshot(self, path):
+    """Saves the cached names and fallback addresses to the given file."""
+    cache = []
+    for key, value in dict.iteritems(self._cache):
+      expiry = self._cache.getExpiry(key)
+      if isinstance(value, HostAddresses) and expiry is not None:
+        cache.append((key, value.addresses, expiry))
+    fallback = []
+    if self._fallback is not None:
+      fallback = [(key, hosts.addresses, stored) for key, hosts, stored in self._fallback.items()]
+
+    temporaryPath = path + '.tmp'
+    with open(temporaryPath, 'w') as f:
+      json.dump({'cache': cache, 'fallback': fallback}, f)
+      f.flush()
+      os.fsync(f.fileno())
+    os.rename(temporaryPath, path)
+
+
+  def loadSnapshot(self, path):
+    """Loads cached names and fallback addresses saved by saveSnapshot.
+
+    The whole file is read before anything is loaded, so a truncated or corrupt snapshot raises an error without
+    changing the cache.
+    """
+    with open(path) as f:
+      snapshot = json.load(f)
+    fallback = [(_fromJson(key), HostAddresses(_fromJson(addresses)), float(stored))
+                for key, addresses, stored in snapshot['fallback']]
+    cache = [(_fromJson(key), HostAddresses(_fromJson(addresses)), float(expiry))
+             for key, addresses, expiry in snapshot['cache']]
+
+    now = self._clock.seconds()
+    if self._fallback is not None:
+      for key, hosts, stored in fallback:
+        self._fallback.set(key, hosts, stored)
+    for key, hosts, expiry in cache:
+      if expiry > now:
+        hosts.ttl = expiry - now
+        self._cache[key] = hosts
+
+
+  def stopSnapshots(self):
+    """Stops saving snapshots periodically."""
+    if self._snapshotCall is not None and self._snapshotCall.running:
+      self._snapshotCall.stop()
+
+
+  def __saveSnapshotPeriodically(self, path):
+    """Saves a snapshot, logging rather than raising errors so that the next snapshot still happens."""
     try:
-      result = self._fallback[key]
-      self._stats['fallback'][str(key)] += 1
-      return result
-    except KeyError:
-      self._stats['error'][str(key)] += 1
-      return err
+      self.saveSnapshot(path)
+    except (IOError, OSError):
+      logging.warning('Failed to save DNS cache snapshot to %s', path, exc_info = True)
 
 
   def getStats(self):
-    """Gets stats about hits / misses / failures."""
-    return self._stats
+    """Gets stats about hits / misses / failures for the most frequent hosts."""
+    return dict((name, hitters.getCounts()) for name, hitters in self._stats.iteritems())
+
+
+  def getTotals(self):
+    """Gets the total number of hits / misses / failures."""
+    return dict(self._totals)
+
+
+  def reportFailure(self, address):
+    """Demotes an address that could not be connected to."""
+    now = self._clock.seconds()
+    if len(self._demoted) >= self._maxDemoted:
+      for demoted, until in self._demoted.items():
+        if until <= now:
+          del self._demoted[demoted]
+      if len(self._demoted) >= self._maxDemoted:
+        return
+    self._demoted[address] = now + self._demoteFor
+
+
+  def reportSuccess(self, address):
+    """Restores an address that was connected to successfully."""
+    self._demoted.pop(address, None)
+
+
+  def __partition(self, addresses):
+    """Splits addresses into those that are healthy and those that are demoted."""
+    if not self._demoted:
+      return addresses, ()
+    now = self._clock.seconds()
+    healthy = []
+    demoted = []
+    for address in addresses:
+      until = self._demoted.get(address)
+      if until is None:
+        healthy.append(address)
+      elif until <= now:
+        del self._demoted[address]
+        healthy.append(address)
+      else:
+        demoted.append(address)
+    return healthy, demoted
+
+
+  def __choose(self, hosts):
+    """Picks one of the given addresses."""
+    addresses = hosts.addresses
+    if len(addresses) > 1:
+      addresses = self.__partition(addresses)[0] or addresses
+    if self._selection == ROUND_ROBIN:
+      address = addresses[hosts.turn % len(addresses)]
+      hosts.turn += 1
+      return address
+    if self._selection == RANDOM:
+      return random.choice(addresses)
+    return addresses[0]
+
+
+  def __ordered(self, hosts):
+    """Returns the given addresses with the demoted ones last."""
+    healthy, demoted = self.__partition(hosts.addresses)
+    return tuple(healthy) + tuple(demoted)
+
+
+  def __lookup(self, name, args, callback):
+    """Looks up a host by name, returning a deferred that fires with callback applied to its HostAddresses."""
+    key = (name,) + args
+    result = self._cache[key]
+    if isinstance(result, defer.Deferred):
+      self.__count('miss', key)
+      return result.addErrback(self.__fallback, key).addCallback(callback)
+
+    # The item was in cache and not expired, so return it immediately.
+    self.__count('hit', key)
+    return defer.succeed(callback(result))
 
 
   def getHostByName(self, name, *args):
     """Gets a host by name."""
-    key = (name,) + args
-    if key in self._cache:
-      # If we failed last time, try again
-      if isinstance(self._cache[key], Failure):
-        del self._cache[key]
-      # Check for a cache hit.
-      elif time.time() >= self._cache[key][1] + self._timeout:
-        # Ensure the item hasn't expired.
-        if self._fallback is not None:
-          self._fallback[key] = self._cache[key][0]
-        del self._cache[key]
-      else:
-        # If the item is in cache and not expired, return it immediately.
-        self._stats['hit'][str(key)] += 1
-        return defer.succeed(self._cache[key][0])
+    return self.__lookup(name, args, self.__choose)
 
-    # If it wasn't already in the cache, this always returns a deferred.
-    result = self._cache[key].addCallback(lambda x: x[0]).addErrback(self.__fallback, key)
-    self._stats['miss'][str(key)] += 1
-    return result
+
+  def getAllHostsByName(self, name, *args):
+    """Gets all the addresses for a host name."""
+    return self.__lookup(name, args, self.__ordered)
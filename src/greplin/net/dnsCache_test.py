@@ -15,11 +15,15 @@
 """DNS resolver that uses a short lived local cache to improve performance."""
 
 import mox
+import os
+import shutil
+import tempfile
 import unittest
 
 from greplin.net import dnsCache
 
-from twisted.internet import defer, error
+from twisted.internet import defer, error, task
+from twisted.names import dns
 from twisted.python import failure
 
 
@@ -86,3 +90,344 @@ class CachingDNSTest(unittest.TestCase):
     result = cache.getHostByName('google.com')
     self.assertEquals(result.result, '9.8.7.6')
     mox.Verify(original)
+
+
+  def testBounded(self):
+    """Test that the cache, fallbacks and stats stay bounded."""
+    original = mox.MockAnything()
+    for i in range(5):
+      original.getHostByName('host%d.com' % i).AndReturn(defer.succeed('1.2.3.%d' % i))
+    mox.Replay(original)
+
+    cache = dnsCache.CachingDNS(original, maxSize=2, topHosts=2)
+    for i in range(5):
+      self.assertEquals('1.2.3.%d' % i, cache.getHostByName('host%d.com' % i).result)
+    self.assertEquals('1.2.3.4', cache.getHostByName('host4.com').result)
+    mox.Verify(original)
+
+    self.assertEquals(2, len(cache._cache)) # pylint: disable=W0212
+    self.assertEquals({'miss': 5, 'hit': 1, 'error': 0, 'fallback': 0}, cache.getTotals())
+    stats = cache.getStats()
+    self.assertEquals(2, len(stats['miss']))
+    self.assertEquals({str(('host4.com',)): 1}, stats['hit'])
+
+
+  def testFallbackMaxAge(self):
+    """Test that old fallback addresses are not used."""
+    original = mox.MockAnything()
+    original.getHostByName('google.com').AndReturn(
+        defer.succeed('1.2.3.4'))
+    original.getHostByName('google.com').AndReturn(
+        defer.fail(failure.Failure(error.DNSLookupError('Fake DNS failure'))))
+    mox.Replay(original)
+
+    cache = dnsCache.CachingDNS(original, timeout = 0, fallbackMaxAge = -1)
+    self.assertEquals('1.2.3.4', cache.getHostByName('google.com').result)
+    result = cache.getHostByName('google.com')
+    self.assertTrue(isinstance(result.result, failure.Failure))
+    result.addErrback(lambda _: None) # Consume the error.
+    self.assertEquals(1, cache.getTotals()['error'])
+    mox.Verify(original)
+
+
+  def testRefreshAhead(self):
+    """Test that names close to expiry are refreshed in the background."""
+    original = mox.MockAnything()
+    original.getHostByName('google.com').AndReturn(defer.succeed('1.2.3.4'))
+    refresh = defer.Deferred()
+    original.getHostByName('google.com').AndReturn(refresh)
+    original.getHostByName('google.com').AndReturn(defer.succeed('5.6.7.8'))
+    mox.Replay(original)
+
+    clock = task.Clock()
+    cache = dnsCache.CachingDNS(original, timeout = 10, refreshAhead = 0.2, clock = clock)
+    self.assertEquals('1.2.3.4', cache.getHostByName('google.com').result)
+
+    clock.advance(7)
+    self.assertEquals('1.2.3.4', cache.getHostByName('google.com').result)
+
+    clock.advance(1)
+    self.assertEquals('1.2.3.4', cache.getHostByName('google.com').result)
+    self.assertEquals('1.2.3.4', cache.getHostByName('google.com').result)
+    refresh.callback('9.8.7.6')
+    self.assertEquals('9.8.7.6', cache.getHostByName('google.com').result)
+    self.assertEquals({'miss': 1, 'hit': 4, 'error': 0, 'fallback': 0}, cache.getTotals())
+
+    clock.advance(10)
+    self.assertEquals('5.6.7.8', cache.getHostByName('google.com').result)
+    mox.Verify(original)
+
+
+
+def _answers(*records):
+  """Returns the result of a lookup that found the given (type, ttl, address) answers."""
+  answers = []
+  for recordType, ttl, address in records:
+    payload = {
+      dns.A: dns.Record_A,
+      dns.AAAA: dns.Record_AAAA,
+      dns.CNAME: dns.Record_CNAME
+    }[recordType](address, ttl)
+    answers.append(dns.RRHeader('google.com', recordType, ttl=ttl, payload=payload))
+  return defer.succeed((answers, [], []))
+
+
+
+class RecordTtlTest(unittest.TestCase):
+  """Tests for caching DNS using record ttls."""
+
+  def testRecordTtl(self):
+    """Test that names are cached for the ttl of their records."""
+    original = mox.MockAnything()
+    original.lookupAddress('google.com').AndReturn(
+        _answers((dns.CNAME, 300, 'www.google.com'), (dns.A, 30, '1.2.3.4'), (dns.A, 60, '1.2.3.5')))
+    original.lookupIPV6Address('google.com').AndReturn(_answers((dns.AAAA, 20, '::1')))
+    original.lookupAddress('google.com').AndReturn(_answers((dns.A, 100, '5.6.7.8')))
+    original.lookupIPV6Address('google.com').AndReturn(
+        defer.fail(failure.Failure(error.DNSLookupError('Fake DNS failure'))))
+    mox.Replay(original)
+
+    clock = task.Clock()
+    cache = dnsCache.CachingDNS(original, timeout = 1, useRecordTtl = True, ipv6 = True, refreshAhead = 0,
+                                clock = clock)
+    self.assertEquals(['1.2.3.4', '1.2.3.5', '::1'], list(cache.getAllHostsByName('google.com').result))
+    clock.advance(19)
+    self.assertEquals('1.2.3.4', cache.getHostByName('google.com').result)
+    clock.advance(2)
+    self.assertEquals('5.6.7.8', cache.getHostByName('google.com').result)
+    mox.Verify(original)
+
+
+  def testClamped(self):
+    """Test that record ttls are clamped."""
+    original = mox.MockAnything()
+    original.lookupAddress('google.com').AndReturn(_answers((dns.A, 0, '1.2.3.4')))
+    original.lookupAddress('google.com').AndReturn(_answers((dns.A, 86400, '5.6.7.8')))
+    original.lookupAddress('google.com').AndReturn(_answers((dns.A, 86400, '9.8.7.6')))
+    mox.Replay(original)
+
+    clock = task.Clock()
+    cache = dnsCache.CachingDNS(original, useRecordTtl = True, minTtl = 5, maxTtl = 100, refreshAhead = 0,
+                                clock = clock)
+    self.assertEquals('1.2.3.4', cache.getHostByName('google.com').result)
+    clock.advance(4)
+    self.assertEquals('1.2.3.4', cache.getHostByName('google.com').result)
+    clock.advance(2)
+    self.assertEquals('5.6.7.8', cache.getHostByName('google.com').result)
+    clock.advance(99)
+    self.assertEquals('5.6.7.8', cache.getHostByName('google.com').result)
+    clock.advance(2)
+    self.assertEquals('9.8.7.6', cache.getHostByName('google.com').result)
+    mox.Verify(original)
+
+
+  def testNoAddresses(self):
+    """Test lookups that find no addresses."""
+    original = mox.MockAnything()
+    original.lookupAddress('google.com').AndReturn(_answers((dns.CNAME, 300, 'www.google.com')))
+    original.lookupAddress('google.com').AndReturn(
+        defer.fail(failure.Failure(error.DNSLookupError('Fake DNS failure'))))
+    mox.Replay(original)
+
+    cache = dnsCache.CachingDNS(original, useRecordTtl = True)
+    result = cache.getHostByName('google.com')
+    self.assertTrue(result.result.check(error.DNSLookupError))
+    result.addErrback(lambda _: None) # Consume the error.
+    result = cache.getHostByName('google.com')
+    self.assertTrue('Fake DNS failure' in result.result.getErrorMessage())
+    result.addErrback(lambda _: None) # Consume the error.
+    self.assertEquals(2, cache.getTotals()['error'])
+    mox.Verify(original)
+
+
+
+class SelectionTest(unittest.TestCase):
+  """Tests for picking between the addresses of a name."""
+
+  def setUp(self):
+    original = mox.MockAnything()
+    original.lookupAddress('google.com').AndReturn(
+        _answers((dns.A, 60, '1.2.3.4'), (dns.A, 60, '1.2.3.5'), (dns.A, 60, '1.2.3.6')))
+    mox.Replay(original)
+    self.original = original
+    self.clock = task.Clock()
+
+
+  def tearDown(self):
+    mox.Verify(self.original)
+
+
+  def lookup(self, cache, count):
+    """Looks up google.com count times."""
+    return [cache.getHostByName('google.com').result for _ in range(count)]
+
+
+  def testFirst(self):
+    """Test always using the first address."""
+    cache = dnsCache.CachingDNS(self.original, useRecordTtl = True, clock = self.clock)
+    self.assertEquals(['1.2.3.4'] * 3, self.lookup(cache, 3))
+
+
+  def testRoundRobin(self):
+    """Test cycling through the addresses."""
+    cache = dnsCache.CachingDNS(self.original, useRecordTtl = True, selection = dnsCache.ROUND_ROBIN,
+                                clock = self.clock)
+    self.assertEquals(['1.2.3.4', '1.2.3.5', '1.2.3.6', '1.2.3.4'], self.lookup(cache, 4))
+
+
+  def testRandom(self):
+    """Test picking addresses at random."""
+    cache = dnsCache.CachingDNS(self.original, useRecordTtl = True, selection = dnsCache.RANDOM, clock = self.clock)
+    self.assertEquals(set(['1.2.3.4', '1.2.3.5', '1.2.3.6']), set(self.lookup(cache, 100)))
+
+
+  def testDemoted(self):
+    """Test that addresses that failed are avoided until they recover."""
+    cache = dnsCache.CachingDNS(self.original, useRecordTtl = True, selection = dnsCache.ROUND_ROBIN,
+                                demoteFor = 10, clock = self.clock)
+    cache.reportFailure('1.2.3.5')
+    self.assertEquals(['1.2.3.4', '1.2.3.6', '1.2.3.4'], self.lookup(cache, 3))
+    self.assertEquals(('1.2.3.4', '1.2.3.6', '1.2.3.5'), cache.getAllHostsByName('google.com').result)
+
+    cache.reportFailure('1.2.3.4')
+    cache.reportFailure('1.2.3.6')
+    self.assertEquals(3, len(set(self.lookup(cache, 3))))
+
+    cache.reportSuccess('1.2.3.6')
+    self.assertEquals(['1.2.3.6'] * 2, self.lookup(cache, 2))
+
+    self.clock.advance(10)
+    self.assertEquals(3, len(set(self.lookup(cache, 3))))
+
+
+
+class SnapshotTest(unittest.TestCase):
+  """Tests for saving and loading cache snapshots."""
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir, 'dns.json')
+
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+
+  def testWarmStart(self):
+    """Test that a new cache starts with the names saved by an old one."""
+    original = mox.MockAnything()
+    original.getHostByName('a.com').AndReturn(defer.succeed('1.2.3.4'))
+    original.getHostByName('b.com').AndReturn(defer.succeed('5.6.7.8'))
+    original.getHostByName('a.com').AndReturn(
+        defer.fail(failure.Failure(error.DNSLookupError('Fake DNS failure'))))
+    original.getHostByName('b.com').AndReturn(defer.succeed('9.8.7.6'))
+    mox.Replay(original)
+
+    clock = task.Clock()
+    clock.advance(1000)
+    cache = dnsCache.CachingDNS(original, refreshAhead = 0, snapshotPath = self.path, snapshotInterval = 10,
+                                clock = clock)
+    self.assertEquals('1.2.3.4', cache.getHostByName('a.com').result)
+    clock.advance(40)
+    self.assertEquals('5.6.7.8', cache.getHostByName('b.com').result)
+    clock.advance(10)
+    cache.stopSnapshots()
+
+    clock.advance(20)
+    cache = dnsCache.CachingDNS(original, refreshAhead = 0, snapshotPath = self.path, clock = clock)
+    cache.stopSnapshots()
+    self.assertEquals('5.6.7.8', cache.getHostByName('b.com').result)
+    self.assertEquals('1.2.3.4', cache.getHostByName('a.com').result)
+    self.assertEquals({'miss': 1, 'hit': 1, 'error': 0, 'fallback': 1}, cache.getTotals())
+
+    clock.advance(31)
+    self.assertEquals('9.8.7.6', cache.getHostByName('b.com').result)
+    mox.Verify(original)
+
+
+  def testCorruptSnapshot(self):
+    """Test that a cache starts empty rather than failing if its snapshot is unreadable."""
+    original = mox.MockAnything()
+    original.getHostByName('a.com').AndReturn(defer.succeed('1.2.3.4'))
+    mox.Replay(original)
+
+    with open(self.path, 'w') as f:
+      f.write('{"cache": [["a.com", ["5.6.7.8"], 10')
+    cache = dnsCache.CachingDNS(original, snapshotPath = self.path, clock = task.Clock())
+    cache.stopSnapshots()
+    self.assertEquals('1.2.3.4', cache.getHostByName('a.com').result)
+    mox.Verify(original)
+
+
+  def testFallbackMaxAge(self):
+    """Test that fallback addresses that are too old are not loaded."""
+    original = mox.MockAnything()
+    original.getHostByName('a.com').AndReturn(defer.succeed('1.2.3.4'))
+    mox.Replay(original)
+
+    clock = task.Clock()
+    cache = dnsCache.CachingDNS(original, fallbackMaxAge = 100, clock = clock)
+    self.assertEquals('1.2.3.4', cache.getHostByName('a.com').result)
+    cache.saveSnapshot(self.path)
+
+    clock.advance(100)
+    cache = dnsCache.CachingDNS(original, fallbackMaxAge = 100, clock = clock)
+    cache.loadSnapshot(self.path)
+    self.assertEquals(1, len(cache._fallback)) # pylint: disable=W0212
+
+    clock.advance(1)
+    cache = dnsCache.CachingDNS(original, fallbackMaxAge = 100, clock = clock)
+    cache.loadSnapshot(self.path)
+    self.assertEquals(0, len(cache._cache)) # pylint: disable=W0212
+    self.assertEquals(0, len(cache._fallback)) # pylint: disable=W0212
+    mox.Verify(original)
+
+
+
+class FallbackStoreTest(unittest.TestCase):
+  """Tests for the fallback address store."""
+
+  def testStoredAgain(self):
+    """Test that storing a key again makes it the newest entry without using up room."""
+    store = dnsCache._FallbackStore(2, None, task.Clock()) # pylint: disable=W0212
+    store['k'] = '1.1.1.1'
+    store['k'] = '2.2.2.2'
+    store['j'] = '3.3.3.3'
+    self.assertEquals(2, len(store))
+    self.assertEquals('2.2.2.2', store['k'])
+    store['k'] = '4.4.4.4'
+    store['i'] = '5.5.5.5'
+    self.assertEquals(['k', 'i'], [key for key, _, _ in store.items()])
+
+
+
+class HeavyHittersTest(unittest.TestCase):
+  """Tests for HeavyHitters."""
+
+  def testCounts(self):
+    """Test that frequent keys are kept."""
+    hitters = dnsCache.HeavyHitters(3)
+    for key in 'aaaaabcdbbbbbe':
+      hitters.add(key)
+    counts = hitters.getCounts()
+    self.assertEquals(3, len(counts))
+    self.assertEquals(5, counts['a'])
+    self.assertTrue(counts['b'] >= 6)
+
+
+  def testReplacesSmallest(self):
+    """Test that a new key replaces a key with the lowest count and inherits it."""
+    hitters = dnsCache.HeavyHitters(2)
+    for key in 'aaabbc':
+      hitters.add(key)
+    self.assertEquals({'a': 3, 'c': 3}, hitters.getCounts())
+    for key in 'dde':
+      hitters.add(key)
+    self.assertEquals({'d': 5, 'e': 4}, hitters.getCounts())
+
+
+  def testEmpty(self):
+    """Test that a table with no room ignores keys."""
+    hitters = dnsCache.HeavyHitters(0)
+    hitters.add('a')
+    self.assertEquals({}, hitters.getCounts())
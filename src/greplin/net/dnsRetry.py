@@ -17,33 +17,227 @@
 from greplin.defer import inline, time
 
 from twisted.internet import defer, interfaces
+from twisted.names.error import DNSNameError
+from twisted.python import failure
 
 from zope.interface import implements
 
+import collections
 import logging
 
 
 
+class _HedgedLookup(object):
+  """A lookup that is also sent to a second resolver if the first has not answered after a delay.
+
+  The first answer wins and the other lookup is cancelled.  If the first lookup fails before the delay, the second is
+  sent straight away.  The lookup only fails once both have failed.
+  """
+
+  def __init__(self, owner, primary, hedge, delay, name, args):
+    self.__owner = owner
+    self.__hedge = hedge
+    self.__name = name
+    self.__args = args
+    self.__pending = []
+    self.__hedgeCall = None
+    self.__startTime = owner.clock.seconds()
+    self.result = defer.Deferred(self.__cancel)
+    self.__hedgeCall = owner.clock.callLater(delay, self.__startHedge)
+    self.__start(primary, False)
+
+
+  def __start(self, resolver, isHedge):
+    """Sends the lookup to the given resolver."""
+    d = defer.maybeDeferred(resolver.getHostByName, self.__name, *self.__args)
+    self.__pending.append(d)
+    d.addBoth(self.__finished, d, isHedge)
+
+
+  def __startHedge(self):
+    """Sends the lookup to the second resolver."""
+    self.__hedgeCall = None
+    self.__owner.hedges += 1
+    self.__start(self.__hedge, True)
+
+
+  def __finished(self, result, d, isHedge):
+    """Handles the result of one of the lookups."""
+    if self.result.called or d not in self.__pending:
+      return None # Swallow errors, including cancellation, from the losing lookup.
+    self.__pending.remove(d)
+
+    if isinstance(result, failure.Failure):
+      if self.__hedgeCall is not None:
+        self.__hedgeCall.cancel()
+        self.__startHedge()
+      elif not self.__pending:
+        self.result.errback(result)
+      return None
+
+    if isHedge:
+      self.__owner.hedgeWins += 1
+    # Time the whole lookup, so a slow first resolver still pushes the adaptive delay up when a hedge answers for it.
+    self.__owner.recordLatency(self.__owner.clock.seconds() - self.__startTime)
+    self.__stop()
+    self.result.callback(result)
+    return None
+
+
+  def __stop(self):
+    """Cancels the hedge timer and any lookups that are still running."""
+    if self.__hedgeCall is not None:
+      self.__hedgeCall.cancel()
+      self.__hedgeCall = None
+    pending = self.__pending
+    self.__pending = []
+    for d in pending:
+      d.cancel()
+
+
+  def __cancel(self, _):
+    """Cancels the whole lookup."""
+    self.__stop()
+
+
+
 class RetryingDNS(object):
-  """DNS resolver that retries on failure."""
+  """DNS resolver that retries on failure.
+
+  If hedgeDelay is given, each try that has not answered after hedgeDelay seconds is also sent to the next of the
+  alternates resolvers (or to original again if there are none), and the first answer is used.  If hedgePercentile is
+  also given, the delay adapts to that percentile of recent lookup latencies once there are enough of them, with
+  hedgeDelay used until then.  hedges counts the hedged lookups sent and hedgeWins how many of them answered first.
+
+  Concurrent lookups of the same name share a single chain of tries; coalesced counts the lookups that joined one.
+  Failures that isDefinitive returns true for, by default the name not existing, are not retried and are remembered
+  for negativeTtl seconds, so lookups of the name in that time fail straight away.  At most maxNegative such failures
+  are remembered.  negativeHits counts the lookups answered this way.
+  """
   implements(interfaces.IResolverSimple)
 
 
-  def __init__(self, original, tries = 5, sleep = time.SleepManager(5, 60, 10)):
+  def __init__(self, original, tries = 5, sleep = time.SleepManager(5, 60, 10), alternates = (), hedgeDelay = None,
+               hedgePercentile = None, latencySamples = 100, isDefinitive = None, negativeTtl = 60,
+               maxNegative = 10000, clock = None):
     self._original = original
     self._tries = tries
     self._sleep = sleep
+    self._alternates = alternates
+    self._hedgeDelay = hedgeDelay
+    self._hedgePercentile = hedgePercentile
+    self._latencies = collections.deque(maxlen=latencySamples)
+    self._nextAlternate = 0
+    self._isDefinitive = isDefinitive or (lambda err: err.check(DNSNameError) is not None)
+    self._negativeTtl = negativeTtl
+    self._maxNegative = maxNegative
+    self._negative = collections.OrderedDict() # Key -> (exception, time to forget it), oldest first.
+    self._inFlight = {} # Key -> (deferred for the tries in progress, list of deferreds waiting for them).
+    if clock is None:
+      from twisted.internet import reactor
+      clock = reactor
+    self.clock = clock
+    self.hedges = 0
+    self.hedgeWins = 0
+    self.coalesced = 0
+    self.negativeHits = 0
+
+
+  def recordLatency(self, seconds):
+    """Records how long a lookup took."""
+    self._latencies.append(seconds)
+
+
+  def getHedgeDelay(self):
+    """Returns how many seconds to wait for an answer before sending a hedged lookup."""
+    samples = self._latencies
+    if self._hedgePercentile is None or len(samples) < samples.maxlen:
+      return self._hedgeDelay
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * self._hedgePercentile / 100.0))]
+
+
+  def __lookup(self, name, args):
+    """Looks up the name once, hedging if configured to."""
+    if self._hedgeDelay is None:
+      return self._original.getHostByName(name, *args)
+    if self._alternates:
+      hedge = self._alternates[self._nextAlternate % len(self._alternates)]
+      self._nextAlternate += 1
+    else:
+      hedge = self._original
+    return _HedgedLookup(self, self._original, hedge, self.getHedgeDelay(), name, args).result
+
+
+  def __rememberFailure(self, key, exception):
+    """Remembers a definitive failure for the given key."""
+    if not self._negativeTtl:
+      return
+    self._negative.pop(key, None)
+    self._negative[key] = (exception, self.clock.seconds() + self._negativeTtl)
+    while len(self._negative) > self._maxNegative:
+      self._negative.popitem(last=False)
 
 
-  @inline.callbacks
   def getHostByName(self, name, *args):
-    """Gets a host by name."""
+    """Gets a host by name.  Always returns a deferred, even when the answer or failure is known straight away."""
+    key = (name,) + args
+    negative = self._negative.get(key)
+    if negative is not None:
+      if negative[1] > self.clock.seconds():
+        self.negativeHits += 1
+        return defer.fail(negative[0])
+      del self._negative[key]
+
+    if key in self._inFlight:
+      self.coalesced += 1
+      waiting = self._inFlight[key][1]
+    else:
+      tries = defer.maybeDeferred(self.__resolve, name, args)
+      if tries.called:
+        return tries
+      waiting = []
+      self._inFlight[key] = (tries, waiting)
+      tries.addBoth(self.__resolved, key)
+
+    d = defer.Deferred(lambda d: self.__abandon(key, d))
+    waiting.append(d)
+    return d
+
+
+  def __abandon(self, key, d):
+    """Stops the given deferred waiting for the key, cancelling the tries if nothing else is waiting for them."""
+    tries, waiting = self._inFlight[key]
+    waiting.remove(d)
+    if not waiting:
+      del self._inFlight[key]
+      tries.cancel()
+
+
+  def __resolved(self, result, key):
+    """Passes the result of the tries for the given key to everything waiting for it."""
+    isFailure = isinstance(result, failure.Failure)
+    _, waiting = self._inFlight.pop(key, (None, ()))
+    for d in waiting:
+      if isFailure:
+        d.errback(result)
+      else:
+        d.callback(result)
+    return None if isFailure else result # Errors were passed on to every caller.
+
+
+  @inline.callbacks
+  def __resolve(self, name, args):
+    """Looks up the name, retrying as necessary."""
     sleepManager = None
     for tryIndex in range(self._tries):
       try:
-        result = yield self._original.getHostByName(name, *args)
+        result = yield self.__lookup(name, args)
         defer.returnValue(result)
-      except Exception: # This is intended to catch general exceptions! # pylint: disable=W0703
+      except Exception as e: # This is intended to catch general exceptions! # pylint: disable=W0703
+        if self._isDefinitive(failure.Failure()):
+          self.__rememberFailure((name,) + args, e)
+          raise
         if tryIndex == self._tries - 1:
           raise
         else:
@@ -20,7 +20,8 @@ import unittest
 from greplin.defer import time
 from greplin.net import dnsRetry
 
-from twisted.internet import defer, error
+from twisted.internet import defer, error, task
+from twisted.names.error import DNSNameError
 from twisted.python import failure
 
 
@@ -38,10 +39,12 @@ class RetryingDNSTest(unittest.TestCase):
     mox.Replay(original)
 
     cache = dnsRetry.RetryingDNS(original, tries=1)
-    self.assertRaises(error.DNSLookupError, cache.getHostByName, 'google.com')
+    result = cache.getHostByName('google.com')
+    self.assertTrue(result.result.check(error.DNSLookupError))
+    result.addErrback(lambda _: None) # Consume the error.
 
     result = cache.getHostByName('google.com')
-    self.assertEquals(result, '1.2.3.4')
+    self.assertEquals(result.result, '1.2.3.4')
     mox.Verify(original)
 
 
@@ -56,5 +59,229 @@ class RetryingDNSTest(unittest.TestCase):
 
     cache = dnsRetry.RetryingDNS(original, tries=2, sleep=time.SleepManager(0, 0, 0))
     result = cache.getHostByName('google.com')
-    self.assertEquals(result, '1.2.3.4')
+    self.assertEquals(result.result, '1.2.3.4')
+    mox.Verify(original)
+
+
+
+  def testCoalesced(self):
+    """Test that concurrent lookups of a name share their tries."""
+    lookup = defer.Deferred()
+    original = mox.MockAnything()
+    original.getHostByName('google.com').AndReturn(lookup)
+    original.getHostByName('google.com').AndReturn(defer.succeed('5.6.7.8'))
+    mox.Replay(original)
+
+    resolver = dnsRetry.RetryingDNS(original, tries=1)
+    first = resolver.getHostByName('google.com')
+    second = resolver.getHostByName('google.com')
+    lookup.callback('1.2.3.4')
+    self.assertEquals('1.2.3.4', first.result)
+    self.assertEquals('1.2.3.4', second.result)
+    self.assertEquals(1, resolver.coalesced)
+    self.assertEquals('5.6.7.8', resolver.getHostByName('google.com').result)
+    mox.Verify(original)
+
+
+  def testCoalescedFailure(self):
+    """Test that a failure is passed to every lookup that shared the tries."""
+    lookup = defer.Deferred()
+    original = mox.MockAnything()
+    original.getHostByName('google.com').AndReturn(lookup)
+    mox.Replay(original)
+
+    resolver = dnsRetry.RetryingDNS(original, tries=1)
+    results = [resolver.getHostByName('google.com') for _ in range(3)]
+    lookup.errback(error.DNSLookupError('Fake DNS failure'))
+    for result in results:
+      self.assertTrue(result.result.check(error.DNSLookupError))
+      result.addErrback(lambda _: None) # Consume the error.
+    mox.Verify(original)
+
+
+  def testCancelCoalesced(self):
+    """Test that the tries are only cancelled once every lookup sharing them is cancelled."""
+    cancelled = []
+    original = mox.MockAnything()
+    original.getHostByName('google.com').AndReturn(defer.Deferred(lambda _: cancelled.append(True)))
+    mox.Replay(original)
+
+    resolver = dnsRetry.RetryingDNS(original, tries=1)
+    first = resolver.getHostByName('google.com')
+    second = resolver.getHostByName('google.com')
+    first.addErrback(lambda _: None)
+    second.addErrback(lambda _: None)
+    first.cancel()
+    self.assertEquals([], cancelled)
+    second.cancel()
+    self.assertEquals([True], cancelled)
+    mox.Verify(original)
+
+
+  def testNegativeCache(self):
+    """Test that names that do not exist are not retried, and are remembered."""
+    original = mox.MockAnything()
+    original.getHostByName('nowhere.com').AndReturn(defer.fail(failure.Failure(DNSNameError('nowhere.com'))))
+    original.getHostByName('nowhere.com').AndReturn(defer.succeed('1.2.3.4'))
+    mox.Replay(original)
+
+    clock = task.Clock()
+    resolver = dnsRetry.RetryingDNS(original, tries=5, negativeTtl=10, clock=clock)
+    result = resolver.getHostByName('nowhere.com')
+    self.assertTrue(result.result.check(DNSNameError))
+    result.addErrback(lambda _: None) # Consume the error.
+    result = resolver.getHostByName('nowhere.com')
+    self.assertTrue(result.result.check(DNSNameError))
+    result.addErrback(lambda _: None) # Consume the error.
+    self.assertEquals(1, resolver.negativeHits)
+
+    clock.advance(10)
+    self.assertEquals('1.2.3.4', resolver.getHostByName('nowhere.com').result)
+    mox.Verify(original)
+
+
+  def testAlwaysDeferred(self):
+    """Test that answers and failures known straight away are still returned as deferreds."""
+    original = mox.MockAnything()
+    original.getHostByName('nowhere.com').AndReturn(defer.fail(failure.Failure(DNSNameError('nowhere.com'))))
+    original.getHostByName('google.com').AndReturn(defer.succeed('1.2.3.4'))
+    mox.Replay(original)
+
+    resolver = dnsRetry.RetryingDNS(original, clock=task.Clock())
+    results = [resolver.getHostByName(name) for name in ('nowhere.com', 'nowhere.com', 'google.com')]
+    for result in results:
+      self.assertTrue(isinstance(result, defer.Deferred))
+    results[0].addErrback(lambda _: None) # Consume the error.
+    results[1].addErrback(lambda _: None) # Consume the error.
     mox.Verify(original)
+
+
+  def testMaxNegative(self):
+    """Test that only the most recent definitive failures are remembered."""
+    original = mox.MockAnything()
+    for name in ('a.com', 'b.com', 'a.com'):
+      original.getHostByName(name).AndReturn(defer.fail(failure.Failure(DNSNameError(name))))
+    mox.Replay(original)
+
+    resolver = dnsRetry.RetryingDNS(original, maxNegative=1, clock=task.Clock())
+    for name in ('a.com', 'b.com', 'b.com', 'a.com'):
+      result = resolver.getHostByName(name)
+      self.assertTrue(result.result.check(DNSNameError))
+      result.addErrback(lambda _: None) # Consume the error.
+    self.assertEquals(1, resolver.negativeHits)
+    mox.Verify(original)
+
+
+
+class HedgedDNSTest(unittest.TestCase):
+  """Tests for hedged lookups."""
+
+  def setUp(self):
+    self.clock = task.Clock()
+    self.primary = mox.MockAnything()
+    self.alternate = mox.MockAnything()
+    self.cancelled = []
+
+
+  def tearDown(self):
+    mox.Verify(self.primary)
+    mox.Verify(self.alternate)
+
+
+  def deferred(self, name):
+    """Returns a deferred that records when it is cancelled."""
+    return defer.Deferred(lambda _: self.cancelled.append(name))
+
+
+  def testFastPrimary(self):
+    """Test that no hedge is sent when the first resolver answers in time."""
+    primaryResult = self.deferred('primary')
+    self.primary.getHostByName('google.com').AndReturn(primaryResult)
+    mox.Replay(self.primary, self.alternate)
+
+    resolver = dnsRetry.RetryingDNS(self.primary, alternates=[self.alternate], hedgeDelay=1, clock=self.clock)
+    result = resolver.getHostByName('google.com')
+    self.clock.advance(0.5)
+    primaryResult.callback('1.2.3.4')
+    self.assertEquals('1.2.3.4', result.result)
+    self.clock.advance(1)
+    self.assertEquals((0, 0), (resolver.hedges, resolver.hedgeWins))
+    self.assertEquals([0.5], list(resolver._latencies)) # pylint: disable=W0212
+
+
+  def testHedgeWins(self):
+    """Test that a slow first resolver is hedged and cancelled when the hedge answers."""
+    alternateResult = self.deferred('alternate')
+    self.primary.getHostByName('google.com').AndReturn(self.deferred('primary'))
+    self.alternate.getHostByName('google.com').AndReturn(alternateResult)
+    mox.Replay(self.primary, self.alternate)
+
+    resolver = dnsRetry.RetryingDNS(self.primary, alternates=[self.alternate], hedgeDelay=1, clock=self.clock)
+    result = resolver.getHostByName('google.com')
+    self.clock.advance(1)
+    self.assertFalse(result.called)
+    self.clock.advance(0.5)
+    alternateResult.callback('5.6.7.8')
+    self.assertEquals('5.6.7.8', result.result)
+    self.assertEquals(['primary'], self.cancelled)
+    self.assertEquals((1, 1), (resolver.hedges, resolver.hedgeWins))
+    self.assertEquals([1.5], list(resolver._latencies)) # pylint: disable=W0212
+
+
+  def testPrimaryFailsFast(self):
+    """Test that the hedge is sent straight away when the first resolver fails."""
+    self.primary.getHostByName('google.com').AndReturn(
+        defer.fail(failure.Failure(error.DNSLookupError('Fake DNS failure'))))
+    self.alternate.getHostByName('google.com').AndReturn(defer.succeed('5.6.7.8'))
+    mox.Replay(self.primary, self.alternate)
+
+    resolver = dnsRetry.RetryingDNS(self.primary, tries=1, alternates=[self.alternate], hedgeDelay=1,
+                                    clock=self.clock)
+    self.assertEquals('5.6.7.8', resolver.getHostByName('google.com').result)
+    self.assertEquals([], self.clock.getDelayedCalls())
+
+
+  def testBothFail(self):
+    """Test that a try fails once both lookups fail."""
+    alternateResult = self.deferred('alternate')
+    primaryResult = self.deferred('primary')
+    self.primary.getHostByName('google.com').AndReturn(primaryResult)
+    self.alternate.getHostByName('google.com').AndReturn(alternateResult)
+    mox.Replay(self.primary, self.alternate)
+
+    resolver = dnsRetry.RetryingDNS(self.primary, tries=1, alternates=[self.alternate], hedgeDelay=1,
+                                    clock=self.clock)
+    result = resolver.getHostByName('google.com')
+    self.clock.advance(1)
+    alternateResult.errback(error.DNSLookupError('Fake DNS failure'))
+    self.assertFalse(result.called)
+    primaryResult.errback(error.DNSLookupError('Fake DNS failure'))
+    self.assertTrue(result.result.check(error.DNSLookupError))
+    result.addErrback(lambda _: None) # Consume the error.
+    self.assertEquals([], self.cancelled)
+
+
+  def testCancel(self):
+    """Test that cancelling a lookup cancels both resolvers."""
+    self.primary.getHostByName('google.com').AndReturn(self.deferred('primary'))
+    self.alternate.getHostByName('google.com').AndReturn(self.deferred('alternate'))
+    mox.Replay(self.primary, self.alternate)
+
+    resolver = dnsRetry.RetryingDNS(self.primary, alternates=[self.alternate], hedgeDelay=1, clock=self.clock)
+    result = resolver.getHostByName('google.com')
+    self.clock.advance(1)
+    result.addErrback(lambda _: None)
+    result.cancel()
+    self.assertEquals(['primary', 'alternate'], self.cancelled)
+
+
+  def testPercentileDelay(self):
+    """Test that the hedge delay follows recent latencies."""
+    mox.Replay(self.primary, self.alternate)
+    resolver = dnsRetry.RetryingDNS(self.primary, hedgeDelay=1, hedgePercentile=90, latencySamples=10,
+                                    clock=self.clock)
+    for i in range(9):
+      resolver.recordLatency(i * 0.1)
+    self.assertEquals(1, resolver.getHedgeDelay())
+    resolver.recordLatency(0.9)
+    self.assertAlmostEquals(0.9, resolver.getHedgeDelay())